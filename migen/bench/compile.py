@@ -0,0 +1,274 @@
+"""Benchmark of the elaboration and Verilog conversion of designs
+
+Builds synthetic designs (wide datapaths, large FSMs, deep ``Array``
+multiplexers, a sorting network, many FIFOs and a ``Record`` bus fabric)
+and converts them to Verilog, measuring the time spent in each phase:
+``get_fragment`` (including ``finalize``), the lowering passes, naming
+and printing. Times of nested phases are included in the time of the
+enclosing phase (e.g. ``lower_basics`` in ``lower_specials``). The peak
+memory of each phase is measured with ``tracemalloc`` in a second run,
+for the outermost phases only.
+
+Usage: ``python -m migen.bench.compile [--scale N] [--output FILE.json]
+[design ...]``
+"""
+
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+from functools import wraps
+
+from migen import *
+from migen.fhdl import verilog
+from migen.genlib.fifo import SyncFIFO, AsyncFIFO
+from migen.genlib.fsm import FSM, NextState, NextValue
+from migen.genlib.record import Record, DIR_M_TO_S, DIR_S_TO_M
+from migen.genlib.sort import BitonicSort
+
+
+class _Datapath(Module):
+    def __init__(self, scale):
+        self.i = Signal(64)
+        self.o = Signal(256)
+        x = Replicate(self.i, 4)
+        for n in range(64*scale):
+            y = Signal(256)
+            self.comb += y.eq(Cat(x[128:], x[:128]) ^ Replicate(x[n % 256], 256))
+            z = Signal(256)
+            self.sync += z.eq(Cat(*[y[i:i+16] + 1 for i in range(0, 256, 16)]))
+            x = z
+        self.comb += self.o.eq(x)
+        self.ios = {self.i, self.o}
+
+
+class _FSM(Module):
+    def __init__(self, scale):
+        self.i = Signal(8)
+        self.o = Signal(16)
+        self.submodules.fsm = fsm = FSM()
+        states = 1000*scale
+        for n in range(states):
+            fsm.act(n,
+                NextValue(self.o, self.o + n),
+                If(self.i == (n & 0xff),
+                    NextState((n + 1) % states)
+                ).Elif(self.i == 0xff,
+                    NextState(n//2)
+                )
+            )
+        self.ios = {self.i, self.o}
+
+
+class _Array(Module):
+    def __init__(self, scale):
+        self.sel = Signal(16)
+        self.o = Signal(32)
+        values = Array(Signal(32, reset=n) for n in range(256))
+        for n in range(16*scale):
+            index = Signal(8)
+            self.sync += index.eq(self.sel + n)
+            row = Array(values[(index + i) & 0xff] for i in range(16))
+            o = Signal(32)
+            self.comb += o.eq(row[self.sel[:4]])
+            self.sync += values[n % 256].eq(o)
+        self.comb += self.o.eq(values[self.sel[8:]])
+        self.ios = {self.sel, self.o}
+
+
+class _Sort(Module):
+    def __init__(self, scale):
+        self.submodules.sort = BitonicSort(64*scale, 16)
+        self.ios = set(self.sort.i) | set(self.sort.o)
+
+
+class _FIFOs(Module):
+    def __init__(self, scale):
+        self.din = Signal(32)
+        self.dout = Signal(32)
+        self.ios = {self.din, self.dout}
+        data = self.din
+        for n in range(32*scale):
+            if n % 4:
+                fifo = SyncFIFO(32, 16)
+            else:
+                fifo = ClockDomainsRenamer({"write": "sys", "read": "sys"})(
+                    AsyncFIFO(32, 16))
+            self.submodules += fifo
+            self.comb += [
+                fifo.din.eq(data),
+                fifo.we.eq(fifo.writable),
+                fifo.re.eq(fifo.readable)
+            ]
+            data = fifo.dout
+        self.comb += self.dout.eq(data)
+
+
+_bus_layout = [
+    ("adr", 30, DIR_M_TO_S),
+    ("dat_w", 32, DIR_M_TO_S),
+    ("dat_r", 32, DIR_S_TO_M),
+    ("sel", 4, DIR_M_TO_S),
+    ("cyc", 1, DIR_M_TO_S),
+    ("stb", 1, DIR_M_TO_S),
+    ("ack", 1, DIR_S_TO_M),
+    ("we", 1, DIR_M_TO_S)
+]
+
+
+class _Bus(Module):
+    def __init__(self, scale):
+        masters = [Record(_bus_layout) for i in range(4*scale)]
+        slaves = [Record(_bus_layout) for i in range(16*scale)]
+        self.ios = set()
+        for bus in masters + slaves:
+            self.ios |= set(bus.flatten())
+        for n, slave in enumerate(slaves):
+            grant = Signal(max=len(masters))
+            requests = Cat(*[master.cyc & (master.adr[24:] == n)
+                             for master in masters])
+            self.sync += If(~requests.part(grant, 1),
+                grant.eq(grant + 1))
+            self.comb += Case(grant, {
+                m: master.connect(slave, omit={"cyc", "ack", "dat_r"})
+                for m, master in enumerate(masters)
+            })
+            self.comb += slave.cyc.eq(requests.part(grant, 1))
+        for m, master in enumerate(masters):
+            self.comb += [
+                master.ack.eq(Array(slave.ack for slave in slaves)[master.adr[24:]]),
+                master.dat_r.eq(Array(slave.dat_r for slave in slaves)[master.adr[24:]])
+            ]
+
+
+designs = {
+    "datapath": _Datapath,
+    "fsm": _FSM,
+    "array": _Array,
+    "sort": _Sort,
+    "fifos": _FIFOs,
+    "bus": _Bus
+}
+
+
+_phases = [
+    "list_clock_domains", "lower_basics", "insert_resets", "lower_specials",
+    "build_namespace", "group_by_targets", "_printheader", "_printcomb",
+    "_printsync", "_printspecials"
+]
+
+
+class _Recorder:
+    def __init__(self, memory):
+        self.memory = memory
+        self.results = dict()
+        self.depth = 0
+
+    def measure(self, name, f, *args, **kwargs):
+        result = self.results.setdefault(name, {"time": 0.0, "calls": 0})
+        outermost = self.memory and self.depth == 0
+        if outermost:
+            tracemalloc.reset_peak()
+            start_memory = tracemalloc.get_traced_memory()[0]
+        self.depth += 1
+        start = time.perf_counter()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            result["time"] += time.perf_counter() - start
+            result["calls"] += 1
+            self.depth -= 1
+            if outermost:
+                peak = tracemalloc.get_traced_memory()[1] - start_memory
+                result["peak_memory"] = max(result.get("peak_memory", 0), peak)
+
+    def wrap(self, name, f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            return self.measure(name, f, *args, **kwargs)
+        return wrapper
+
+
+def _convert(design, scale, memory):
+    recorder = _Recorder(memory)
+    originals = {name: getattr(verilog, name) for name in _phases}
+    for name, f in originals.items():
+        setattr(verilog, name, recorder.wrap(name, f))
+    try:
+        module = recorder.measure("elaborate", design, scale)
+        fragment = recorder.measure("get_fragment", module.get_fragment)
+        output = recorder.measure("convert", verilog.convert, fragment, module.ios)
+    finally:
+        for name, f in originals.items():
+            setattr(verilog, name, f)
+    results = recorder.results
+    results["output_size"] = len(output.main_source)
+    return results
+
+
+def run(names=None, scale=1, memory=True):
+    """Convert the designs, measuring each phase
+
+    Returns
+    -------
+    dict
+        For each design, the ``time`` (in seconds), ``calls`` and
+        ``peak_memory`` (in bytes, with ``memory``) of each phase, and
+        the size of the Verilog output.
+    """
+    if names is None:
+        names = sorted(designs.keys())
+    # tracemalloc.reset_peak appeared in Python 3.9
+    memory = memory and hasattr(tracemalloc, "reset_peak")
+    results = dict()
+    for name in names:
+        result = _convert(designs[name], scale, False)
+        if memory:
+            tracemalloc.start()
+            try:
+                memory_result = _convert(designs[name], scale, True)
+            finally:
+                tracemalloc.stop()
+            for phase, r in memory_result.items():
+                if isinstance(r, dict) and "peak_memory" in r:
+                    result[phase]["peak_memory"] = r["peak_memory"]
+        results[name] = result
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("designs", nargs="*",
+                        help="designs to convert, among {} (default: all)"
+                             .format(", ".join(sorted(designs.keys()))))
+    parser.add_argument("--scale", type=int, default=1,
+                        help="size factor of the designs (default: %(default)s)")
+    parser.add_argument("--no-memory", action="store_true",
+                        help="do not measure memory, which takes a second run")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+    for name in args.designs:
+        if name not in designs:
+            parser.error("unknown design: " + name)
+    results = run(args.designs or None, args.scale, not args.no_memory)
+    report = {
+        "python": sys.version,
+        "scale": args.scale,
+        "designs": results
+    }
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    for name, result in sorted(results.items()):
+        print(name)
+        for phase, r in result.items():
+            if isinstance(r, dict):
+                line = "  {:22} {:10.4f} s".format(phase, r["time"])
+                if "peak_memory" in r:
+                    line += " {:10.1f} MiB".format(r["peak_memory"]/(1 << 20))
+                print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""Micro-benchmark of the simulator's expression evaluator
+
+Times ``Evaluator.eval`` and ``Evaluator.assign`` on slices, part-selects,
+concatenations, replications and truncations of wide values, i.e. the
+operations dominating the interpreted simulation of wide datapaths.
+
+Usage: ``python -m migen.bench.evaluator [--width N] [--number N]``
+"""
+
+import argparse
+import timeit
+
+from migen.fhdl.structure import *
+from migen.sim.core import Evaluator
+
+
+def _cases(width):
+    a = Signal(width, reset=(1 << width) - 3)
+    b = Signal((width, True))
+    offset = Signal(max=width//2, reset=width//4)
+    quarter = width//4
+    return a, [
+        ("slice", a[quarter:3*quarter], None),
+        ("part", a.part(offset, width//2), None),
+        ("cat", Cat(*[a[i:i+8] for i in range(0, width, 8)]), None),
+        ("replicate", Replicate(a[:8], width//8), None),
+        ("truncate", None, b.eq(a + 1)),
+        ("assign slice", None, a[quarter:3*quarter].eq(b)),
+        ("assign part", None, a.part(offset, width//2).eq(b)),
+        ("assign cat", None, Cat(*[b[i:i+8] for i in range(0, width, 8)]).eq(a)),
+    ]
+
+
+def run(width=512, number=20000):
+    """Time each operation on values of the given width
+
+    Returns
+    -------
+    list of (str, float)
+        Name of each operation and the time of one evaluation, in seconds.
+    """
+    evaluator = Evaluator([], [])
+    results = []
+    a, cases = _cases(width)
+    for name, expression, statement in cases:
+        if statement is None:
+            f = lambda: evaluator.eval(expression)
+        else:
+            f = lambda: evaluator.execute([statement])
+        t = min(timeit.repeat(f, number=number, repeat=3))
+        evaluator.commit()
+        results.append((name, t/number))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--width", type=int, default=512,
+                        help="width of the values (default: %(default)s)")
+    parser.add_argument("--number", type=int, default=20000,
+                        help="evaluations per measurement (default: %(default)s)")
+    args = parser.parse_args()
+    for name, t in run(args.width, args.number):
+        print("{:15} {:10.2f} us".format(name, t*1e6))
+
+
+if __name__ == "__main__":
+    main()
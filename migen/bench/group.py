@@ -0,0 +1,59 @@
+"""Benchmark of the grouping of combinatorial statements
+
+Times ``group_by_targets`` on a large list of combinatorial statements:
+single assignments, which stay in their own groups, and ``If``
+statements assigning two targets, which merge groups that were created
+long before.
+
+Usage: ``python -m migen.bench.group [--statements N]``
+"""
+
+import argparse
+import random
+import time
+
+from migen.fhdl.structure import *
+from migen.fhdl.tools import group_by_targets
+
+
+def _statements(n, seed=0):
+    prng = random.Random(seed)
+    targets = [Signal(8) for i in range(n//2)]
+    condition = Signal()
+    statements = []
+    for i in range(n):
+        a = targets[i % len(targets)]
+        if i % 3:
+            statements.append(a.eq(i))
+        else:
+            b = prng.choice(targets)
+            statements.append(If(condition, a.eq(b), b.eq(a + 1)))
+    return statements
+
+
+def run(statements=100000):
+    """Group the statements
+
+    Returns
+    -------
+    (float, int)
+        The time taken, in seconds, and the number of groups.
+    """
+    statements = _statements(statements)
+    start = time.perf_counter()
+    groups = group_by_targets(statements)
+    return time.perf_counter() - start, len(groups)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--statements", type=int, default=100000,
+                        help="number of statements (default: %(default)s)")
+    args = parser.parse_args()
+    t, groups = run(args.statements)
+    print("{} statements in {} groups: {:.3f} s".format(
+        args.statements, groups, t))
+
+
+if __name__ == "__main__":
+    main()
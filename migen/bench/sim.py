@@ -0,0 +1,281 @@
+"""Benchmark of the simulator
+
+Simulates a set of designs (a farm of counters, a FIR filter, a stressed
+FIFO, a memory-heavy design and AsyncFIFOs between several clock
+domains) with ``Simulator`` and reports, for each of them:
+
+* the simulation speed, in cycles of the ``sys`` clock per second, with
+  and without a VCD file;
+* the average number of delta cycles (combinatorial group executions)
+  per clock edge, from a profiled run;
+* the size of the VCD file and the rate at which it is written;
+* the peak resident set size of the process.
+
+Each design is simulated in a fresh process, so that the peak RSS is
+its own.
+
+Usage: ``python -m migen.bench.sim [--scale N] [--output FILE.json]
+[design ...]``
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+from math import cos, pi, sin
+
+from migen import *
+from migen.genlib.fifo import SyncFIFO, AsyncFIFO
+from migen.sim.core import Simulator
+
+
+class _Counters(Module):
+    def __init__(self, n):
+        self.enable = Signal(n)
+        self.matches = Signal(n)
+        for i in range(n):
+            counter = Signal(32)
+            self.sync += If(self.enable[i], counter.eq(counter + i + 1))
+            self.comb += self.matches[i].eq(counter[:8] == i % 256)
+
+
+def _counters(scale, cycles):
+    dut = _Counters(256*scale)
+    def generator():
+        for cycle in range(cycles):
+            yield dut.enable.eq(cycle*0x9e3779b97f4a7c15)
+            yield
+    return dut, generator()
+
+
+class _FIR(Module):
+    # as in examples/sim/fir.py
+    def __init__(self, coef, wsize=16):
+        self.wsize = wsize
+        self.i = Signal((wsize, True))
+        self.o = Signal((wsize, True))
+        muls = []
+        src = self.i
+        for c in coef:
+            sreg = Signal((wsize, True))
+            self.sync += sreg.eq(src)
+            src = sreg
+            muls.append(int(c*2**(wsize - 1))*sreg)
+        sum_full = Signal((2*wsize-1, True))
+        self.sync += sum_full.eq(sum(muls[1:], muls[0]))
+        self.comb += self.o.eq(sum_full >> wsize-1)
+
+
+def _fir(scale, cycles):
+    # windowed sinc low-pass filter
+    taps = 32*scale
+    coef = []
+    for n in range(taps):
+        x = n - (taps - 1)/2
+        sinc = sin(0.4*pi*x)/(pi*x) if x else 0.4
+        coef.append(sinc*(0.54 - 0.46*cos(2*pi*n/(taps - 1))))
+    dut = _FIR(coef)
+    def generator():
+        f = 2**(dut.wsize - 1)
+        for cycle in range(cycles):
+            yield dut.i.eq(int(0.1*f*cos(2*pi*0.05*cycle)))
+            yield
+    return dut, generator()
+
+
+def _fifo(scale, cycles):
+    dut = SyncFIFO(32, 64*scale)
+    def writer():
+        prng = random.Random(1)
+        data = 0
+        for cycle in range(cycles):
+            we = prng.random() < 0.6
+            yield dut.we.eq(we)
+            yield dut.din.eq(data)
+            yield
+            if we and (yield dut.writable):
+                data += 1
+    @passive
+    def reader():
+        prng = random.Random(2)
+        expected = 0
+        while True:
+            re = prng.random() < 0.5
+            yield dut.re.eq(re)
+            yield
+            if re and (yield dut.readable):
+                if (yield dut.dout) != expected:
+                    raise ValueError("FIFO data mismatch")
+                expected += 1
+    return dut, [writer(), reader()]
+
+
+class _Memories(Module):
+    def __init__(self, n, depth):
+        self.address = Signal(32)
+        self.sum = Signal(32)
+        self.sync += self.address.eq(self.address + 0x9e3779b9)
+        outputs = []
+        for i in range(n):
+            mem = Memory(32, depth, init=list(range(depth)))
+            write = mem.get_port(write_capable=True)
+            read = mem.get_port(async_read=True)
+            self.specials += mem, write, read
+            self.comb += [
+                write.adr.eq(self.address + i),
+                write.dat_w.eq(write.dat_r + 1),
+                write.we.eq(self.address[i % 32]),
+                read.adr.eq(self.address >> 16)
+            ]
+            outputs.append(read.dat_r)
+        self.sync += self.sum.eq(sum(outputs[1:], outputs[0]))
+
+
+def _memory(scale, cycles):
+    dut = _Memories(8*scale, 4096)
+    def generator():
+        for cycle in range(cycles):
+            yield
+    return dut, generator()
+
+
+class _Domains(Module):
+    def __init__(self, n):
+        self.din = Signal(16)
+        self.we = Signal()
+        self.dout = Signal(16)
+        self.clock_domains.cd_fast = ClockDomain(reset_less=True)
+        self.clock_domains.cd_slow = ClockDomain(reset_less=True)
+        data, we = self.din, self.we
+        # sys -> slow -> fast -> sys -> ...
+        domains = ["sys", "slow", "fast"]
+        for i in range(n):
+            fifo = ClockDomainsRenamer({"write": domains[i % 3],
+                                        "read": domains[(i + 1) % 3]})(
+                AsyncFIFO(16, 8))
+            self.submodules += fifo
+            self.comb += [
+                fifo.din.eq(data),
+                fifo.we.eq(we),
+                fifo.re.eq(1)
+            ]
+            data, we = fifo.dout, fifo.readable & fifo.re
+        self.comb += self.dout.eq(data)
+
+
+def _domains(scale, cycles):
+    dut = _Domains(6*scale)
+    def generator():
+        for cycle in range(cycles):
+            yield dut.din.eq(cycle)
+            yield dut.we.eq(cycle % 3 == 0)
+            yield
+    return dut, generator(), {"sys": 10, "fast": 7, "slow": 23}
+
+
+designs = {
+    "counters": _counters,
+    "fir": _fir,
+    "fifo": _fifo,
+    "memory": _memory,
+    "domains": _domains
+}
+
+
+def _simulate(name, scale, cycles, **kwargs):
+    design = designs[name](scale, cycles)
+    dut, generators = design[:2]
+    clocks = design[2] if len(design) > 2 else {"sys": 10}
+    start = time.perf_counter()
+    with Simulator(dut, generators, clocks, **kwargs) as simulator:
+        simulator.run()
+    return simulator, time.perf_counter() - start
+
+
+def _peak_rss():
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss if sys.platform == "darwin" else rss*1024
+
+
+def _benchmark(name, scale, cycles):
+    simulator, elapsed = _simulate(name, scale, cycles)
+    result = {
+        "cycles": cycles,
+        "cycles_per_second": cycles/elapsed
+    }
+    with tempfile.TemporaryDirectory() as dir:
+        filename = os.path.join(dir, "bench.vcd")
+        simulator, elapsed = _simulate(name, scale, cycles, vcd_name=filename)
+        size = os.path.getsize(filename)
+    result["cycles_per_second_traced"] = cycles/elapsed
+    result["vcd_bytes"] = size
+    result["vcd_bytes_per_second"] = size/elapsed
+    simulator, elapsed = _simulate(name, scale, cycles, profile=True)
+    profile = simulator.profile
+    result["deltas_per_edge"] = (sum(k*v for k, v in profile.deltas.items())
+                                 / profile.edges)
+    result["peak_rss"] = _peak_rss()
+    return result
+
+
+def run(names=None, scale=1, cycles=2000):
+    """Simulate the designs for the given number of ``sys`` cycles
+
+    Returns
+    -------
+    dict
+        The measurements of each design.
+    """
+    if names is None:
+        names = sorted(designs.keys())
+    context = multiprocessing.get_context("spawn")
+    results = dict()
+    for name in names:
+        with context.Pool(1) as pool:
+            results[name] = pool.apply(_benchmark, (name, scale, cycles))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("designs", nargs="*",
+                        help="designs to simulate, among {} (default: all)"
+                             .format(", ".join(sorted(designs.keys()))))
+    parser.add_argument("--scale", type=int, default=1,
+                        help="size factor of the designs (default: %(default)s)")
+    parser.add_argument("--cycles", type=int, default=2000,
+                        help="cycles of the sys clock (default: %(default)s)")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+    for name in args.designs:
+        if name not in designs:
+            parser.error("unknown design: " + name)
+    results = run(args.designs or None, args.scale, args.cycles)
+    if args.output is not None:
+        report = {
+            "python": sys.version,
+            "scale": args.scale,
+            "designs": results
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    print("{:10} {:>10} {:>10} {:>8} {:>10} {:>8}".format(
+        "", "cycles/s", "traced", "deltas", "VCD kB/s", "RSS MB"))
+    for name, r in sorted(results.items()):
+        print("{:10} {:10.0f} {:10.0f} {:8.2f} {:10.0f} {:>8}".format(
+            name, r["cycles_per_second"], r["cycles_per_second_traced"],
+            r["deltas_per_edge"], r["vcd_bytes_per_second"]/1e3,
+            "-" if r["peak_rss"] is None else "{:.0f}".format(r["peak_rss"]/1e6)))
+
+
+if __name__ == "__main__":
+    main()
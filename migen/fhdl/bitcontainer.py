@@ -61,7 +61,18 @@ def value_bits_sign(v):
     """
     if isinstance(v, (f.Constant, f.Signal)):
         return v.nbits, v.signed
-    elif isinstance(v, (f.ClockSignal, f.ResetSignal)):
+    # Expressions are not modified after their creation, so their shape is
+    # computed once, unless the shape of a signal changes in the meantime.
+    cached = getattr(v, "_bits_sign", None)
+    if cached is not None and cached[0] == f._shape_generation:
+        return cached[1]
+    bits_sign = _value_bits_sign(v)
+    v._bits_sign = f._shape_generation, bits_sign
+    return bits_sign
+
+
+def _value_bits_sign(v):
+    if isinstance(v, (f.ClockSignal, f.ResetSignal)):
         return 1, False
     elif isinstance(v, f._Operator):
         obs = list(map(value_bits_sign, v.operands))
@@ -117,6 +128,8 @@ def value_bits_sign(v):
     elif isinstance(v, f._ArrayProxy):
         bsc = list(map(value_bits_sign, v.choices))
         return max(bs[0] for bs in bsc), any(bs[1] for bs in bsc)
+    elif isinstance(v, f._MemoryLocation):
+        return v.memory.width, False
     else:
         raise TypeError("Can not calculate bit length of {} {}".format(
             type(v), v))
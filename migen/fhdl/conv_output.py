@@ -3,11 +3,27 @@ from operator import itemgetter
 
 class ConvOutput:
     def __init__(self):
-        self.main_source = ""
+        # the main source is kept as a list of fragments, which are only
+        # joined when main_source is read
+        self._main_source = []
         self.data_files = dict()
 
+    @property
+    def main_source(self):
+        if len(self._main_source) != 1:
+            self._main_source = ["".join(self._main_source)]
+        return self._main_source[0]
+
+    @main_source.setter
+    def main_source(self, src):
+        self.set_main_source(src)
+
     def set_main_source(self, src):
-        self.main_source = src
+        """Set the main source, from a string or a list of strings."""
+        if isinstance(src, str):
+            self._main_source = [src]
+        else:
+            self._main_source = src
 
     def add_data_file(self, filename_base, content):
         filename = filename_base
@@ -21,15 +37,16 @@ class ConvOutput:
         return filename
 
     def __str__(self):
-        r = self.main_source + "\n"
+        r = [self.main_source, "\n"]
         for filename, content in sorted(self.data_files.items(),
                                         key=itemgetter(0)):
-            r += filename + ":\n" + content
-        return r
+            r += [filename, ":\n", content]
+        return "".join(r)
 
     def write(self, main_filename):
+        # the fragments are written one by one, without joining them
         with open(main_filename, "w") as f:
-            f.write(self.main_source)
+            f.writelines(self._main_source)
         for filename, content in self.data_files.items():
             with open(filename, "w") as f:
                 f.write(content)
@@ -52,6 +52,46 @@ class FullMemoryWE(ModuleTransformer):
             f.specials -= set(oldmem.ports)
 
 
+def _lower_ports(f, mem, storage):
+    # Add the statements modelling the ports of mem to fragment f.
+    # storage[address] is the memory word at the given address.
+    for port in mem.ports:
+        try:
+            sync = f.sync[port.clock.cd]
+        except KeyError:
+            sync = f.sync[port.clock.cd] = []
+
+        # read
+        if port.async_read:
+            f.comb.append(port.dat_r.eq(storage[port.adr]))
+        else:
+            if port.mode == WRITE_FIRST:
+                adr_reg = Signal.like(port.adr)
+                rd_stmt = adr_reg.eq(port.adr)
+                f.comb.append(port.dat_r.eq(storage[adr_reg]))
+            elif port.mode == NO_CHANGE and port.we is not None:
+                rd_stmt = If(~port.we, port.dat_r.eq(storage[port.adr]))
+            else: # NO_CHANGE without write capability reduces to READ_FIRST
+                rd_stmt = port.dat_r.eq(storage[port.adr])
+            if port.re is None:
+                sync.append(rd_stmt)
+            else:
+                sync.append(If(port.re, rd_stmt))
+
+        # write
+        if port.we is not None:
+            if port.we_granularity:
+                n = mem.width//port.we_granularity
+                for i in range(n):
+                    m = i*port.we_granularity
+                    M = (i+1)*port.we_granularity
+                    sync.append(If(port.we[i],
+                                storage[port.adr][m:M].eq(port.dat_w[m:M])))
+            else:
+                sync.append(If(port.we,
+                               storage[port.adr].eq(port.dat_w)))
+
+
 class MemoryToArray(ModuleTransformer):
     def __init__(self):
         self.replacements = dict()
@@ -78,43 +118,35 @@ class MemoryToArray(ModuleTransformer):
                 mem_storage = Signal(mem.width, name_override=storage_name())
                 storage.append(mem_storage)
 
-            for port in mem.ports:
-                try:
-                    sync = f.sync[port.clock.cd]
-                except KeyError:
-                    sync = f.sync[port.clock.cd] = []
-
-                # read
-                if port.async_read:
-                    f.comb.append(port.dat_r.eq(storage[port.adr]))
-                else:
-                    if port.mode == WRITE_FIRST:
-                        adr_reg = Signal.like(port.adr)
-                        rd_stmt = adr_reg.eq(port.adr)
-                        f.comb.append(port.dat_r.eq(storage[adr_reg]))
-                    elif port.mode == NO_CHANGE and port.we is not None:
-                        rd_stmt = If(~port.we, port.dat_r.eq(storage[port.adr]))
-                    else: # NO_CHANGE without write capability reduces to READ_FIRST
-                        rd_stmt = port.dat_r.eq(storage[port.adr])
-                    if port.re is None:
-                        sync.append(rd_stmt)
-                    else:
-                        sync.append(If(port.re, rd_stmt))
-
-                # write
-                if port.we is not None:
-                    if port.we_granularity:
-                        n = mem.width//port.we_granularity
-                        for i in range(n):
-                            m = i*port.we_granularity
-                            M = (i+1)*port.we_granularity
-                            sync.append(If(port.we[i],
-                                        storage[port.adr][m:M].eq(port.dat_w[m:M])))
-                    else:
-                        sync.append(If(port.we,
-                                       storage[port.adr].eq(port.dat_w)))
+            _lower_ports(f, mem, storage)
+            processed_ports.update(mem.ports)
+
+        newspecials -= processed_ports
+        f.specials = newspecials
+
+
+class MemoryToLocations(ModuleTransformer):
+    """Lower memory ports into statements accessing memory words.
+
+    Unlike MemoryToArray, memories are kept as a whole and their words
+    are accessed with ``Memory.__getitem__``. The result can only be
+    simulated.
+    """
+    def __init__(self):
+        self.memories = []
+
+    def transform_fragment(self, i, f):
+        newspecials = set()
+        processed_ports = set()
+
+        for mem in sorted(f.specials, key=lambda x: x.duid):
+            if not isinstance(mem, Memory):
+                newspecials.add(mem)
+                continue
 
-                processed_ports.add(port)
+            self.memories.append(mem)
+            _lower_ports(f, mem, mem)
+            processed_ports.update(mem.ports)
 
         newspecials -= processed_ports
         f.specials = newspecials
@@ -1,7 +1,7 @@
 from operator import itemgetter
 
 from migen.fhdl.structure import *
-from migen.fhdl.structure import _Value
+from migen.fhdl.structure import _Value, _MemoryLocation
 from migen.fhdl.module import *
 from migen.fhdl.bitcontainer import bits_for, value_bits_sign
 from migen.fhdl.tools import *
@@ -191,48 +191,48 @@ class Instance(Special):
 
     @staticmethod
     def emit_verilog(instance, ns, add_data_file):
-        r = instance.of + " "
+        r = [instance.of, " "]
         parameters = list(filter(lambda i: isinstance(i, Instance.Parameter), instance.items))
         if parameters:
-            r += "#(\n"
+            r.append("#(\n")
             firstp = True
             for p in parameters:
                 if not firstp:
-                    r += ",\n"
+                    r.append(",\n")
                 firstp = False
-                r += "\t." + p.name + "("
+                r.append("\t." + p.name + "(")
                 if isinstance(p.value, Constant):
-                    r += verilog_printexpr(ns, p.value)[0]
+                    r.append(verilog_printexpr(ns, p.value)[0])
                 elif isinstance(p.value, float):
-                    r += str(p.value)
+                    r.append(str(p.value))
                 elif isinstance(p.value, Instance.PreformattedParam):
-                    r += p.value
+                    r.append(p.value)
                 elif isinstance(p.value, str):
-                    r += "\"" + p.value + "\""
+                    r.append("\"" + p.value + "\"")
                 else:
                     raise TypeError
-                r += ")"
-            r += "\n) "
-        r += ns.get_name(instance)
-        if parameters: r += " "
-        r += "(\n"
+                r.append(")")
+            r.append("\n) ")
+        r.append(ns.get_name(instance))
+        if parameters: r.append(" ")
+        r.append("(\n")
         firstp = True
         for p in instance.items:
             if isinstance(p, Instance._IO):
                 name_inst = p.name
                 name_design = verilog_printexpr(ns, p.expr)[0]
                 if not firstp:
-                    r += ",\n"
+                    r.append(",\n")
                 firstp = False
-                r += "\t." + name_inst + "(" + name_design + ")"
+                r.append("\t." + name_inst + "(" + name_design + ")")
         if not firstp:
-            r += "\n"
+            r.append("\n")
         if instance.synthesis_directive is not None:
             synthesis_directive = "/* synthesis {} */".format(instance.synthesis_directive)
-            r += ")" + synthesis_directive + ";\n\n"
+            r.append(")" + synthesis_directive + ";\n\n")
         else:
-            r += ");\n\n"
-        return r
+            r.append(");\n\n")
+        return "".join(r)
 
 
 (READ_FIRST, WRITE_FIRST, NO_CHANGE) = range(3)
@@ -268,13 +268,6 @@ class _MemoryPort(Special):
         return ""  # done by parent Memory object
 
 
-class _MemoryLocation(_Value):
-    def __init__(self, memory, index):
-        _Value.__init__(self)
-        self.memory = memory
-        self.index = wrap(index)
-
-
 class Memory(Special):
     def __init__(self, width, depth, init=None, name=None):
         Special.__init__(self)
@@ -316,7 +309,7 @@ class Memory(Special):
 
     @staticmethod
     def emit_verilog(memory, ns, add_data_file):
-        r = ""
+        r = []
         def gn(e):
             if isinstance(e, Memory):
                 return ns.get_name(e)
@@ -324,9 +317,9 @@ class Memory(Special):
                 return verilog_printexpr(ns, e)[0]
         adrbits = bits_for(memory.depth-1)
 
-        r += "reg [" + str(memory.width-1) + ":0] " \
-            + gn(memory) \
-            + "[0:" + str(memory.depth-1) + "];\n"
+        r.append("reg [" + str(memory.width-1) + ":0] "
+            + gn(memory)
+            + "[0:" + str(memory.depth-1) + "];\n")
 
         adr_regs = {}
         data_regs = {}
@@ -334,17 +327,17 @@ class Memory(Special):
             if not port.async_read:
                 if port.mode == WRITE_FIRST:
                     adr_reg = Signal(name_override="memadr")
-                    r += "reg [" + str(adrbits-1) + ":0] " \
-                        + gn(adr_reg) + ";\n"
+                    r.append("reg [" + str(adrbits-1) + ":0] "
+                        + gn(adr_reg) + ";\n")
                     adr_regs[id(port)] = adr_reg
                 else:
                     data_reg = Signal(name_override="memdat")
-                    r += "reg [" + str(memory.width-1) + ":0] " \
-                        + gn(data_reg) + ";\n"
+                    r.append("reg [" + str(memory.width-1) + ":0] "
+                        + gn(data_reg) + ";\n")
                     data_regs[id(port)] = data_reg
 
         for port in memory.ports:
-            r += "always @(posedge " + gn(port.clock) + ") begin\n"
+            r.append("always @(posedge " + gn(port.clock) + ") begin\n")
             if port.we is not None:
                 if port.we_granularity:
                     n = memory.width//port.we_granularity
@@ -352,11 +345,11 @@ class Memory(Special):
                         m = i*port.we_granularity
                         M = (i+1)*port.we_granularity-1
                         sl = "[" + str(M) + ":" + str(m) + "]"
-                        r += "\tif (" + gn(port.we) + "[" + str(i) + "])\n"
-                        r += "\t\t" + gn(memory) + "[" + gn(port.adr) + "]" + sl + " <= " + gn(port.dat_w) + sl + ";\n"
+                        r.append("\tif (" + gn(port.we) + "[" + str(i) + "])\n")
+                        r.append("\t\t" + gn(memory) + "[" + gn(port.adr) + "]" + sl + " <= " + gn(port.dat_w) + sl + ";\n")
                 else:
-                    r += "\tif (" + gn(port.we) + ")\n"
-                    r += "\t\t" + gn(memory) + "[" + gn(port.adr) + "] <= " + gn(port.dat_w) + ";\n"
+                    r.append("\tif (" + gn(port.we) + ")\n")
+                    r.append("\t\t" + gn(memory) + "[" + gn(port.adr) + "] <= " + gn(port.dat_w) + ";\n")
             if not port.async_read:
                 if port.mode == WRITE_FIRST:
                     rd = "\t" + gn(adr_regs[id(port)]) + " <= " + gn(port.adr) + ";\n"
@@ -368,31 +361,29 @@ class Memory(Special):
                         rd = "\tif (!" + gn(port.we) + ")\n" \
                           + "\t\t" + bassign
                 if port.re is None:
-                    r += rd
+                    r.append(rd)
                 else:
-                    r += "\tif (" + gn(port.re) + ")\n"
-                    r += "\t" + rd.replace("\n\t", "\n\t\t")
-            r += "end\n\n"
+                    r.append("\tif (" + gn(port.re) + ")\n")
+                    r.append("\t" + rd.replace("\n\t", "\n\t\t"))
+            r.append("end\n\n")
 
         for port in memory.ports:
             if port.async_read:
-                r += "assign " + gn(port.dat_r) + " = " + gn(memory) + "[" + gn(port.adr) + "];\n"
+                r.append("assign " + gn(port.dat_r) + " = " + gn(memory) + "[" + gn(port.adr) + "];\n")
             else:
                 if port.mode == WRITE_FIRST:
-                    r += "assign " + gn(port.dat_r) + " = " + gn(memory) + "[" + gn(adr_regs[id(port)]) + "];\n"
+                    r.append("assign " + gn(port.dat_r) + " = " + gn(memory) + "[" + gn(adr_regs[id(port)]) + "];\n")
                 else:
-                    r += "assign " + gn(port.dat_r) + " = " + gn(data_regs[id(port)]) + ";\n"
-        r += "\n"
+                    r.append("assign " + gn(port.dat_r) + " = " + gn(data_regs[id(port)]) + ";\n")
+        r.append("\n")
 
         if memory.init is not None:
-            content = ""
             formatter = "{:0" + str(int(memory.width / 4)) + "X}\n"
-            for d in memory.init:
-                content += formatter.format(d)
+            content = "".join(formatter.format(d) for d in memory.init)
             memory_filename = add_data_file(gn(memory) + ".init", content)
 
-            r += "initial begin\n"
-            r += "\t$readmemh(\"" + memory_filename + "\", " + gn(memory) + ");\n"
-            r += "end\n\n"
+            r.append("initial begin\n")
+            r.append("\t$readmemh(\"" + memory_filename + "\", " + gn(memory) + ");\n")
+            r.append("end\n\n")
 
-        return r
+        return "".join(r)
@@ -7,6 +7,11 @@ from migen.fhdl import tracer as _tracer
 from migen.util.misc import flat_iteration as _flat_iteration
 
 
+# Incremented whenever the shape of a signal is changed after its creation.
+# This invalidates the shapes cached on expressions by value_bits_sign.
+_shape_generation = 0
+
+
 class DUID:
     """Deterministic Unique IDentifier"""
     __next_uid = 0
@@ -26,6 +31,9 @@ class _Value(DUID):
     Values created from integers have the minimum bit width to necessary to
     represent the integer.
     """
+    # (_shape_generation, (nbits, signed)), see value_bits_sign
+    _bits_sign = None
+
     def __bool__(self):
         # Special case: Constants and Signals are part of a set or used as
         # dictionary keys, and Python needs to check for equality.
@@ -399,6 +407,9 @@ class Signal(_Value):
     def __setattr__(self, k, v):
         if k == "reset":
             v = wrap(v)
+        elif (k == "nbits" or k == "signed") and k in self.__dict__:
+            global _shape_generation
+            _shape_generation += 1
         _Value.__setattr__(self, k, v)
 
     def __repr__(self):
@@ -680,6 +691,14 @@ class Array(list):
         else:
             return list.__getitem__(self, key)
 
+
+class _MemoryLocation(_Value):
+    # word of a Memory, see Memory.__getitem__ (simulation only)
+    def __init__(self, memory, index):
+        _Value.__init__(self)
+        self.memory = memory
+        self.index = wrap(index)
+
 # clock domains
 
 class ClockDomain:
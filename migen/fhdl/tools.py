@@ -1,6 +1,7 @@
 from migen.fhdl.structure import *
-from migen.fhdl.structure import _Slice, _Part, _Assign, _Fragment
-from migen.fhdl.visit import NodeVisitor, NodeTransformer
+from migen.fhdl.structure import (_Slice, _Part, _Assign, _Fragment,
+                                  _ClockDomainList)
+from migen.fhdl.visit import NodeVisitor, NodeTransformer, fuse
 from migen.fhdl.bitcontainer import value_bits_sign
 from migen.util.misc import flat_iteration
 
@@ -27,20 +28,51 @@ class _TargetLister(NodeVisitor):
         self.visit(node.l)
         self.target_context = False
 
+    def visit_Part(self, node):
+        # the offset is an input, even on the left hand side
+        self.visit(node.value)
+
     def visit_ArrayProxy(self, node):
         for choice in node.choices:
             self.visit(choice)
 
+    def visit_MemoryLocation(self, node):
+        pass
+
 
 class _InputLister(NodeVisitor):
     def __init__(self):
         self.output_list = set()
+        self.target_context = False
 
     def visit_Signal(self, node):
-        self.output_list.add(node)
+        if not self.target_context:
+            self.output_list.add(node)
 
     def visit_Assign(self, node):
         self.visit(node.r)
+        # indices used on the left hand side are inputs as well
+        self.target_context = True
+        self.visit(node.l)
+        self.target_context = False
+
+    def _visit_index(self, node):
+        old_target_context = self.target_context
+        self.target_context = False
+        self.visit(node)
+        self.target_context = old_target_context
+
+    def visit_Part(self, node):
+        self.visit(node.value)
+        self._visit_index(node.offset)
+
+    def visit_ArrayProxy(self, node):
+        for choice in node.choices:
+            self.visit(choice)
+        self._visit_index(node.key)
+
+    def visit_MemoryLocation(self, node):
+        self._visit_index(node.index)
 
 
 def list_signals(node):
@@ -61,30 +93,47 @@ def list_inputs(node):
     return lister.output_list
 
 
-def _resort_statements(ol):
-    return [statement for i, statement in
-            sorted(ol, key=lambda x: x[0])]
-
-
 def group_by_targets(sl):
-    groups = []
-    seen = set()
-    for order, stmt in enumerate(flat_iteration(sl)):
-        targets = set(list_targets(stmt))
-        group = [(order, stmt)]
-        disjoint = targets.isdisjoint(seen)
-        seen |= targets
-        if not disjoint:
-            groups, old_groups = [], groups
-            for old_targets, old_group in old_groups:
-                if targets.isdisjoint(old_targets):
-                    groups.append((old_targets, old_group))
-                else:
-                    targets |= old_targets
-                    group += old_group
-        groups.append((targets, group))
-    return [(targets, _resort_statements(stmts))
-        for targets, stmts in groups]
+    # Statements sharing a target are joined with a union-find structure.
+    # Each group keeps its statements in their original order, and the
+    # groups are ordered by their last statement.
+    statements = list(flat_iteration(sl))
+    parent = list(range(len(statements)))
+    size = [1]*len(statements)
+    owner = dict()
+    targets = []
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for order, stmt in enumerate(statements):
+        stmt_targets = list_targets(stmt)
+        targets.append(stmt_targets)
+        for target in stmt_targets:
+            other = owner.setdefault(target, order)
+            if other != order:
+                a, b = find(other), find(order)
+                if a != b:
+                    if size[a] < size[b]:
+                        a, b = b, a
+                    parent[b] = a
+                    size[a] += size[b]
+
+    groups = dict()
+    last = dict()
+    for order, stmt in enumerate(statements):
+        root = find(order)
+        try:
+            group_targets, group = groups[root]
+        except KeyError:
+            group_targets, group = groups[root] = (set(), [])
+        group_targets |= targets[order]
+        group.append(stmt)
+        last[root] = order
+    return [groups[root] for root in sorted(groups, key=last.__getitem__)]
 
 
 def list_special_ios(f, ins, outs, inouts):
@@ -155,17 +204,26 @@ def insert_reset(rst, sl):
     return sl + [If(rst, *generate_reset(rst, sl))]
 
 
-def insert_resets(f):
+def insert_resets(f, lowered=False):
+    # With lowered, the basics of f have already been lowered (see
+    # lower_basics), and the reset signals of its clock domains are used
+    # instead of ResetSignal.
     newsync = dict()
     for k, v in f.sync.items():
         if f.clock_domains[k].rst is not None:
-            newsync[k] = insert_reset(ResetSignal(k), v)
+            if lowered:
+                rst = f.clock_domains[k].rst
+            else:
+                rst = ResetSignal(k)
+            newsync[k] = insert_reset(rst, v)
         else:
             newsync[k] = v
     f.sync = newsync
 
 
 class _Lowerer(NodeTransformer):
+    share_unchanged = True
+
     def __init__(self):
         self.target_context = False
         self.extra_stmts = []
@@ -196,7 +254,9 @@ class _BasicLowerer(_Lowerer):
 
     def visit_ArrayProxy(self, node):
         # TODO: rewrite without variables
-        array_muxed = Signal(value_bits_sign(node), variable=True)
+        # the variable holds no state, so it is excluded from resets
+        array_muxed = Signal(value_bits_sign(node), variable=True,
+                             reset_less=True)
         if self.target_context:
             k = self.visit(node.key)
             cases = {}
@@ -257,6 +317,11 @@ class _ComplexPartLowerer(_Lowerer):
         node = _Part(value_proxy, offset_proxy, node.width)
         return NodeTransformer.visit_Part(self, node)
 
+class _ComplexSliceBasicLowerer(fuse(_ComplexSliceLowerer, _BasicLowerer)):
+    # the lowered signals are named as if the passes were separate
+    _tracer_prefix = "_BasicLowerer"
+
+
 def _apply_lowerer(l, f):
     f = l.visit(f)
     f.comb += l.comb
@@ -277,8 +342,16 @@ def _apply_lowerer(l, f):
     return f
 
 
-def lower_basics(f):
-    return _apply_lowerer(_BasicLowerer(f.clock_domains), f)
+def lower_basics(f, complex_slices=False, clock_domains=None):
+    # With complex_slices, complex slices are lowered in the same traversal
+    # (see lower_complex_slices). clock_domains defaults to those of f.
+    if clock_domains is None:
+        clock_domains = f.clock_domains
+    if complex_slices:
+        lowerer = _ComplexSliceBasicLowerer(clock_domains)
+    else:
+        lowerer = _BasicLowerer(clock_domains)
+    return _apply_lowerer(lowerer, f)
 
 
 def lower_complex_slices(f):
@@ -346,10 +419,16 @@ def _lower_specials_step(overrides, specials):
     return f, lowered_specials
 
 
-def lower_specials(overrides, f):
+def lower_specials(overrides, f, lower=None):
+    # lower, if not None, is applied to the fragment produced by each step
+    # before it is added to f, e.g. lower_basics: this avoids another pass
+    # over the whole of f. It is given the clock domains of both fragments.
     lowered_specials = set()
     while True:
         fs, lowered_specials_step = _lower_specials_step(overrides, f.specials)
+        if lower is not None:
+            fs = lower(fs, clock_domains=_ClockDomainList(
+                f.clock_domains + fs.clock_domains))
         f += fs
         if lowered_specials_step:
             lowered_specials |= lowered_specials_step
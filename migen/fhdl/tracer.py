@@ -96,6 +96,15 @@ name_to_idx = defaultdict(int)
 classname_to_objs = dict()
 
 
+def reset():
+    """Forget all names and objects seen so far.
+
+    Names inferred after a reset are the same as in a fresh interpreter.
+    """
+    name_to_idx.clear()
+    classname_to_objs.clear()
+
+
 def index_id(l, obj):
     for n, e in enumerate(l):
         if id(e) == id(obj):
@@ -132,7 +141,10 @@ def trace_back(varname=None):
                 l.insert(0, (coname, name_to_idx[coname]))
                 name_to_idx[coname] += 1
         else:
-            classname = obj.__class__.__name__.lower()
+            # a class can set _tracer_prefix to name the signals it
+            # creates after another class
+            classname = getattr(obj.__class__, "_tracer_prefix",
+                                obj.__class__.__name__).lower()
             try:
                 objs = classname_to_objs[classname]
             except KeyError:
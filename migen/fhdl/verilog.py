@@ -120,7 +120,11 @@ def _printexpr(ns, node):
 (_AT_BLOCKING, _AT_NONBLOCKING, _AT_SIGNAL) = range(3)
 
 
-def _printnode(ns, at, level, node):
+# The printers below append the fragments of the output to the list r,
+# so that large netlists are not copied over and over by string
+# concatenation.
+
+def _printnode(ns, at, level, node, r):
     if isinstance(node, _Assign):
         if at == _AT_BLOCKING:
             assignment = " = "
@@ -130,34 +134,32 @@ def _printnode(ns, at, level, node):
             assignment = " = "
         else:
             assignment = " <= "
-        return "\t"*level + _printexpr(ns, node.l)[0] + assignment + _printexpr(ns, node.r)[0] + ";\n"
+        r += ["\t"*level, _printexpr(ns, node.l)[0], assignment,
+              _printexpr(ns, node.r)[0], ";\n"]
     elif isinstance(node, collections.abc.Iterable):
-        return "".join(list(map(partial(_printnode, ns, at, level), node)))
+        for n in node:
+            _printnode(ns, at, level, n, r)
     elif isinstance(node, If):
-        r = "\t"*level + "if (" + _printexpr(ns, node.cond)[0] + ") begin\n"
-        r += _printnode(ns, at, level + 1, node.t)
+        r += ["\t"*level, "if (", _printexpr(ns, node.cond)[0], ") begin\n"]
+        _printnode(ns, at, level + 1, node.t, r)
         if node.f:
-            r += "\t"*level + "end else begin\n"
-            r += _printnode(ns, at, level + 1, node.f)
-        r += "\t"*level + "end\n"
-        return r
+            r += ["\t"*level, "end else begin\n"]
+            _printnode(ns, at, level + 1, node.f, r)
+        r += ["\t"*level, "end\n"]
     elif isinstance(node, Case):
         if node.cases:
-            r = "\t"*level + "case (" + _printexpr(ns, node.test)[0] + ")\n"
+            r += ["\t"*level, "case (", _printexpr(ns, node.test)[0], ")\n"]
             css = [(k, v) for k, v in node.cases.items() if isinstance(k, Constant)]
             css = sorted(css, key=lambda x: x[0].value)
             for choice, statements in css:
-                r += "\t"*(level + 1) + _printexpr(ns, choice)[0] + ": begin\n"
-                r += _printnode(ns, at, level + 2, statements)
-                r += "\t"*(level + 1) + "end\n"
+                r += ["\t"*(level + 1), _printexpr(ns, choice)[0], ": begin\n"]
+                _printnode(ns, at, level + 2, statements, r)
+                r += ["\t"*(level + 1), "end\n"]
             if "default" in node.cases:
-                r += "\t"*(level + 1) + "default: begin\n"
-                r += _printnode(ns, at, level + 2, node.cases["default"])
-                r += "\t"*(level + 1) + "end\n"
-            r += "\t"*level + "endcase\n"
-            return r
-        else:
-            return ""
+                r += ["\t"*(level + 1), "default: begin\n"]
+                _printnode(ns, at, level + 2, node.cases["default"], r)
+                r += ["\t"*(level + 1), "end\n"]
+            r += ["\t"*level, "endcase\n"]
     elif isinstance(node, Display):
         s = "\"" + node.s + "\""
         for arg in node.args:
@@ -166,16 +168,15 @@ def _printnode(ns, at, level, node):
                 s += ns.get_name(arg)
             else:
                 s += str(arg)
-        return "\t"*level + "$display(" + s + ");\n"
+        r += ["\t"*level, "$display(", s, ");\n"]
     elif isinstance(node, Finish):
-        return "\t"*level + "$finish;\n"
+        r += ["\t"*level, "$finish;\n"]
     else:
         raise TypeError("Node of unrecognized type: "+str(type(node)))
 
 
-def _list_comb_wires_regs(f):
+def _list_comb_wires_regs(groups):
     w, r = set(), set()
-    groups = group_by_targets(f.comb)
     for g in groups:
         if len(g[1]) == 1 and isinstance(g[1][0], _Assign):
             w |= g[0]
@@ -208,108 +209,101 @@ def _printattr(attr, attr_translate):
     return r
 
 
-def _printheader(f, ios, name, ns, attr_translate):
-    sigs = list_signals(f) | list_special_ios(f, True, True, True)
+def _printheader(f, ios, name, ns, attr_translate, sigs, groups, r):
     special_outs = list_special_ios(f, False, True, True)
     inouts = list_special_ios(f, False, False, True)
-    targets = list_targets(f) | special_outs
-    wires, comb_regs = _list_comb_wires_regs(f)
+    targets = list_targets(f.sync) | special_outs
+    for g in groups:
+        targets |= g[0]
+    wires, comb_regs = _list_comb_wires_regs(groups)
     wires |= special_outs
-    r = "module " + name + "(\n"
+    r += ["module ", name, "(\n"]
     firstp = True
     for sig in sorted(ios, key=lambda x: x.duid):
         if not firstp:
-            r += ",\n"
+            r.append(",\n")
         firstp = False
         attr = _printattr(sig.attr, attr_translate)
         if attr:
-            r += "\t" + attr
+            r += ["\t", attr]
         if sig in inouts:
-            r += "\tinout " + _printsig(ns, sig)
+            r += ["\tinout ", _printsig(ns, sig)]
         elif sig in targets:
             if sig in wires:
-                r += "\toutput " + _printsig(ns, sig)
+                r += ["\toutput ", _printsig(ns, sig)]
             else:
-                r += "\toutput reg " + _printsig(ns, sig)
+                r += ["\toutput reg ", _printsig(ns, sig)]
         else:
-            r += "\tinput " + _printsig(ns, sig)
-    r += "\n);\n\n"
+            r += ["\tinput ", _printsig(ns, sig)]
+    r.append("\n);\n\n")
     for sig in sorted(sigs - ios, key=lambda x: x.duid):
         attr = _printattr(sig.attr, attr_translate)
         if attr:
-            r += attr + " "
+            r += [attr, " "]
         if sig in wires:
-            r += "wire " + _printsig(ns, sig) + ";\n"
+            r += ["wire ", _printsig(ns, sig), ";\n"]
         else:
             if sig not in comb_regs:
-                r += "reg " + _printsig(ns, sig) + " = " + _printexpr(ns, sig.reset)[0] + ";\n"
+                r += ["reg ", _printsig(ns, sig), " = ", _printexpr(ns, sig.reset)[0], ";\n"]
             else:
-                r += "reg " + _printsig(ns, sig) + ";\n"
-    r += "\n"
-    return r
+                r += ["reg ", _printsig(ns, sig), ";\n"]
+    r.append("\n")
 
 
-def _printcomb(f, ns, display_run):
-    r = ""
+def _printcomb(f, ns, display_run, groups, r):
     if f.comb:
         # Add a dummy event (using a dummy signal 'dummy_s') to get the simulator
         # to run the combinatorial process once at the beginning.
         syn_off = "// synthesis translate_off\n"
         syn_on = "// synthesis translate_on\n"
         dummy_s = Signal(name_override="dummy_s")
-        r += syn_off
-        r += "reg " + _printsig(ns, dummy_s) + ";\n"
-        r += "initial " + ns.get_name(dummy_s) + " <= 1'd0;\n"
-        r += syn_on
-        r += "\n"
-
-        groups = group_by_targets(f.comb)
+        r.append(syn_off)
+        r += ["reg ", _printsig(ns, dummy_s), ";\n"]
+        r += ["initial ", ns.get_name(dummy_s), " <= 1'd0;\n"]
+        r.append(syn_on)
+        r.append("\n")
 
         for n, g in enumerate(groups):
             if len(g[1]) == 1 and isinstance(g[1][0], _Assign):
-                r += "assign " + _printnode(ns, _AT_BLOCKING, 0, g[1][0])
+                r.append("assign ")
+                _printnode(ns, _AT_BLOCKING, 0, g[1][0], r)
             else:
                 dummy_d = Signal(name_override="dummy_d")
-                r += "\n" + syn_off
-                r += "reg " + _printsig(ns, dummy_d) + ";\n"
-                r += syn_on
+                r += ["\n", syn_off]
+                r += ["reg ", _printsig(ns, dummy_d), ";\n"]
+                r.append(syn_on)
 
-                r += "always @(*) begin\n"
+                r.append("always @(*) begin\n")
                 if display_run:
-                    r += "\t$display(\"Running comb block #" + str(n) + "\");\n"
+                    r += ["\t$display(\"Running comb block #", str(n), "\");\n"]
                 for t in sorted(g[0], key=lambda x: x.duid):
-                    r += "\t" + ns.get_name(t) + " <= " + _printexpr(ns, t.reset)[0] + ";\n"
-                r += _printnode(ns, _AT_NONBLOCKING, 1, g[1])
-
-                r += syn_off
-                r += "\t" + ns.get_name(dummy_d) + " <= " + ns.get_name(dummy_s) + ";\n"
-                r += syn_on
-                r += "end\n"
-    r += "\n"
-    return r
+                    r += ["\t", ns.get_name(t), " <= ", _printexpr(ns, t.reset)[0], ";\n"]
+                _printnode(ns, _AT_NONBLOCKING, 1, g[1], r)
 
+                r.append(syn_off)
+                r += ["\t", ns.get_name(dummy_d), " <= ", ns.get_name(dummy_s), ";\n"]
+                r.append(syn_on)
+                r.append("end\n")
+    r.append("\n")
 
-def _printsync(f, ns):
-    r = ""
+
+def _printsync(f, ns, r):
     for k, v in sorted(f.sync.items(), key=itemgetter(0)):
-        r += "always @(posedge " + ns.get_name(f.clock_domains[k].clk) + ") begin\n"
-        r += _printnode(ns, _AT_SIGNAL, 1, v)
-        r += "end\n\n"
-    return r
+        r += ["always @(posedge ", ns.get_name(f.clock_domains[k].clk), ") begin\n"]
+        _printnode(ns, _AT_SIGNAL, 1, v, r)
+        r.append("end\n\n")
 
 
-def _printspecials(overrides, specials, ns, add_data_file, attr_translate):
-    r = ""
+def _printspecials(overrides, specials, ns, add_data_file, attr_translate, r):
     for special in sorted(specials, key=lambda x: x.duid):
         if hasattr(special, "attr"):
             attr = _printattr(special.attr, attr_translate)
             if attr:
-                r += attr + " "
+                r += [attr, " "]
         pr = call_special_classmethod(overrides, special, "emit_verilog", ns, add_data_file)
         if pr is None:
             raise NotImplementedError("Special " + str(special) + " failed to implement emit_verilog")
-        r += pr
-    return r
+        r.append(pr)
 
 
 class DummyAttrTranslate:
@@ -345,30 +339,31 @@ def convert(fi, ios=None, name="top",
                 logging.error(msg)
                 raise KeyError("Unresolved clock domain: \""+cd_name+"\"")
 
-    f = lower_complex_slices(f)
-    insert_resets(f)
-    f = lower_basics(f)
-    f, lowered_specials = lower_specials(special_overrides, f)
-    f = lower_basics(f)
+    # Complex slices and basics are lowered in one traversal, before the
+    # resets are inserted. Only the fragments produced by the lowering of
+    # specials need to be lowered afterwards.
+    f = lower_basics(f, complex_slices=True)
+    insert_resets(f, lowered=True)
+    f, lowered_specials = lower_specials(special_overrides, f, lower_basics)
 
     for io in sorted(ios, key=lambda x: x.duid):
         if io.name_override is None:
             io_name = io.backtrace[-1][0]
             if io_name:
                 io.name_override = io_name
-    ns = build_namespace(list_signals(f) \
-        | list_special_ios(f, True, True, True) \
-        | ios, _reserved_keywords)
+    sigs = list_signals(f) | list_special_ios(f, True, True, True)
+    ns = build_namespace(sigs | ios, _reserved_keywords)
     ns.clock_domains = f.clock_domains
     r.ns = ns
 
-    src = "/* Machine-generated using Migen */\n"
-    src += _printheader(f, ios, name, ns, attr_translate)
-    src += _printcomb(f, ns, display_run=display_run)
-    src += _printsync(f, ns)
-    src += _printspecials(special_overrides, f.specials - lowered_specials,
-        ns, r.add_data_file, attr_translate)
-    src += "endmodule\n"
+    groups = group_by_targets(f.comb)
+    src = ["/* Machine-generated using Migen */\n"]
+    _printheader(f, ios, name, ns, attr_translate, sigs, groups, src)
+    _printcomb(f, ns, display_run, groups, src)
+    _printsync(f, ns, src)
+    _printspecials(special_overrides, f.specials - lowered_specials,
+        ns, r.add_data_file, attr_translate, src)
+    src.append("endmodule\n")
     r.set_main_source(src)
 
     return r
@@ -3,43 +3,51 @@ from operator import itemgetter
 
 from migen.fhdl.structure import *
 from migen.fhdl.structure import (_Operator, _Slice, _Part, _Assign, _ArrayProxy,
-                                  _Fragment)
+                                  _MemoryLocation, _Fragment)
+
+
+# Node types, in the order in which they are tested, with the suffixes of
+# their visit methods
+_node_types = [
+    (Constant, "Constant"),
+    (Signal, "Signal"),
+    (ClockSignal, "ClockSignal"),
+    (ResetSignal, "ResetSignal"),
+    (_Operator, "Operator"),
+    (_Slice, "Slice"),
+    (_Part, "Part"),
+    (Cat, "Cat"),
+    (Replicate, "Replicate"),
+    (_Assign, "Assign"),
+    (If, "If"),
+    (Case, "Case"),
+    (_Fragment, "Fragment"),
+    ((list, tuple), "statements"),
+    (dict, "clock_domains"),
+    (_ArrayProxy, "ArrayProxy"),
+    (_MemoryLocation, "MemoryLocation")
+]
+# type -> name of the visit method, filled as types are encountered
+_visit_methods = dict()
+
+
+def _visit_method(node):
+    try:
+        return _visit_methods[type(node)]
+    except KeyError:
+        pass
+    for types, suffix in _node_types:
+        if isinstance(node, types):
+            break
+    else:
+        suffix = "unknown"
+    r = _visit_methods[type(node)] = "visit_" + suffix
+    return r
 
 
 class NodeVisitor:
     def visit(self, node):
-        if isinstance(node, Constant):
-            self.visit_Constant(node)
-        elif isinstance(node, Signal):
-            self.visit_Signal(node)
-        elif isinstance(node, ClockSignal):
-            self.visit_ClockSignal(node)
-        elif isinstance(node, ResetSignal):
-            self.visit_ResetSignal(node)
-        elif isinstance(node, _Operator):
-            self.visit_Operator(node)
-        elif isinstance(node, _Slice):
-            self.visit_Slice(node)
-        elif isinstance(node, Cat):
-            self.visit_Cat(node)
-        elif isinstance(node, Replicate):
-            self.visit_Replicate(node)
-        elif isinstance(node, _Assign):
-            self.visit_Assign(node)
-        elif isinstance(node, If):
-            self.visit_If(node)
-        elif isinstance(node, Case):
-            self.visit_Case(node)
-        elif isinstance(node, _Fragment):
-            self.visit_Fragment(node)
-        elif isinstance(node, (list, tuple)):
-            self.visit_statements(node)
-        elif isinstance(node, dict):
-            self.visit_clock_domains(node)
-        elif isinstance(node, _ArrayProxy):
-            self.visit_ArrayProxy(node)
-        else:
-            self.visit_unknown(node)
+        getattr(self, _visit_method(node))(node)
 
     def visit_Constant(self, node):
         pass
@@ -103,51 +111,40 @@ class NodeVisitor:
             self.visit(choice)
         self.visit(node.key)
 
+    def visit_MemoryLocation(self, node):
+        self.visit(node.index)
+
     def visit_unknown(self, node):
         pass
 
 
-# Default methods always copy the node, except for:
-# - Signals, ClockSignals and ResetSignals
-# - Unknown objects
-# - All fragment fields except comb and sync
-# In those cases, the original node is returned unchanged.
+def _same(a, b):
+    return (isinstance(b, (list, tuple)) and len(a) == len(b)
+            and all(x is y for x, y in zip(a, b)))
+
+
+# Default methods return a copy of each node. With share_unchanged, they
+# copy a node only when one of its children was changed by the transformer,
+# and return the original node otherwise, so that the parts of the tree that
+# the transformer does not change are shared between its input and its
+# output. Transformers that opt in must not modify their output in place.
+# In both cases:
+# - Fragments are always copied
+# - Lists of statements are always copied (to a list, even from a tuple)
+# - Dictionaries of clock domains are always copied
+#
+# The results of self.visit are not stored into local variables, as the
+# tracer would name the signals created by the visit after them.
 class NodeTransformer:
+    share_unchanged = False
+
     def visit(self, node):
-        if isinstance(node, Constant):
-            return self.visit_Constant(node)
-        elif isinstance(node, Signal):
-            return self.visit_Signal(node)
-        elif isinstance(node, ClockSignal):
-            return self.visit_ClockSignal(node)
-        elif isinstance(node, ResetSignal):
-            return self.visit_ResetSignal(node)
-        elif isinstance(node, _Operator):
-            return self.visit_Operator(node)
-        elif isinstance(node, _Slice):
-            return self.visit_Slice(node)
-        elif isinstance(node, _Part):
-            return self.visit_Part(node)
-        elif isinstance(node, Cat):
-            return self.visit_Cat(node)
-        elif isinstance(node, Replicate):
-            return self.visit_Replicate(node)
-        elif isinstance(node, _Assign):
-            return self.visit_Assign(node)
-        elif isinstance(node, If):
-            return self.visit_If(node)
-        elif isinstance(node, Case):
-            return self.visit_Case(node)
-        elif isinstance(node, _Fragment):
-            return self.visit_Fragment(node)
-        elif isinstance(node, (list, tuple)):
-            return self.visit_statements(node)
-        elif isinstance(node, dict):
-            return self.visit_clock_domains(node)
-        elif isinstance(node, _ArrayProxy):
-            return self.visit_ArrayProxy(node)
-        else:
-            return self.visit_unknown(node)
+        return getattr(self, _visit_method(node))(node)
+
+    def _rebuild(self, node, children, new_children, build):
+        if self.share_unchanged and _same(new_children, children):
+            return node
+        return build(*new_children)
 
     def visit_Constant(self, node):
         return node
@@ -162,35 +159,48 @@ class NodeTransformer:
         return node
 
     def visit_Operator(self, node):
-        return _Operator(node.op, [self.visit(o) for o in node.operands])
+        return self._rebuild(node, node.operands,
+                        [self.visit(o) for o in node.operands],
+                        lambda *operands: _Operator(node.op, operands))
 
     def visit_Slice(self, node):
-        return _Slice(self.visit(node.value), node.start, node.stop)
+        return self._rebuild(node, [node.value], [self.visit(node.value)],
+                        lambda value: _Slice(value, node.start, node.stop))
 
     def visit_Part(self, node):
-        return _Part(self.visit(node.value), self.visit(node.offset), node.width)
+        return self._rebuild(node, [node.value, node.offset],
+                        [self.visit(node.value), self.visit(node.offset)],
+                        lambda value, offset: _Part(value, offset, node.width))
 
     def visit_Cat(self, node):
-        return Cat(*[self.visit(e) for e in node.l])
+        return self._rebuild(node, node.l, [self.visit(e) for e in node.l], Cat)
 
     def visit_Replicate(self, node):
-        return Replicate(self.visit(node.v), node.n)
+        return self._rebuild(node, [node.v], [self.visit(node.v)],
+                        lambda v: Replicate(v, node.n))
 
     def visit_Assign(self, node):
-        return _Assign(self.visit(node.l), self.visit(node.r))
+        return self._rebuild(node, [node.l, node.r],
+                        [self.visit(node.l), self.visit(node.r)], _Assign)
 
     def visit_If(self, node):
         r = If(self.visit(node.cond))
         r.t = self.visit(node.t)
         r.f = self.visit(node.f)
+        if (self.share_unchanged and r.cond is node.cond
+                and _same(r.t, node.t) and _same(r.f, node.f)):
+            return node
         return r
 
     def visit_Case(self, node):
         cases = {v: self.visit(statements)
                  for v, statements in sorted(node.cases.items(),
                                              key=lambda x: -1 if isinstance(x[0], str) and x[0] == "default" else x[0].duid)}
-        r = Case(self.visit(node.test), cases)
-        return r
+        if self.share_unchanged and all(_same(statements, node.cases[v])
+                                        for v, statements in cases.items()):
+            return self._rebuild(node, [node.test], [self.visit(node.test)],
+                            lambda test: Case(test, cases))
+        return Case(self.visit(node.test), cases)
 
     def visit_Fragment(self, node):
         r = copy(node)
@@ -208,8 +218,50 @@ class NodeTransformer:
                                                 key=itemgetter(0))}
 
     def visit_ArrayProxy(self, node):
-        return _ArrayProxy([self.visit(choice) for choice in node.choices],
-            self.visit(node.key))
+        return self._rebuild(node, node.choices + [node.key],
+                        [self.visit(choice) for choice in node.choices]
+                        + [self.visit(node.key)],
+                        lambda *children: _ArrayProxy(children[:-1],
+                                                      children[-1]))
+
+    def visit_MemoryLocation(self, node):
+        return self._rebuild(node, [node.index], [self.visit(node.index)],
+                        lambda index: _MemoryLocation(node.memory, index))
 
     def visit_unknown(self, node):
         return node
+
+
+def fuse(*passes):
+    """Combine visitor or transformer classes into one, so that their
+    passes are run in a single traversal.
+
+    Each node type is handled by the class overriding its visit method, if
+    any, and otherwise by the common base class. The classes share the
+    instance (and therefore its state, e.g. that of a common base class),
+    and its constructor is the first one found in the method resolution
+    order of ``passes``.
+
+    The name of the new class is built from the names of ``passes``. It
+    appears in the names of the signals created by the passes, unless
+    they set ``_tracer_prefix`` (see :mod:`migen.fhdl.tracer`).
+
+    Raises
+    ------
+    ValueError
+        If several classes override the same visit method, as their passes
+        could not be run in the same traversal.
+    """
+    common = set.intersection(*[set(p.__mro__) for p in passes])
+    owners = dict()
+    for p in passes:
+        for cls in p.__mro__:
+            if cls in common:
+                continue
+            for method in cls.__dict__:
+                if method.startswith("visit"):
+                    other = owners.setdefault(method, p)
+                    if other is not p:
+                        raise ValueError("{} and {} both override {}".format(
+                            other.__name__, p.__name__, method))
+    return type("_".join(p.__name__ for p in passes), passes, {})
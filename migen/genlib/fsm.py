@@ -54,6 +54,8 @@ def _target_eq(a, b):
 
 
 class _LowerNext(NodeTransformer):
+    share_unchanged = True
+
     def __init__(self, next_state_signal, encoding, aliases):
         self.next_state_signal = next_state_signal
         self.encoding = encoding
@@ -1 +1,3 @@
-from migen.sim.core import Simulator, run_simulation, passive
+from migen.sim.core import (Simulator, run_simulation, passive,
+                            Sleep, WaitUntil, WaitChange,
+                            GateClock, SetClockPeriod, ShiftClock)
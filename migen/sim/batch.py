@@ -0,0 +1,437 @@
+"""Batched simulation: many instances of the same design in NumPy arrays.
+
+In batch mode (``Simulator(..., lanes=N)``), every signal holds a NumPy
+array of ``N`` values, one per lane, and each lane behaves as an
+independent copy of the design. This module requires NumPy.
+"""
+
+import collections.abc
+
+import numpy
+
+from migen.fhdl.structure import *
+from migen.fhdl.structure import (_Value, _Statement, _Operator, _Slice,
+                                  _Part, _ArrayProxy, _MemoryLocation, _Assign)
+from migen.fhdl.bitcontainer import value_bits_sign
+from migen.fhdl.visit import NodeVisitor
+from migen.sim.core import (Evaluator, str2op, _mask, _replicate_factor,
+                            Sleep, WaitUntil, WaitChange, _ClockCommand)
+
+
+__all__ = ["Lanes", "per_lane"]
+
+
+class Lanes(_Value):
+    """Per-lane values for batch simulation
+
+    Can be used in generator statements, e.g.
+    ``yield dut.a.eq(Lanes(stimulus[cycle]))``.
+
+    Parameters
+    ----------
+    values : array-like
+        One value per lane.
+    """
+    def __init__(self, values):
+        _Value.__init__(self)
+        self.values = numpy.asarray(values)
+
+
+class _LaneStatement(_Statement):
+    def __init__(self, statement, lane):
+        self.statement = statement
+        self.lane = lane
+
+
+def per_lane(generators):
+    """Run one scalar generator per lane
+
+    Combines a list of generators, written as for a normal simulation,
+    into a single batch generator. Generator ``i`` reads and writes the
+    values of lane ``i`` only. The ``Sleep``, ``WaitUntil`` and
+    ``WaitChange`` commands apply to the lane of the generator, and the
+    conditions are polled at every cycle.
+    """
+    generators = list(generators)
+    passive = set()
+    is_passive = False
+    sleeping = [0]*len(generators)
+    waiting = dict()
+    while generators:
+        exhausted = []
+        for lane, generator in enumerate(generators):
+            if generator is None:
+                continue
+            if sleeping[lane]:
+                sleeping[lane] -= 1
+                continue
+            if lane in waiting:
+                command, value = waiting[lane]
+                new_value = _lane_value((yield command.expr), lane) & _mask(command.expr)
+                if isinstance(command, WaitUntil):
+                    done = new_value
+                else:
+                    done = new_value != value
+                if not done:
+                    continue
+                del waiting[lane]
+            reply = None
+            while True:
+                try:
+                    request = generator.send(reply)
+                except StopIteration:
+                    exhausted.append(lane)
+                    break
+                reply = None
+                if request is None:
+                    break
+                elif isinstance(request, str):
+                    if request == "passive":
+                        passive.add(lane)
+                    elif request == "active":
+                        passive.discard(lane)
+                    else:
+                        raise ValueError("Unknown simulator command: '{}'"
+                                         .format(request))
+                elif isinstance(request, Sleep):
+                    if request.cycles > 0:
+                        sleeping[lane] = request.cycles - 1
+                        break
+                elif isinstance(request, (WaitUntil, WaitChange)):
+                    value = _lane_value((yield request.expr), lane) & _mask(request.expr)
+                    if not (isinstance(request, WaitUntil) and value):
+                        waiting[lane] = request, value
+                        break
+                elif isinstance(request, _ClockCommand):
+                    # clocks are shared by all lanes
+                    yield request
+                else:
+                    reply = yield _lane_request(request, lane)
+                    reply = _lane_reply(reply, lane)
+        for lane in exhausted:
+            generators[lane] = None
+            passive.discard(lane)
+        running = [lane for lane, g in enumerate(generators) if g is not None]
+        if not running:
+            break
+        if is_passive != passive.issuperset(running):
+            is_passive = not is_passive
+            yield "passive" if is_passive else "active"
+        yield
+
+
+def _lane_request(request, lane):
+    if isinstance(request, list):
+        return [_lane_request(e, lane) for e in request]
+    elif isinstance(request, _Statement):
+        return _LaneStatement(request, lane)
+    else:
+        return request
+
+
+def _lane_value(value, lane):
+    if numpy.ndim(value):
+        value = value[lane]
+    return int(value)
+
+
+def _lane_reply(reply, lane):
+    if isinstance(reply, list):
+        return [_lane_reply(e, lane) for e in reply]
+    elif reply is None:
+        return None
+    else:
+        return _lane_value(reply, lane)
+
+
+class _WidthVisitor(NodeVisitor):
+    def __init__(self):
+        self.max_width = 1
+
+    def visit(self, node):
+        if isinstance(node, _Value) and not isinstance(node, (ClockSignal, ResetSignal)):
+            self.max_width = max(self.max_width, value_bits_sign(node)[0])
+        NodeVisitor.visit(self, node)
+
+
+def lane_dtype(fragment):
+    """Choose the NumPy type able to hold all values of a fragment
+
+    Designs whose expressions all fit in 62 bits use native 64-bit
+    integers. Wider designs fall back on arrays of Python integers.
+    """
+    visitor = _WidthVisitor()
+    visitor.visit(fragment)
+    if visitor.max_width <= 62:
+        return numpy.int64
+    else:
+        return object
+
+
+class BatchEvaluator(Evaluator):
+    """Evaluate statements lane-wise
+
+    Signal values are arrays with one element per lane. Conditional
+    statements are executed with a mask selecting the lanes in which
+    the condition holds. Memory contents are two-dimensional arrays
+    indexed by address and lane; pending memory writes are lists of
+    (addresses, lanes, values) arrays.
+    """
+    def __init__(self, clock_domains, memories, lanes, dtype):
+        self.lanes = lanes
+        self.dtype = dtype
+        self._lane_masks = dict()
+        self._all_lanes = numpy.arange(lanes)
+        Evaluator.__init__(self, clock_domains, memories)
+        self.signal_values = dict()
+        self.modifications = dict()
+        self.memory_modifications = {memory: [] for memory in memories}
+
+    def _memory_storage(self, memory):
+        storage = numpy.zeros((memory.depth, self.lanes), dtype=self.dtype)
+        if memory.init:
+            storage[:len(memory.init)] = numpy.array(
+                memory.init, dtype=self.dtype)[:, numpy.newaxis]
+        return storage
+
+    def _full(self, value):
+        return numpy.broadcast_to(numpy.asarray(value, dtype=self.dtype),
+                                  (self.lanes,))
+
+    def commit(self):
+        r = set()
+        for k, v in self.modifications.items():
+            if (k not in self.signal_values
+                    or not numpy.array_equal(self.signal_values[k], v)):
+                self.signal_values[k] = v
+                r.add(k)
+        self.modifications.clear()
+        for memory, modifications in self.memory_modifications.items():
+            storage = self.memories[memory]
+            for addresses, lanes, values in modifications:
+                addresses = addresses[lanes]
+                lane_numbers = self._all_lanes[lanes]
+                values = values[lanes]
+                if (storage[addresses, lane_numbers] != values).any():
+                    storage[addresses, lane_numbers] = values
+                    r.add(memory)
+            del modifications[:]
+        return r
+
+    def _memory_address(self, node, postcommit=False):
+        addresses = self._full(self.eval(node.index, postcommit))
+        return numpy.minimum(node.memory.depth - 1, addresses).astype(numpy.intp)
+
+    def _index_lanes(self, index):
+        # Group lanes by index value, so that each selected choice is
+        # evaluated only once.
+        index = self._full(index)
+        for i in numpy.unique(index):
+            yield int(i), index == i
+
+    def eval(self, node, postcommit=False):
+        if isinstance(node, Constant):
+            return node.value
+        elif isinstance(node, Signal):
+            if postcommit:
+                try:
+                    return self.modifications[node]
+                except KeyError:
+                    pass
+            try:
+                return self.signal_values[node]
+            except KeyError:
+                return self._full(node.reset.value)
+        elif isinstance(node, Lanes):
+            return self._full(node.values)
+        elif isinstance(node, _Operator):
+            operands = [self.eval(o, postcommit) for o in node.operands]
+            if node.op == "-":
+                if len(operands) == 1:
+                    return -self._full(operands[0])
+                else:
+                    return operands[0] - operands[1]
+            elif node.op == "m":
+                return numpy.where(self._full(operands[0]) != 0,
+                                   self._full(operands[1]),
+                                   self._full(operands[2]))
+            elif node.op in (">>>", "<<<") and self.dtype is not object:
+                # shifting 64-bit integers by 64 or more is undefined
+                amount = numpy.minimum(operands[1], 63)
+                return str2op[node.op](operands[0], amount)
+            else:
+                r = str2op[node.op](*operands)
+                if node.op in ("<", "<=", "==", "!=", ">", ">="):
+                    r = numpy.asarray(r).astype(self.dtype)
+                return r
+        elif isinstance(node, _Slice):
+            v = self.eval(node.value, postcommit)
+            return (v >> node.start) & ((1 << (node.stop - node.start)) - 1)
+        elif isinstance(node, _Part):
+            v = self.eval(node.value, postcommit)
+            offset = self.eval(node.offset, postcommit)
+            return (v >> offset) & ((1 << node.width) - 1)
+        elif isinstance(node, Cat):
+            shift = 0
+            r = 0
+            for element in node.l:
+                mask = _mask(element)
+                r = r | ((self.eval(element, postcommit) & mask) << shift)
+                shift += mask.bit_length()
+            return r
+        elif isinstance(node, Replicate):
+            v = self.eval(node.v, postcommit) & _mask(node.v)
+            return v*_replicate_factor(node)
+        elif isinstance(node, _MemoryLocation):
+            addresses = self._memory_address(node, postcommit)
+            r = self.memories[node.memory][addresses, self._all_lanes]
+            if postcommit:
+                for w_addresses, w_lanes, w_values in self.memory_modifications[node.memory]:
+                    r = numpy.where(w_lanes & (w_addresses == addresses), w_values, r)
+            return r
+        elif isinstance(node, _ArrayProxy):
+            choices = node.choices
+            index = numpy.minimum(len(choices) - 1,
+                                  self.eval(node.key, postcommit))
+            r = numpy.zeros(self.lanes, dtype=self.dtype)
+            for i, lanes in self._index_lanes(index):
+                r = numpy.where(lanes, self.eval(choices[i], postcommit), r)
+            return r
+        elif isinstance(node, (ClockSignal, ResetSignal)):
+            return Evaluator.eval(self, node, postcommit)
+        else:
+            raise NotImplementedError(node)
+
+    def _truncate(self, value, nbits, signed):
+        value = self._full(value) & ((1 << nbits) - 1)
+        if signed:
+            half = 1 << (nbits - 1)
+            value = ((value + half) & ((1 << nbits) - 1)) - half
+        return value
+
+    def assign(self, node, value, mask=None):
+        if isinstance(node, Signal):
+            assert not node.variable
+            value = self._truncate(value, node.nbits, node.signed)
+            if mask is not None:
+                value = numpy.where(mask, value, self.eval(node, True))
+            self.modifications[node] = value
+        elif isinstance(node, Cat):
+            for element in node.l:
+                element_mask = _mask(element)
+                self.assign(element, value & element_mask, mask)
+                value = value >> element_mask.bit_length()
+        elif isinstance(node, (_Slice, _Part)):
+            full_value = self.eval(node.value, True)
+            if isinstance(node, _Slice):
+                start = node.start
+                width = node.stop - node.start
+            else:
+                start = self.eval(node.offset, True)
+                width = node.width
+            clear = ((1 << width) - 1) << start
+            full_value = (full_value & ~clear) | ((value & ((1 << width) - 1)) << start)
+            self.assign(node.value, full_value, mask)
+        elif isinstance(node, _MemoryLocation):
+            if mask is None:
+                mask = numpy.ones(self.lanes, dtype=bool)
+            value = self._truncate(value, node.memory.width, False)
+            self.memory_modifications[node.memory].append(
+                (self._memory_address(node), mask, value))
+        elif isinstance(node, _ArrayProxy):
+            choices = node.choices
+            index = numpy.minimum(len(choices) - 1, self.eval(node.key))
+            for i, lanes in self._index_lanes(index):
+                if mask is not None:
+                    lanes &= mask
+                if lanes.any():
+                    self.assign(choices[i], value, lanes)
+        else:
+            raise NotImplementedError(node)
+
+    def _lane_mask(self, lane):
+        try:
+            return self._lane_masks[lane]
+        except KeyError:
+            if not 0 <= lane < self.lanes:
+                raise ValueError("No lane {} in a batch of {}".format(lane, self.lanes))
+            mask = numpy.zeros(self.lanes, dtype=bool)
+            mask[lane] = True
+            self._lane_masks[lane] = mask
+            return mask
+
+    def execute(self, statements, mask=None):
+        for s in statements:
+            if isinstance(s, _Assign):
+                self.assign(s.l, self.eval(s.r), mask)
+            elif isinstance(s, If):
+                cond = self._full(self.eval(s.cond) & _mask(s.cond)) != 0
+                if mask is not None:
+                    taken = cond & mask
+                    not_taken = ~cond & mask
+                else:
+                    taken = cond
+                    not_taken = ~cond
+                if taken.all():
+                    self.execute(s.t, mask)
+                elif taken.any():
+                    self.execute(s.t, taken)
+                if not_taken.all():
+                    self.execute(s.f, mask)
+                elif not_taken.any():
+                    self.execute(s.f, not_taken)
+            elif isinstance(s, Case):
+                nbits, signed = value_bits_sign(s.test)
+                test = self._truncate(self.eval(s.test), nbits, signed)
+                if mask is None:
+                    remaining = numpy.ones(self.lanes, dtype=bool)
+                else:
+                    remaining = mask.copy()
+                for k, v in s.cases.items():
+                    if isinstance(k, Constant):
+                        lanes = remaining & (test == k.value)
+                        if lanes.any():
+                            self.execute(v, lanes)
+                            remaining &= ~lanes
+                if "default" in s.cases and remaining.any():
+                    self.execute(s.cases["default"], remaining)
+            elif isinstance(s, _LaneStatement):
+                lane_mask = self._lane_mask(s.lane)
+                if mask is not None:
+                    lane_mask = lane_mask & mask
+                self.execute([s.statement], lane_mask)
+            elif isinstance(s, collections.abc.Iterable):
+                self.execute(s, mask)
+            elif isinstance(s, Display):
+                args = [self._full(self.eval(arg)) for arg in s.args]
+                for lane in range(self.lanes):
+                    if mask is None or mask[lane]:
+                        print("[{}] ".format(lane) +
+                              s.s % tuple(int(arg[lane]) for arg in args))
+            else:
+                raise NotImplementedError
+
+
+class LaneVCDWriter:
+    """Trace a single lane of a batch simulation"""
+    def __init__(self, vcd, lane):
+        self.vcd = vcd
+        self.lane = lane
+
+    def set(self, signal, value):
+        self.vcd.set(signal, _lane_value(value, self.lane))
+
+    def delay(self, delay):
+        self.vcd.delay(delay)
+
+    def set_time(self, t):
+        self.vcd.set_time(t)
+
+    def dump_off(self):
+        self.vcd.dump_off()
+
+    def dump_on(self):
+        self.vcd.dump_on()
+
+    def close(self):
+        self.vcd.close()
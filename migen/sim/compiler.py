@@ -0,0 +1,457 @@
+import collections.abc
+from itertools import count
+
+from migen.fhdl.structure import *
+from migen.fhdl.structure import (_Operator, _Slice, _Part, _ArrayProxy,
+                                  _MemoryLocation, _Assign)
+from migen.fhdl.bitcontainer import value_bits_sign
+
+
+__all__ = ["StatementCompiler"]
+
+
+_binary_ops = {
+    "+": "+",
+    "-": "-",
+    "*": "*",
+
+    ">>>": ">>",
+    "<<<": "<<",
+
+    "&": "&",
+    "^": "^",
+    "|": "|",
+
+    "<": "<",
+    "<=": "<=",
+    "==": "==",
+    "!=": "!=",
+    ">": ">",
+    ">=": ">=",
+}
+
+# Python's parser refuses deeply nested expressions (e.g. long adder chains),
+# so subexpressions beyond this depth are spilled into temporaries.
+_MAX_EXPR_DEPTH = 32
+
+# Case statements with more choices than this are dispatched through a dict
+# instead of an if/elif chain.
+_MAX_CASE_CHAIN = 8
+
+
+def _mask(nbits):
+    return (1 << nbits) - 1
+
+
+def _literal(value):
+    if value < 0:
+        return "(" + str(value) + ")"
+    else:
+        return str(value)
+
+
+class StatementCompiler:
+    """Compile FHDL statements into Python functions for the simulator.
+
+    Each call to :meth:`compile` returns a function taking the ``values``,
+    ``next_values`` and ``dirty.append`` of an ``Evaluator`` and producing
+    the same effect as ``Evaluator.execute`` on the statements. The tree is
+    walked only once, when the function is generated, and signals are
+    accessed by their position in the value lists.
+
+    Parameters
+    ----------
+    clock_domains : list of ClockDomain
+        Used to resolve ``ClockSignal`` and ``ResetSignal``.
+    memories : dict
+        Mapping from ``Memory`` to the sequence holding its contents.
+    memory_modifications : dict
+        Mapping from ``Memory`` to the dictionary of its pending writes.
+    signal_index : function
+        Returns the position of the value of a signal.
+    """
+    def __init__(self, clock_domains, memories, memory_modifications,
+                 signal_index):
+        self.clock_domains = clock_domains
+        self.memories = memories
+        self.memory_modifications = memory_modifications
+        self.signal_index = signal_index
+
+        self._namespace = dict()
+        self._names = dict()
+        self._uid = count()
+        self._helpers = []
+        self._tables = []
+        self._lines = None
+        self._pending = None
+
+    def _new_name(self, prefix):
+        return "{}{}".format(prefix, next(self._uid))
+
+    def _bind(self, obj, prefix):
+        try:
+            return self._names[id(obj)]
+        except KeyError:
+            name = self._new_name(prefix)
+            self._names[id(obj)] = name
+            self._namespace[name] = obj
+            return name
+
+    def _signal(self, signal):
+        return str(self.signal_index(signal))
+
+    def _function_table(self, functions):
+        # Function tables refer to helpers of the current compilation unit
+        # and are therefore emitted as source rather than bound.
+        name = self._new_name("a")
+        self._tables.append("{} = ({})".format(
+            name, "".join(f + ", " for f in functions)))
+        return name
+
+    def _spill(self, code):
+        name = self._new_name("t")
+        self._pending.append("{} = {}".format(name, code))
+        return name
+
+    # Expressions are returned as (code, nesting depth) pairs.
+
+    def _expr(self, node, postcommit=False):
+        if isinstance(node, Constant):
+            return _literal(node.value), 0
+        elif isinstance(node, Signal):
+            if postcommit:
+                return "nv[" + self._signal(node) + "]", 1
+            else:
+                return "sv[" + self._signal(node) + "]", 1
+        elif isinstance(node, _Operator):
+            operands = [self._expr(o, postcommit) for o in node.operands]
+            depth = max(d for c, d in operands) + 1
+            operands = [c for c, d in operands]
+            if len(operands) == 1:
+                code = "(" + node.op + operands[0] + ")"
+            elif node.op == "m":
+                code = "({} if {} else {})".format(operands[1], operands[0],
+                                                   operands[2])
+            else:
+                code = "({} {} {})".format(operands[0], _binary_ops[node.op],
+                                           operands[1])
+        elif isinstance(node, (_Slice, _Part)):
+            value, depth = self._expr(node.value, postcommit)
+            if isinstance(node, _Slice):
+                start = str(node.start)
+                width = node.stop - node.start
+            else:
+                start, d = self._expr(node.offset, postcommit)
+                depth = max(depth, d)
+                width = node.width
+            if start == "0":
+                code = "({} & {})".format(value, _mask(width))
+            else:
+                code = "(({} >> {}) & {})".format(value, start, _mask(width))
+            depth += 2
+        elif isinstance(node, Cat):
+            shift = 0
+            elements = []
+            depth = 0
+            for element in node.l:
+                nbits = len(element)
+                code, d = self._expr(element, postcommit)
+                depth = max(depth, d)
+                code = "({} & {})".format(code, _mask(nbits))
+                if shift:
+                    code = "({} << {})".format(code, shift)
+                elements.append(code)
+                shift += nbits
+            if not elements:
+                return "0", 0
+            code = "(" + " | ".join(elements) + ")"
+            depth += 3
+        elif isinstance(node, Replicate):
+            nbits = len(node.v)
+            if not node.n:
+                return "0", 0
+            value, depth = self._expr(node.v, postcommit)
+            factor = sum(1 << i*nbits for i in range(node.n))
+            code = "(({} & {}) * {})".format(value, _mask(nbits), factor)
+            depth += 2
+        elif isinstance(node, _MemoryLocation):
+            address, depth = self._address(node)
+            storage = self._bind(self.memories[node.memory], "m")
+            if postcommit:
+                address = self._spill(address)
+                code = "{}.get({}, {}[{}])".format(
+                    self._bind(self.memory_modifications[node.memory], "w"),
+                    address, storage, address)
+            else:
+                code = "{}[{}]".format(storage, address)
+            depth += 1
+        elif isinstance(node, _ArrayProxy):
+            index, depth = self._index(node)
+            table = self._signal_table(node)
+            if table is not None:
+                code = "{}[{}[{}]]".format("nv" if postcommit else "sv",
+                                           table, index)
+            else:
+                table = self._function_table(
+                    self._helper(self._emit_return, choice, postcommit)
+                    for choice in node.choices)
+                code = "{}[{}](sv, nv, d)".format(table, index)
+            depth += 2
+        elif isinstance(node, ClockSignal):
+            return self._expr(self.clock_domains[node.cd].clk, postcommit)
+        elif isinstance(node, ResetSignal):
+            rst = self.clock_domains[node.cd].rst
+            if rst is None:
+                if node.allow_reset_less:
+                    return "0", 0
+                else:
+                    raise ValueError("Attempted to get reset signal of resetless"
+                                     " domain '{}'".format(node.cd))
+            return self._expr(rst, postcommit)
+        else:
+            raise NotImplementedError(node)
+
+        if depth > _MAX_EXPR_DEPTH:
+            return self._spill(code), 0
+        return code, depth
+
+    def _signal_table(self, node):
+        # Arrays whose entries are all signals of the same shape are
+        # compiled into a table lookup.
+        # Returns the name of the bound table, or None.
+        choices = node.choices
+        try:
+            return self._names[id(choices)]
+        except KeyError:
+            pass
+        if not choices or not all(isinstance(c, Signal) for c in choices):
+            return None
+        shape = (choices[0].nbits, choices[0].signed)
+        if any((c.nbits, c.signed) != shape or c.variable for c in choices):
+            return None
+        name = self._bind(tuple(self.signal_index(c) for c in choices), "a")
+        # choices is kept alive by the fragment, so its id is not reused
+        self._names[id(choices)] = name
+        return name
+
+    def _index(self, node):
+        key, depth = self._expr(node.key)
+        return "min({}, {})".format(len(node.choices) - 1, key), depth + 1
+
+    def _address(self, node):
+        # out of range addresses select the last word, as with Array
+        address, depth = self._expr(node.index)
+        nbits, signed = value_bits_sign(node.index)
+        if signed or 2**nbits > node.memory.depth:
+            address = "min({}, {})".format(node.memory.depth - 1, address)
+            depth += 1
+        return address, depth
+
+    def _truncate(self, code, nbits, signed):
+        if signed:
+            half = 1 << (nbits - 1)
+            return "((({} + {}) & {}) - {})".format(code, half, _mask(nbits), half)
+        else:
+            return "({} & {})".format(code, _mask(nbits))
+
+    # Statements
+
+    def _emit(self, level, line):
+        for pending in self._pending:
+            self._lines.append("    "*level + pending)
+        del self._pending[:]
+        self._lines.append("    "*level + line)
+
+    def _emit_return(self, level, node, postcommit):
+        code, depth = self._expr(node, postcommit)
+        self._emit(level, "return " + code)
+
+    def _helper(self, emitter, *args):
+        # Compile a piece of code into a separate function taking
+        # (sv, nv, d[, value]) and return its name.
+        name = self._new_name("f")
+        outer_lines, outer_pending = self._lines, self._pending
+        self._lines, self._pending = [], []
+        if emitter == self._emit_assign_value:
+            self._lines.append("def {}(sv, nv, d, value):".format(name))
+        else:
+            self._lines.append("def {}(sv, nv, d):".format(name))
+        start = len(self._lines)
+        emitter(1, *args)
+        if len(self._lines) == start:
+            self._lines.append("    pass")
+        self._helpers.append(self._lines)
+        self._lines, self._pending = outer_lines, outer_pending
+        return name
+
+    def _emit_assign_value(self, level, node):
+        self._emit_assign(level, node, "value")
+
+    def _emit_assign(self, level, node, value):
+        if isinstance(node, Signal):
+            assert not node.variable
+            s = self._signal(node)
+            self._emit(level, "nv[{}] = {}".format(
+                s, self._truncate(value, node.nbits, node.signed)))
+            self._emit(level, "d({})".format(s))
+        elif isinstance(node, Cat):
+            if not value.isidentifier():
+                tmp = self._new_name("t")
+                self._emit(level, "{} = {}".format(tmp, value))
+                value = tmp
+            shift = 0
+            for element in node.l:
+                if shift:
+                    element_value = "({} >> {})".format(value, shift)
+                else:
+                    element_value = value
+                self._emit_assign(level, element, element_value)
+                shift += len(element)
+        elif isinstance(node, (_Slice, _Part)):
+            full_value, depth = self._expr(node.value, True)
+            if isinstance(node, _Slice):
+                start = node.start
+                mask = _mask(node.stop - node.start)
+                code = "({} & {}) | (({} & {}) << {})".format(
+                    full_value, _literal(~(mask << start)), value, mask, start)
+            else:
+                offset, depth = self._expr(node.offset, True)
+                mask = _mask(node.width)
+                offset = self._spill(offset)
+                code = "({} & ~({} << {})) | (({} & {}) << {})".format(
+                    full_value, mask, offset, value, mask, offset)
+            tmp = self._new_name("t")
+            self._emit(level, "{} = {}".format(tmp, code))
+            self._emit_assign(level, node.value, tmp)
+        elif isinstance(node, _MemoryLocation):
+            address, depth = self._address(node)
+            self._emit(level, "{}[{}] = {} & {}".format(
+                self._bind(self.memory_modifications[node.memory], "w"),
+                address, value, _mask(node.memory.width)))
+        elif isinstance(node, _ArrayProxy):
+            index, depth = self._index(node)
+            table = self._signal_table(node)
+            if table is not None:
+                shape = node.choices[0]
+                s = self._spill("{}[{}]".format(table, index))
+                self._emit(level, "nv[{}] = {}".format(
+                    s, self._truncate(value, shape.nbits, shape.signed)))
+                self._emit(level, "d({})".format(s))
+            else:
+                table = self._function_table(
+                    self._helper(self._emit_assign_value, choice)
+                    for choice in node.choices)
+                self._emit(level, "{}[{}](sv, nv, d, {})".format(table, index, value))
+        else:
+            raise NotImplementedError(node)
+
+    def _emit_block(self, level, statements):
+        start = len(self._lines)
+        self._emit_statements(level, statements)
+        if len(self._lines) == start:
+            self._lines.append("    "*level + "pass")
+
+    def _emit_if(self, level, node, keyword="if"):
+        cond, depth = self._expr(node.cond)
+        if keyword == "elif" and self._pending:
+            # temporaries must be evaluated before the test
+            self._lines.append("    "*level + "else:")
+            level += 1
+            keyword = "if"
+        self._emit(level, "{} {} & {}:".format(keyword, cond, _mask(len(node.cond))))
+        self._emit_block(level + 1, node.t)
+        if len(node.f) == 1 and isinstance(node.f[0], If):
+            self._emit_if(level, node.f[0], "elif")
+        elif node.f:
+            self._emit(level, "else:")
+            self._emit_block(level + 1, node.f)
+
+    def _emit_case(self, level, node):
+        nbits, signed = value_bits_sign(node.test)
+        test, depth = self._expr(node.test)
+        test = self._spill(self._truncate(test, nbits, signed))
+        choices = []
+        seen = set()
+        for k, v in node.cases.items():
+            if isinstance(k, Constant) and k.value not in seen:
+                seen.add(k.value)
+                choices.append((k.value, v))
+        default = node.cases.get("default")
+        if len(choices) > _MAX_CASE_CHAIN:
+            dispatch = self._new_name("c")
+            self._tables.append("{} = {{{}}}".format(dispatch, "".join(
+                "{}: {}, ".format(value, self._helper(self._emit_block, statements))
+                for value, statements in choices)))
+            default = self._helper(self._emit_block, default or [])
+            self._emit(level, "{}.get({}, {})(sv, nv, d)".format(
+                dispatch, test, default))
+        else:
+            keyword = "if"
+            for value, statements in choices:
+                self._emit(level, "{} {} == {}:".format(keyword, test, _literal(value)))
+                self._emit_block(level + 1, statements)
+                keyword = "elif"
+            if default is not None:
+                if choices:
+                    self._emit(level, "else:")
+                    self._emit_block(level + 1, default)
+                else:
+                    self._emit_statements(level, default)
+
+    def _emit_statements(self, level, statements):
+        for s in statements:
+            if isinstance(s, _Assign):
+                value, depth = self._expr(s.r)
+                self._emit_assign(level, s.l, value)
+            elif isinstance(s, If):
+                self._emit_if(level, s)
+            elif isinstance(s, Case):
+                self._emit_case(level, s)
+            elif isinstance(s, collections.abc.Iterable):
+                self._emit_statements(level, s)
+            elif isinstance(s, Display):
+                args = [self._expr(arg)[0] for arg in s.args]
+                self._emit(level, "print({} % ({}))".format(
+                    self._bind(s.s, "d"), "".join(a + ", " for a in args)))
+            else:
+                raise NotImplementedError(s)
+
+    def compile(self, statements):
+        """Compile a list of statements.
+
+        Returns
+        -------
+        function
+            Function taking ``(values, next_values, dirty_append)`` that
+            executes the statements.
+        """
+        return self.compile_list([statements])[0]
+
+    def compile_list(self, statement_lists):
+        """Compile several lists of statements at once.
+
+        This is equivalent to calling :meth:`compile` on each list, but
+        only invokes the Python compiler once.
+
+        Returns
+        -------
+        list of functions
+        """
+        names = []
+        self._helpers, self._tables = [], []
+        self._pending = []
+        for statements in statement_lists:
+            names.append(self._new_name("run"))
+            self._lines = ["def {}(sv, nv, d):".format(names[-1])]
+            self._emit_block(1, statements)
+            self._helpers.append(self._lines)
+            del self._pending[:]
+
+        source = "".join(line + "\n" for helper in self._helpers for line in helper)
+        source += "".join(line + "\n" for line in self._tables)
+        self._helpers, self._tables = [], []
+        self._lines = self._pending = None
+
+        namespace = dict(self._namespace)
+        exec(compile(source, "<migen-sim>", "exec"), namespace)
+        return [namespace[name] for name in names]
@@ -1,32 +1,72 @@
 import operator
 import collections.abc
 import inspect
-from functools import wraps
+import heapq
+import hashlib
+import pickle
+import time
+import bisect
+import array
+from fnmatch import fnmatchcase
+from functools import wraps, partial
 
 from migen.fhdl.structure import *
 from migen.fhdl.structure import (_Value, _Statement,
                                   _Operator, _Slice, _Part, _ArrayProxy,
-                                  _Assign, _Fragment)
+                                  _MemoryLocation, _Assign, _Fragment)
 from migen.fhdl.bitcontainer import value_bits_sign
-from migen.fhdl.tools import (list_targets, list_signals,
-                              insert_resets, lower_specials)
-from migen.fhdl.simplify import MemoryToArray
-from migen.fhdl.specials import _MemoryLocation
+from migen.fhdl.tools import (list_targets, list_signals, list_inputs,
+                              list_clock_domains_expr, group_by_targets,
+                              generate_reset, insert_resets, lower_specials)
+from migen.fhdl.simplify import MemoryToLocations
+from migen.fhdl.specials import Memory, Instance
 from migen.fhdl.module import Module
+from migen.fhdl.visit import NodeVisitor
+from migen.util.misc import gcd_multiple
+from migen.fhdl.namer import build_namespace
 from migen.genlib.resetsync import AsyncResetSynchronizer
-from migen.sim.vcd import VCDWriter, DummyVCDWriter
+from migen.sim.vcd import open_trace, DummyVCDWriter
+from migen.sim.compiler import StatementCompiler
+from migen.sim.profile import Profile, module_path
+from migen.sim.cosim import Cosimulation
 
 
 class ClockState:
-    def __init__(self, high, half_period, time_before_trans):
+    """State of a simulated clock
+
+    ``phase`` is the level the clock would have if it were never gated,
+    and ``next_transition`` the absolute time of its next transition.
+    ``high`` is the actual level of the clock.
+    """
+    def __init__(self, high, half_period, next_transition):
         self.high = high
+        self.phase = high
         self.half_period = half_period
-        self.time_before_trans = time_before_trans
+        self.next_transition = next_transition
+        self.enabled = True
+
+
+# Limit on the length of the precomputed edge pattern
+_MAX_PATTERN_EVENTS = 1 << 16
+# Number of ticks without clock changes before building a new pattern
+_PATTERN_DELAY = 256
 
 
 class TimeManager:
+    """Schedule the edges of the simulated clocks
+
+    While all clocks run freely, the sequence of edges repeats every
+    hyperperiod (the least common multiple of the periods). It is
+    precomputed, so that a tick is a lookup in the pattern. Otherwise,
+    e.g. after a clock was gated or shifted, the next transitions are
+    taken from a heap.
+
+    A gated clock stops after its next falling edge, and restarts at
+    the next rising edge of its original schedule once enabled again.
+    """
     def __init__(self, description):
         self.clocks = collections.OrderedDict()
+        self.now = 0
 
         for k, period_phase in description.items():
             if isinstance(period_phase, tuple):
@@ -42,21 +82,191 @@ class TimeManager:
                 high = False
             self.clocks[k] = ClockState(high, half_period, half_period - phase)
 
+        self._order = {k: n for n, k in enumerate(self.clocks.keys())}
+        self._heap = None
+        self._pattern = None
+        self._stable_ticks = 0
+        self._build_pattern()
+        if self._pattern is None:
+            self._build_heap()
+
+    def _build_heap(self):
+        self._heap = [(cs.next_transition, self._order[k], k)
+                      for k, cs in self.clocks.items()]
+        heapq.heapify(self._heap)
+
+    def _build_pattern(self):
+        self._pattern = None
+        # a clock restarted in its high phase stays low until its next
+        # rising edge, which the pattern cannot represent
+        if not all(cs.enabled and cs.high == cs.phase
+                   for cs in self.clocks.values()):
+            return
+        hyperperiod = 1
+        for cs in self.clocks.values():
+            period = 2*cs.half_period
+            hyperperiod = hyperperiod*period//gcd_multiple([hyperperiod, period])
+        n_events = sum(hyperperiod//cs.half_period for cs in self.clocks.values())
+        if n_events > _MAX_PATTERN_EVENTS:
+            return
+        # each clock transitions at next_transition + m*half_period
+        transitions = collections.defaultdict(lambda: (set(), set()))
+        for k, cs in self.clocks.items():
+            high = cs.phase
+            for t in range(cs.next_transition, self.now + hyperperiod + 1,
+                           cs.half_period):
+                high = not high
+                transitions[t][0 if high else 1].add(k)
+        times = sorted(transitions.keys())
+        self._pattern = [(frozenset(transitions[t][0]),
+                          frozenset(transitions[t][1])) for t in times]
+        self._pattern_times = [t - self.now for t in times]
+        self._pattern_base = self.now
+        self._pattern_pos = 0
+        self._hyperperiod = hyperperiod
+        self._heap = None
+
+    def _modified(self):
+        # the schedule of a clock has changed
+        if self._pattern is not None:
+            self._pattern = None
+            self._build_heap()
+        self._stable_ticks = 0
+
     def tick(self):
-        rising = set()
-        falling = set()
-        dt = min(cs.time_before_trans for cs in self.clocks.values())
+        if self._pattern is not None:
+            rising, falling = self._pattern[self._pattern_pos]
+            t = self._pattern_base + self._pattern_times[self._pattern_pos]
+            self._pattern_pos += 1
+            if self._pattern_pos == len(self._pattern):
+                self._pattern_pos = 0
+                self._pattern_base += self._hyperperiod
+            for k in rising:
+                cs = self.clocks[k]
+                cs.high = cs.phase = True
+                cs.next_transition = t + cs.half_period
+            for k in falling:
+                cs = self.clocks[k]
+                cs.high = cs.phase = False
+                cs.next_transition = t + cs.half_period
+        else:
+            rising = set()
+            falling = set()
+            heap = self._heap
+            t = heap[0][0]
+            while heap and heap[0][0] == t:
+                _, order, k = heapq.heappop(heap)
+                cs = self.clocks[k]
+                if cs.next_transition != t:
+                    continue  # rescheduled
+                cs.phase = not cs.phase
+                high = cs.phase and cs.enabled
+                if high != cs.high:
+                    cs.high = high
+                    if high:
+                        rising.add(k)
+                    else:
+                        falling.add(k)
+                cs.next_transition = t + cs.half_period
+                heapq.heappush(heap, (cs.next_transition, order, k))
+        dt = t - self.now
+        self.now = t
+        if self._pattern is None:
+            self._stable_ticks += 1
+            if self._stable_ticks == _PATTERN_DELAY:
+                self._build_pattern()
+                if self._pattern is None:
+                    self._stable_ticks = 0
+        return dt, rising, falling
+
+    def time_to_rising(self, k, n):
+        """Time until the ``n``-th next rising edge of clock ``k``.
+
+        Returns None if the clock is gated.
+        """
+        cs = self.clocks[k]
+        if not cs.enabled:
+            return None
+        t = cs.next_transition - self.now
+        if cs.phase:
+            t += cs.half_period
+        return t + 2*(n - 1)*cs.half_period
+
+    def advance(self, dt):
+        """Apply all the transitions of the next ``dt`` time units at once.
+
+        Returns the number of rising edges of each clock.
+        """
+        t = self.now + dt
+        rising = dict()
         for k, cs in self.clocks.items():
-            if cs.time_before_trans == dt:
-                cs.high = not cs.high
-                if cs.high:
-                    rising.add(k)
+            rising[k] = 0
+            if t < cs.next_transition:
+                continue
+            n = (t - cs.next_transition)//cs.half_period + 1
+            if cs.enabled:
+                if cs.phase:
+                    rising[k] = n//2
                 else:
-                    falling.add(k)
-            cs.time_before_trans -= dt
-            if not cs.time_before_trans:
-                cs.time_before_trans += cs.half_period
-        return dt, rising, falling
+                    rising[k] = (n + 1)//2
+            if n % 2:
+                cs.phase = not cs.phase
+            cs.high = cs.phase and cs.enabled
+            cs.next_transition += n*cs.half_period
+        self.now = t
+        if self._pattern is not None:
+            offset = t - self._pattern_base
+            self._pattern_base += offset//self._hyperperiod*self._hyperperiod
+            self._pattern_pos = bisect.bisect_right(self._pattern_times,
+                                                    t - self._pattern_base)
+            if self._pattern_pos == len(self._pattern):
+                self._pattern_pos = 0
+                self._pattern_base += self._hyperperiod
+        else:
+            self._build_heap()
+        return rising
+
+    def get_state(self):
+        return self.now, [(cs.high, cs.phase, cs.half_period,
+                           cs.next_transition, cs.enabled)
+                          for cs in self.clocks.values()]
+
+    def set_state(self, state):
+        self.now, clocks = state
+        for cs, (high, phase, half_period, next_transition, enabled) \
+                in zip(self.clocks.values(), clocks):
+            cs.high = high
+            cs.phase = phase
+            cs.half_period = half_period
+            cs.next_transition = next_transition
+            cs.enabled = enabled
+        self._stable_ticks = 0
+        self._build_pattern()
+        if self._pattern is None:
+            self._build_heap()
+
+    def gate(self, k, gated=True):
+        """Stop (or restart) clock ``k``."""
+        self.clocks[k].enabled = not gated
+        self._modified()
+
+    def set_period(self, k, period):
+        """Change the period of clock ``k``, from its next transition."""
+        self.clocks[k].half_period = period//2
+        self._modified()
+
+    def shift(self, k, delay):
+        """Delay the next transition of clock ``k``, e.g. to model jitter.
+
+        ``delay`` can be negative, but the transition cannot be moved to
+        the current time or before.
+        """
+        cs = self.clocks[k]
+        if cs.next_transition + delay <= self.now:
+            raise ValueError("Cannot shift a clock transition into the past")
+        self._modified()
+        cs.next_transition += delay
+        heapq.heappush(self._heap, (cs.next_transition, self._order[k], k))
 
 
 str2op = {
@@ -82,41 +292,116 @@ str2op = {
 
 
 def _truncate(value, nbits, signed):
-    value = value & (2**nbits - 1)
-    if signed and (value & 2**(nbits - 1)):
-        value -= 2**nbits
+    value &= (1 << nbits) - 1
+    if signed and value >> (nbits - 1):
+        value -= 1 << nbits
     return value
 
 
+def _mask(node):
+    return (1 << value_bits_sign(node)[0]) - 1
+
+
+def _replicate_factor(node):
+    # v*factor concatenates node.n copies of v
+    nbits = value_bits_sign(node.v)[0]
+    if not nbits:
+        return 0
+    return ((1 << nbits*node.n) - 1)//((1 << nbits) - 1)
+
+
 class Evaluator:
-    def __init__(self, clock_domains, replaced_memories):
+    """Execute statements on signal values and memory contents
+
+    Signal values are held in lists, at a position assigned to each signal
+    by :meth:`index`: ``values`` holds the current values, and
+    ``next_values`` the values after the next commit. Both only differ at
+    the positions listed in ``dirty``.
+
+    Parameters
+    ----------
+    clock_domains : list of ClockDomain
+    memories : list of Memory
+        Memories whose words are accessed by the statements. Their
+        contents are held in ``memories``, with pending writes in
+        ``memory_modifications``.
+    signals : iterable of Signal
+        Signals to place first in the value lists. Other signals are
+        added when they are first accessed.
+    """
+    def __init__(self, clock_domains, memories, signals=()):
         self.clock_domains = clock_domains
-        self.replaced_memories = replaced_memories
-        self.signal_values = dict()
-        self.modifications = dict()
+        self.signal_index = dict()
+        self.signals = []
+        self.values = []
+        self.next_values = []
+        self.dirty = []
+        for signal in signals:
+            self.index(signal)
+        self.memories = {memory: self._memory_storage(memory)
+                         for memory in memories}
+        self.memory_modifications = {memory: dict() for memory in memories}
+
+    def _memory_storage(self, memory):
+        init = list(memory.init or [])
+        init += [0]*(memory.depth - len(init))
+        for typecode in "BHIQ":
+            if memory.width <= 8*array.array(typecode).itemsize:
+                return array.array(typecode, init)
+        return init
+
+    def index(self, signal):
+        """Position of the value of a signal in the value lists."""
+        try:
+            return self.signal_index[signal]
+        except KeyError:
+            i = len(self.signals)
+            self.signal_index[signal] = i
+            self.signals.append(signal)
+            self.values.append(signal.reset.value)
+            self.next_values.append(signal.reset.value)
+            return i
 
     def commit(self):
+        """Apply the pending modifications.
+
+        Returns
+        -------
+        set
+            The signals whose value changed, and the memories whose
+            contents changed.
+        """
         r = set()
-        for k, v in self.modifications.items():
-            if k not in self.signal_values or self.signal_values[k] != v:
-                self.signal_values[k] = v
-                r.add(k)
-        self.modifications.clear()
+        if self.dirty:
+            values, next_values, signals = self.values, self.next_values, self.signals
+            for i in self.dirty:
+                v = next_values[i]
+                if values[i] != v:
+                    values[i] = v
+                    r.add(signals[i])
+            del self.dirty[:]
+        for memory, modifications in self.memory_modifications.items():
+            if modifications:
+                storage = self.memories[memory]
+                for address, value in modifications.items():
+                    if storage[address] != value:
+                        storage[address] = value
+                        r.add(memory)
+                modifications.clear()
         return r
 
+    def _memory_address(self, node, postcommit=False):
+        # out of range addresses select the last word, as with Array
+        return min(node.memory.depth - 1, self.eval(node.index, postcommit))
+
     def eval(self, node, postcommit=False):
         if isinstance(node, Constant):
             return node.value
         elif isinstance(node, Signal):
             if postcommit:
-                try:
-                    return self.modifications[node]
-                except KeyError:
-                    pass
-            try:
-                return self.signal_values[node]
-            except KeyError:
-                return node.reset.value
+                return self.next_values[self.index(node)]
+            else:
+                return self.values[self.index(node)]
         elif isinstance(node, _Operator):
             operands = [self.eval(o, postcommit) for o in node.operands]
             if node.op == "-":
@@ -130,32 +415,34 @@ class Evaluator:
                 return str2op[node.op](*operands)
         elif isinstance(node, _Slice):
             v = self.eval(node.value, postcommit)
-            idx = range(node.start, node.stop)
-            return sum(((v >> i) & 1) << j for j, i in enumerate(idx))
+            return (v >> node.start) & ((1 << (node.stop - node.start)) - 1)
         elif isinstance(node, _Part):
             v = self.eval(node.value, postcommit)
             offset = self.eval(node.offset, postcommit)
-            idx = range(offset, offset + node.width)
-            return sum(((v >> i) & 1) << j for j, i in enumerate(idx))
+            return (v >> offset) & ((1 << node.width) - 1)
         elif isinstance(node, Cat):
             shift = 0
             r = 0
             for element in node.l:
-                nbits = len(element)
+                mask = _mask(element)
                 # make value always positive
-                r |= (self.eval(element, postcommit) & (2**nbits-1)) << shift
-                shift += nbits
+                r |= (self.eval(element, postcommit) & mask) << shift
+                shift += mask.bit_length()
             return r
         elif isinstance(node, Replicate):
-            nbits = len(node.v)
-            v = self.eval(node.v, postcommit) & (2**nbits - 1)
-            return sum(v << i*nbits for i in range(node.n))
+            v = self.eval(node.v, postcommit) & _mask(node.v)
+            return v*_replicate_factor(node)
         elif isinstance(node, _ArrayProxy):
             idx = min(len(node.choices) - 1, self.eval(node.key, postcommit))
             return self.eval(node.choices[idx], postcommit)
         elif isinstance(node, _MemoryLocation):
-            array = self.replaced_memories[node.memory]
-            return self.eval(array[self.eval(node.index, postcommit)], postcommit)
+            address = self._memory_address(node, postcommit)
+            if postcommit:
+                try:
+                    return self.memory_modifications[node.memory][address]
+                except KeyError:
+                    pass
+            return self.memories[node.memory][address]
         elif isinstance(node, ClockSignal):
             return self.eval(self.clock_domains[node.cd].clk, postcommit)
         elif isinstance(node, ResetSignal):
@@ -174,36 +461,32 @@ class Evaluator:
     def assign(self, node, value):
         if isinstance(node, Signal):
             assert not node.variable
-            self.modifications[node] = _truncate(value,
-                                                 node.nbits, node.signed)
+            i = self.index(node)
+            self.next_values[i] = _truncate(value, node.nbits, node.signed)
+            self.dirty.append(i)
         elif isinstance(node, Cat):
             for element in node.l:
-                nbits = len(element)
-                self.assign(element, value & (2**nbits-1))
-                value >>= nbits
-        elif isinstance(node, _Slice):
-            full_value = self.eval(node.value, True)
-            # clear bits assigned to by the slice
-            full_value &= ~((2**node.stop-1) - (2**node.start-1))
-            # set them to the new value
-            value &= 2**(node.stop - node.start)-1
-            full_value |= value << node.start
-            self.assign(node.value, full_value)
-        elif isinstance(node, _Part):
+                mask = _mask(element)
+                self.assign(element, value & mask)
+                value >>= mask.bit_length()
+        elif isinstance(node, (_Slice, _Part)):
             full_value = self.eval(node.value, True)
-            offset = self.eval(node.offset, True)
-            start = offset
-            stop = offset + node.width
-            full_value &= ~((2**stop-1) - (2**start-1))
-            value &= 2**(stop - start)-1
-            full_value |= value << start
+            if isinstance(node, _Slice):
+                start = node.start
+                mask = (1 << (node.stop - node.start)) - 1
+            else:
+                start = self.eval(node.offset, True)
+                mask = (1 << node.width) - 1
+            # clear bits assigned to by the slice and set them to the new value
+            full_value = (full_value & ~(mask << start)) | ((value & mask) << start)
             self.assign(node.value, full_value)
         elif isinstance(node, _ArrayProxy):
             idx = min(len(node.choices) - 1, self.eval(node.key))
             self.assign(node.choices[idx], value)
         elif isinstance(node, _MemoryLocation):
-            array = self.replaced_memories[node.memory]
-            self.assign(array[self.eval(node.index)], value)
+            address = self._memory_address(node)
+            self.memory_modifications[node.memory][address] = \
+                value & ((1 << node.memory.width) - 1)
         else:
             raise NotImplementedError(node)
 
@@ -212,7 +495,7 @@ class Evaluator:
             if isinstance(s, _Assign):
                 self.assign(s.l, self.eval(s.r))
             elif isinstance(s, If):
-                if self.eval(s.cond) & (2**len(s.cond) - 1):
+                if self.eval(s.cond) & _mask(s.cond):
                     self.execute(s.t)
                 else:
                     self.execute(s.f)
@@ -233,15 +516,234 @@ class Evaluator:
                 args = []
                 for arg in s.args:
                     assert isinstance(arg, _Value)
-                    try:
-                        args.append(self.signal_values[arg])
-                    except: # not yet evaluated
-                        args.append(arg.reset.value)
+                    args.append(self.eval(arg))
                 print(s.s %(*args,))
             else:
                 raise NotImplementedError
 
 
+class CombinationalLoopError(Exception):
+    """Raised when a combinatorial loop does not settle
+
+    Parameters
+    ----------
+    signals : list of str
+        Names of the signals forming the loop.
+    """
+    def __init__(self, signals):
+        Exception.__init__(self, "Combinatorial loop does not settle: " +
+                           ", ".join(signals))
+        self.signals = signals
+
+
+# Number of times a combinatorial loop is iterated before it is considered
+# not to settle.
+_MAX_COMB_ITERATIONS = 1000
+
+
+def _strongly_connected_components(graph):
+    # Tarjan's algorithm, iterative. graph[n] is the set of successors of n.
+    # Components are returned in topological order.
+    index = dict()
+    lowlink = dict()
+    stack = []
+    on_stack = set()
+    components = []
+    for root in range(len(graph)):
+        if root in index:
+            continue
+        work = [(root, iter(graph[root]))]
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        while work:
+            node, successors = work[-1]
+            for successor in successors:
+                if successor not in index:
+                    index[successor] = lowlink[successor] = len(index)
+                    stack.append(successor)
+                    on_stack.add(successor)
+                    work.append((successor, iter(graph[successor])))
+                    break
+                elif successor in on_stack:
+                    lowlink[node] = min(lowlink[node], index[successor])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        n = stack.pop()
+                        on_stack.discard(n)
+                        component.append(n)
+                        if n == node:
+                            break
+                    components.append(component)
+    components.reverse()
+    return components
+
+
+class _MemoryLister(NodeVisitor):
+    def __init__(self):
+        self.output_list = set()
+
+    def visit_MemoryLocation(self, node):
+        self.output_list.add(node.memory)
+        self.visit(node.index)
+
+
+def _list_memories(node):
+    lister = _MemoryLister()
+    lister.visit(node)
+    return lister.output_list
+
+
+def _list_always_assigned(statements):
+    # signals assigned as a whole on every path through the statements
+    r = set()
+    for s in statements:
+        if isinstance(s, _Assign):
+            if isinstance(s.l, Signal):
+                r.add(s.l)
+            elif isinstance(s.l, Cat):
+                r |= {e for e in s.l.l if isinstance(e, Signal)}
+        elif isinstance(s, If):
+            r |= _list_always_assigned(s.t) & _list_always_assigned(s.f)
+        elif isinstance(s, Case):
+            if "default" in s.cases:
+                r |= set.intersection(*[_list_always_assigned(v)
+                                        for v in s.cases.values()])
+        elif isinstance(s, collections.abc.Iterable):
+            r |= _list_always_assigned(s)
+    return r
+
+
+class _SideEffectFinder(NodeVisitor):
+    # memory writes and Display statements
+    def __init__(self):
+        self.found = False
+
+    def visit_Assign(self, node):
+        if _list_memories(node.l):
+            self.found = True
+
+    def visit_unknown(self, node):
+        if isinstance(node, Display):
+            self.found = True
+
+
+def _reset_overrides_all(statements):
+    # whether the reset of a domain overrides all the effects of its
+    # synchronous statements
+    if any(target.reset_less for target in list_targets(statements)):
+        return False
+    finder = _SideEffectFinder()
+    finder.visit(statements)
+    return not finder.found
+
+
+def _list_module_signals(modules):
+    signals = set()
+    for module in modules:
+        # the fragment of a finalized submodule holds its own statements
+        # and those of its submodules
+        module.finalize()
+        fragment = module._fragment
+        signals |= list_signals(fragment)
+        for special in fragment.specials:
+            for obj, attr, direction in special.iter_expressions():
+                signals |= list_signals(getattr(obj, attr))
+    return signals
+
+
+def _trace_selected(name, include, exclude):
+    if include is not None and not any(fnmatchcase(name, pattern)
+                                       for pattern in include):
+        return False
+    if exclude is not None and any(fnmatchcase(name, pattern)
+                                   for pattern in exclude):
+        return False
+    return True
+
+
+class Sleep:
+    """Generator command: wait for a number of clock cycles
+
+    ``yield Sleep(n)`` is equivalent to ``n`` plain ``yield`` statements,
+    but the generator is not resumed in between.
+    """
+    def __init__(self, cycles):
+        self.cycles = cycles
+
+
+class WaitUntil:
+    """Generator command: wait until an expression is true
+
+    ``yield WaitUntil(expr)`` is equivalent to
+    ``while not (yield expr): yield``. The expression is only evaluated
+    again when one of the signals it reads changes.
+    """
+    def __init__(self, expr):
+        self.expr = wrap(expr)
+
+
+class WaitChange:
+    """Generator command: wait until the value of an expression changes
+
+    The generator resumes at the first clock cycle where the expression
+    has a different value than when the command was issued.
+    """
+    def __init__(self, expr):
+        self.expr = wrap(expr)
+
+
+class _ClockCommand:
+    pass
+
+
+class GateClock(_ClockCommand):
+    """Generator command: stop or restart a clock
+
+    A stopped clock stays low, from its next falling edge on. When it
+    is restarted, its edges follow the original schedule again.
+    """
+    def __init__(self, domain, gated=True):
+        self.domain = domain
+        self.gated = gated
+
+    def apply(self, time_manager):
+        time_manager.gate(self.domain, self.gated)
+
+
+class SetClockPeriod(_ClockCommand):
+    """Generator command: change the period of a clock
+
+    The new period applies after the next transition of the clock.
+    """
+    def __init__(self, domain, period):
+        self.domain = domain
+        self.period = period
+
+    def apply(self, time_manager):
+        time_manager.set_period(self.domain, self.period)
+
+
+class ShiftClock(_ClockCommand):
+    """Generator command: delay the next transition of a clock
+
+    Injects phase jitter. The following transitions keep the period of
+    the clock, relative to the shifted one. ``delay`` can be negative.
+    """
+    def __init__(self, domain, delay):
+        self.domain = domain
+        self.delay = delay
+
+    def apply(self, time_manager):
+        time_manager.shift(self.domain, self.delay)
+
+
 class DummyAsyncResetSynchronizerImpl(Module):
     def __init__(self, cd, async_reset):
         # TODO: asynchronous set
@@ -256,34 +758,116 @@ class DummyAsyncResetSynchronizer:
         return DummyAsyncResetSynchronizerImpl(dr.cd, dr.async_reset)
 
 
-# TODO: instances via Iverilog/VPI
 class Simulator:
+    """Simulate a fragment or module together with testbench generators.
+
+    Parameters
+    ----------
+    engine : str
+        ``"compiled"`` (default) translates the statements of the fragment
+        into Python functions once, at construction. ``"interpreted"`` walks
+        the statement trees at every evaluation, which is slower but useful
+        to cross-check the compiled engine.
+    comb_schedule : str
+        ``"event"`` (default) executes, after each change, only the
+        combinatorial statements that read a modified signal.
+        ``"levelized"`` executes all combinatorial statements once per
+        clock edge, in an order computed at construction; combinatorial
+        loops are iterated until they settle. This is faster for designs
+        where most of the logic is active at every edge.
+
+    lanes : int or None
+        Simulate this number of independent instances of the design at
+        once (batch mode). Signal values are then NumPy arrays with one
+        element per lane, see :mod:`migen.sim.batch`. Batch mode always
+        uses the interpreter. ``WaitUntil`` and ``WaitChange`` are only
+        supported in generators wrapped by ``per_lane``.
+    vcd_lane : int
+        Lane traced to the VCD file in batch mode.
+    trace_format : str or None
+        Format of the waveform file ``vcd_name``: ``"vcd"`` or ``"fst"``.
+        By default, FST is used if the name ends in ``.fst``.
+    trace_include : list of str or None
+        If not None, only trace the signals whose name matches one of
+        these glob patterns (e.g. ``"fifo_*"``).
+    trace_exclude : list of str or None
+        Do not trace the signals whose name matches one of these glob
+        patterns.
+    trace_modules : list of Module or None
+        If not None, only trace the signals of these modules and of their
+        submodules.
+    trace_window : (int, int) or None
+        Only trace from the ``start``-th to the ``stop``-th rising edge of
+        the ``sys`` clock. Tracing can also be switched off and on by
+        generators, with the ``"trace_off"`` and ``"trace_on"`` commands.
+    skip_idle : bool
+        When all generators are sleeping (see :class:`Sleep`) and the
+        design has settled, i.e. a rising edge of every clock left all
+        signals unchanged, jump directly to the next generator wakeup.
+        The number of rising edges skipped in each clock domain is
+        counted in ``skipped_cycles``. Ignored when a waveform file is
+        written, so that it contains all clock edges, with co-simulated
+        instances and with the Verilator backend. ``Display`` statements
+        of the synchronous logic are not executed on skipped edges.
+    opt_level : int
+        0 (default) simulates the design as generated. 1 drops the
+        default assignments of combinatorial signals that are assigned
+        on every path anyway, and executes the reset statements of a
+        clock domain only when its reset is asserted, skipping the other
+        synchronous statements of the domain at that time when the reset
+        overrides all their effects. Batch mode only applies the former.
+    profile : bool or str
+        Collect execution statistics in ``profile``, a
+        :class:`migen.sim.profile.Profile`. If a file name is given, the
+        report is written to it when the simulator is closed, in JSON if
+        the name ends in ``.json`` and as text otherwise.
+    verilog_sources : list of str or None
+        If not None, the :class:`Instance` specials of the design are
+        co-simulated with Icarus Verilog, and these Verilog files define
+        the instantiated modules. See :mod:`migen.sim.cosim`.
+    cosim_tools : (str, str)
+        Names or paths of the ``iverilog`` and ``vvp`` programs.
+    backend : str
+        ``"python"`` (default) evaluates the design in Python.
+        ``"verilator"`` compiles it with Verilator and only runs the
+        generators in Python, see :mod:`migen.sim.verilator`. The
+        ``verilog_sources`` are then compiled together with the design,
+        and the engine, schedule and optimization level are ignored.
+
+    Combinatorial loops that do not settle raise
+    :class:`CombinationalLoopError`.
+    """
     def __init__(self, fragment_or_module, generators, clocks={"sys": 10}, vcd_name=None,
-                 special_overrides={}):
+                 special_overrides={}, engine="compiled", comb_schedule="event",
+                 lanes=None, vcd_lane=0, trace_format=None,
+                 trace_include=None, trace_exclude=None, trace_modules=None,
+                 trace_window=None, skip_idle=False, opt_level=0,
+                 profile=False, verilog_sources=None,
+                 cosim_tools=("iverilog", "vvp"), backend="python"):
         if isinstance(fragment_or_module, _Fragment):
             self.fragment = fragment_or_module
         else:
             self.fragment = fragment_or_module.get_fragment()
 
-        mta = MemoryToArray()
-        mta.transform_fragment(None, self.fragment)
-
-        overrides = {AsyncResetSynchronizer: DummyAsyncResetSynchronizer}
-        overrides.update(special_overrides)
-        f, lowered = lower_specials(overrides, self.fragment)
-        if self.fragment.specials:
-            raise ValueError("Could not lower all specials", self.fragment.specials)
-
-        if not isinstance(generators, dict):
-            generators = {"sys": generators}
         self.generators = dict()
         self.passive_generators = set()
-        for k, v in generators.items():
-            if (isinstance(v, collections.abc.Iterable)
-                    and not inspect.isgenerator(v)):
-                self.generators[k] = list(v)
-            else:
-                self.generators[k] = [v]
+        # Generators that are not sleeping or waiting, in execution order
+        self._runnable = dict()
+        self._generator_order = dict()
+        self.add_generators(generators)
+        # Number of rising edges of each domain so far
+        self._cycles = collections.defaultdict(int)
+        # Heaps of (cycle, order, generator) for sleeping generators
+        self._sleeping = collections.defaultdict(list)
+        # Waiting generators: generator -> (domain, command, value, inputs)
+        self._waiting = dict()
+        # signal or memory -> generators waiting on it
+        self._waiting_on = collections.defaultdict(set)
+        # domain -> waiting generators whose condition may have changed
+        self._waiting_dirty = collections.defaultdict(set)
+        self.skip_idle = skip_idle and vcd_name is None
+        self.lanes = lanes
+        self.skipped_cycles = collections.defaultdict(int)
 
         clocks = collections.OrderedDict(sorted(clocks.items(),
                                                 key=operator.itemgetter(0)))
@@ -294,27 +878,370 @@ class Simulator:
                 cd.clk.reset = C(self.time.clocks[clock].high)
                 self.fragment.clock_domains.append(cd)
 
-        insert_resets(self.fragment)
+        self.backend = backend
+        if backend == "verilator":
+            self._init_verilator(special_overrides, verilog_sources,
+                                 lanes, vcd_name, profile)
+            return
+        elif backend != "python":
+            raise ValueError("Unknown simulator backend: '{}'".format(backend))
+
+        mtl = MemoryToLocations()
+        mtl.transform_fragment(None, self.fragment)
+
+        overrides = {AsyncResetSynchronizer: DummyAsyncResetSynchronizer}
+        overrides.update(special_overrides)
+        f, lowered = lower_specials(overrides, self.fragment)
+        instances = set()
+        if verilog_sources is not None:
+            instances = {special for special in self.fragment.specials
+                         if isinstance(special, Instance)}
+            self.fragment.specials -= instances
+        if self.fragment.specials:
+            raise ValueError("Could not lower all specials", self.fragment.specials)
+
+        if instances:
+            if lanes is not None:
+                raise ValueError("Instances cannot be co-simulated in batch mode")
+            self.cosim = Cosimulation(instances, self.fragment.clock_domains,
+                                      verilog_sources, *cosim_tools)
+            # the co-simulated instances must see every clock edge
+            self.skip_idle = False
+        else:
+            self.cosim = None
+
+        if opt_level not in (0, 1):
+            raise ValueError("Unknown optimization level: {}".format(opt_level))
+        # domain -> (reset signal, reset statements, whether the reset
+        # overrides the synchronous statements)
+        resets = dict()
+        if opt_level and lanes is None:
+            for cd, statements in self.fragment.sync.items():
+                rst = self.fragment.clock_domains[cd].rst
+                if rst is not None:
+                    resets[cd] = (rst, generate_reset(rst, statements),
+                                  _reset_overrides_all(statements))
+        else:
+            insert_resets(self.fragment)
         # comb signals return to their reset value if nothing assigns them
+        targets = list_targets(self.fragment.comb)
+        if opt_level:
+            targets -= _list_always_assigned(self.fragment.comb)
         self.fragment.comb[0:0] = [s.eq(s.reset)
-                                   for s in list_targets(self.fragment.comb)]
-        self.evaluator = Evaluator(self.fragment.clock_domains,
-                                   mta.replacements)
+                                   for s in sorted(targets, key=lambda x: x.duid)]
+        if lanes is None:
+            # signal values are laid out in creation order
+            self.evaluator = Evaluator(self.fragment.clock_domains,
+                                       mtl.memories, self._state_signals())
+        else:
+            from migen.sim.batch import BatchEvaluator, lane_dtype
+            self.evaluator = BatchEvaluator(self.fragment.clock_domains,
+                                            mtl.memories, lanes,
+                                            lane_dtype(self.fragment))
+
+        if engine == "compiled" and lanes is None:
+            compiler = StatementCompiler(self.fragment.clock_domains,
+                                         self.evaluator.memories,
+                                         self.evaluator.memory_modifications,
+                                         self.evaluator.index)
+        elif engine in ("compiled", "interpreted"):
+            compiler = None
+        else:
+            raise ValueError("Unknown simulator engine: '{}'".format(engine))
+        if comb_schedule == "event":
+            self._comb_propagate = self._comb_propagate_event
+        elif comb_schedule == "levelized":
+            self._comb_propagate = self._comb_propagate_levelized
+        else:
+            raise ValueError("Unknown comb schedule: '{}'".format(comb_schedule))
+        groups = group_by_targets(self.fragment.comb)
+        if self.cosim is not None:
+            # the instances form one more group
+            groups.append((list_signals(self.cosim.outputs), self.cosim))
+        groups = self._schedule_comb(groups)
+        sync = sorted(self.fragment.sync.items(), key=operator.itemgetter(0))
+        reset_domains = sorted(resets.keys())
+        executors = self._make_executors(compiler,
+            [statements for targets, statements in groups] +
+            [statements for cd, statements in sync] +
+            [resets[cd][1] for cd in reset_domains])
+        self._comb_groups = executors[:len(groups)]
+        self._sync_exec = {cd: executor for (cd, statements), executor
+                           in zip(sync, executors[len(groups):])}
+        # domain -> (reset signal, reset executor, reset overrides all)
+        self._reset_exec = {cd: (resets[cd][0], executor, resets[cd][2])
+                            for cd, executor in zip(reset_domains,
+                                executors[len(groups) + len(sync):])}
+        if profile:
+            self.profile = Profile()
+            self._profile_file = profile if isinstance(profile, str) else None
+            self._profile_executors(groups, sync)
+        else:
+            self.profile = None
 
+        if trace_window is not None and "sys" not in clocks:
+            raise ValueError("trace_window requires a sys clock")
+        self.trace_window = trace_window
         if vcd_name is None:
             self.vcd = DummyVCDWriter()
         else:
-            self.vcd = VCDWriter(vcd_name, module_name=type(fragment_or_module).__name__)
-
             signals = list_signals(self.fragment)
+            if self.cosim is not None:
+                signals |= list_signals(self.cosim.inputs + self.cosim.outputs)
             for cd in self.fragment.clock_domains:
                 signals.add(cd.clk)
                 if cd.rst is not None:
                     signals.add(cd.rst)
-            for memory_array in mta.replacements.values():
-                signals |= set(memory_array)
-            for signal in sorted(signals, key=lambda x: x.duid):
-                self.vcd.set(signal, signal.reset.value)
+            if trace_modules is not None:
+                signals &= _list_module_signals(trace_modules)
+            ns = None
+            if trace_include is not None or trace_exclude is not None:
+                ns = build_namespace(signals)
+                signals = {signal for signal in signals
+                           if _trace_selected(ns.get_name(signal),
+                                              trace_include, trace_exclude)}
+
+            self.vcd = open_trace(vcd_name, type(fragment_or_module).__name__,
+                                  trace_format,
+                                  sorted(signals, key=lambda x: x.duid), ns)
+            if lanes is not None:
+                from migen.sim.batch import LaneVCDWriter
+                self.vcd = LaneVCDWriter(self.vcd, vcd_lane)
+
+        if self.cosim is not None:
+            self.cosim.start()
+
+    def _init_verilator(self, special_overrides, verilog_sources,
+                        lanes, vcd_name, profile):
+        from migen.fhdl.verilog import convert
+        from migen.sim.verilator import build, VerilatorModel, VerilatorEvaluator
+
+        if lanes is not None or vcd_name is not None or profile:
+            raise ValueError("Batch mode, waveforms and profiling are not "
+                             "supported with the Verilator backend")
+        ios = set()
+        for cd in self.fragment.clock_domains:
+            ios.add(cd.clk)
+            if cd.rst is not None:
+                ios.add(cd.rst)
+        conv_output = convert(self.fragment, ios, name="top",
+                              special_overrides=special_overrides)
+        model = VerilatorModel(build(conv_output, verilog_sources or ()))
+        self.evaluator = VerilatorEvaluator(self.fragment.clock_domains,
+                                            model, conv_output.ns)
+        self._comb_propagate = lambda initial: self.evaluator.commit()
+        self._comb_groups = []
+        self._sync_exec = dict()
+        self._reset_exec = dict()
+        self.cosim = None
+        self.profile = None
+        # the model must see every clock edge, and only the signals read
+        # or written by generators are watched for changes
+        self.skip_idle = False
+        self.trace_window = None
+        self.vcd = DummyVCDWriter()
+
+    def _profile_executors(self, groups, sync):
+        ns = build_namespace(list_signals(self.fragment))
+        for n, (targets, statements) in enumerate(groups):
+            targets = sorted(targets, key=lambda x: x.duid)
+            names = [ns.get_name(target) for target in targets]
+            if len(names) > 3:
+                names[3:] = ["..."]
+            if isinstance(statements, Cosimulation):
+                statements = statements.instances
+            self._comb_groups[n] = self.profile.wrap_comb(
+                self._comb_groups[n], ", ".join(names),
+                module_path(targets[0]) if targets else "top", len(statements))
+        for cd, statements in sync:
+            modules = collections.Counter()
+            for statement in statements:
+                targets = sorted(list_targets(statement), key=lambda x: x.duid)
+                modules[module_path(targets[0]) if targets else "top"] += 1
+            self._sync_exec[cd] = self.profile.wrap_sync(
+                self._sync_exec[cd], cd, modules)
+
+    def add_generators(self, generators):
+        """Add generators to the simulation.
+
+        ``generators`` takes the same forms as the argument of the
+        constructor. The new generators run after the existing ones of
+        the same clock domain.
+        """
+        if not isinstance(generators, dict):
+            generators = {"sys": generators}
+        for k, v in sorted(generators.items(), key=operator.itemgetter(0)):
+            if (isinstance(v, collections.abc.Iterable)
+                    and not inspect.isgenerator(v)):
+                v = list(v)
+            else:
+                v = [v]
+            self.generators.setdefault(k, []).extend(v)
+            self._runnable.setdefault(k, []).extend(v)
+            for generator in v:
+                self._generator_order[generator] = len(self._generator_order)
+
+    def _state_signals(self):
+        signals = list_signals(self.fragment)
+        for cd in self.fragment.clock_domains:
+            signals.add(cd.clk)
+            if cd.rst is not None:
+                signals.add(cd.rst)
+        return sorted(signals, key=lambda x: x.duid)
+
+    def _state_fingerprint(self, signals, memories):
+        # Designs are matched by the shapes of their signals and memories,
+        # in creation order, since signal identities do not survive the
+        # process that created them.
+        description = repr(([(len(s), s.signed) for s in signals],
+                            [(m.width, m.depth) for m in memories],
+                            list(self.time.clocks.keys())))
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def save_state(self, filename):
+        """Save the state of the simulation to a file.
+
+        The state contains the values of all the signals of the design,
+        the contents of the memories and the state of the clocks. It can
+        be restored into a simulator of the same design, possibly in
+        another process, with :meth:`restore_state`. Generators are not
+        saved. Call this method between runs, e.g. after :meth:`run`
+        returned.
+        """
+        if self.cosim is not None:
+            raise ValueError("Co-simulated instances have no saved state")
+        if self.backend != "python":
+            raise ValueError("The Verilator backend has no saved state")
+        signals = self._state_signals()
+        memories = sorted(self.evaluator.memories.keys(),
+                          key=lambda x: x.duid)
+        state = {
+            "fingerprint": self._state_fingerprint(signals, memories),
+            "signals": [self.evaluator.eval(s) for s in signals],
+            "memories": [self.evaluator.memories[m] for m in memories],
+            "time": self.time.get_state()
+        }
+        with open(filename, "wb") as f:
+            pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+
+    def restore_state(self, filename):
+        """Restore a state saved by :meth:`save_state`.
+
+        The generators of this simulator, given to the constructor or
+        with :meth:`add_generators`, are kept and start from the
+        restored state. The VCD file, if any, continues at the saved
+        simulation time.
+        """
+        with open(filename, "rb") as f:
+            state = pickle.load(f)
+        if self.cosim is not None:
+            raise ValueError("Co-simulated instances have no saved state")
+        if self.backend != "python":
+            raise ValueError("The Verilator backend has no saved state")
+        signals = self._state_signals()
+        memories = sorted(self.evaluator.memories.keys(),
+                          key=lambda x: x.duid)
+        if state["fingerprint"] != self._state_fingerprint(signals, memories):
+            raise ValueError("Saved state does not match the design")
+        for signal, value in zip(signals, state["signals"]):
+            self.evaluator.assign(signal, value)
+            self.vcd.set(signal, value)
+        self.evaluator.commit()
+        for memory, contents in zip(memories, state["memories"]):
+            self.evaluator.memories[memory][:] = contents
+        self.time.set_state(state["time"])
+        self.vcd.set_time(self.time.now)
+
+    def _schedule_comb(self, groups):
+        # Order the comb groups topologically (writers before readers) and
+        # index them by the signals that should trigger their execution.
+        # Groups are executed in increasing index order, so that in an
+        # acyclic comb graph each group runs at most once per propagation.
+        inputs = [self._list_sensitivity(statements)
+                  for targets, statements in groups]
+        driver = dict()
+        for n, (targets, statements) in enumerate(groups):
+            for target in targets:
+                driver[target] = n
+        readers = [set() for group in groups]
+        for n, group_inputs in enumerate(inputs):
+            for signal in group_inputs:
+                if signal in driver:
+                    readers[driver[signal]].add(n)
+
+        components = [sorted(component)
+                      for component in _strongly_connected_components(readers)]
+        order = [n for component in components for n in component]
+        rank = {n: r for r, n in enumerate(order)}
+
+        self._comb_driver = {signal: rank[n] for signal, n in driver.items()}
+        self._comb_readers = collections.defaultdict(list)
+        for n in order:
+            for signal in inputs[n]:
+                self._comb_readers[signal].append(rank[n])
+
+        # Components of the comb graph, as lists of group indices, with the
+        # signals forming a loop when there is one.
+        self._comb_components = []
+        for component in components:
+            members = set(component)
+            loop = {target for n in component for target in groups[n][0]
+                    if not members.isdisjoint(readers[n])
+                    and any(target in inputs[r] for r in component)}
+            self._comb_components.append(([rank[n] for n in component], loop))
+        self._comb_loop_of = {n: loop for component, loop in self._comb_components
+                              for n in component if loop}
+        # in an acyclic graph, each group runs at most once per propagation
+        self._comb_max_executions = len(groups) + _MAX_COMB_ITERATIONS*len(self._comb_loop_of)
+
+        return [groups[n] for n in order]
+
+    def _list_sensitivity(self, node):
+        # signals (and memories) whose changes can change the outcome of
+        # evaluating node
+        if isinstance(node, Cosimulation):
+            node = node.inputs
+        r = list_inputs(node)
+        for cd in list_clock_domains_expr(node):
+            cd = self.fragment.clock_domains[cd]
+            r.add(cd.clk)
+            if cd.rst is not None:
+                r.add(cd.rst)
+        r |= _list_memories(node)
+        return r
+
+    def comb_loops(self):
+        """List the combinatorial loops of the design.
+
+        Returns
+        -------
+        list of list of str
+            For each loop, the names of the signals it is made of.
+        """
+        loops = [loop for component, loop in self._comb_components if loop]
+        return [self._loop_names(loop) for loop in loops]
+
+    def _loop_names(self, loop):
+        ns = build_namespace(list_signals(self.fragment) | loop)
+        return sorted(ns.get_name(signal) for signal in loop)
+
+    def _make_executors(self, compiler, statement_lists):
+        cosim = [n for n, statements in enumerate(statement_lists)
+                 if isinstance(statements, Cosimulation)]
+        statement_lists = list(statement_lists)
+        for n in cosim:
+            statement_lists[n] = []
+        if compiler is None:
+            executors = [partial(self.evaluator.execute, statements)
+                         for statements in statement_lists]
+        else:
+            executors = [partial(f, self.evaluator.values,
+                                 self.evaluator.next_values,
+                                 self.evaluator.dirty.append)
+                         for f in compiler.compile_list(statement_lists)]
+        for n in cosim:
+            executors[n] = partial(self.cosim.execute, self.evaluator)
+        return executors
 
     def __enter__(self):
         return self
@@ -324,18 +1251,90 @@ class Simulator:
 
     def close(self):
         self.vcd.close()
+        if self.backend == "verilator":
+            self.evaluator.model.close()
+        if self.cosim is not None:
+            self.cosim.close()
+        if self.profile is not None and self._profile_file is not None:
+            if self._profile_file.endswith(".json"):
+                self.profile.write_json(self._profile_file)
+            else:
+                with open(self._profile_file, "w") as f:
+                    f.write(self.profile.report())
 
-    def _commit_and_comb_propagate(self):
-        # TODO: optimize
-        all_modified = set()
-        modified = self.evaluator.commit()
-        all_modified |= modified
-        while modified:
-            self.evaluator.execute(self.fragment.comb)
+    def _commit_and_comb_propagate(self, initial=False):
+        all_modified = self._comb_propagate(initial)
+        for signal in all_modified:
+            if not isinstance(signal, Memory):
+                self.vcd.set(signal, self.evaluator.eval(signal))
+        if self._waiting_on:
+            for signal in all_modified:
+                for generator in self._waiting_on.get(signal, ()):
+                    cd = self._waiting[generator][0]
+                    self._waiting_dirty[cd].add(generator)
+        if self.profile is not None:
+            self.profile.end_edge()
+        return all_modified
+
+    def _comb_propagate_event(self, initial):
+        # Only the comb groups reading a modified signal are executed,
+        # one at a time, in topological order.
+        if initial:
+            pending = list(range(len(self._comb_groups)))
+        else:
+            pending = []
+        queued = set(pending)
+        all_modified = self.evaluator.commit()
+        for signal in all_modified:
+            # a signal written by a generator or a sync statement is
+            # overridden by its comb driver, if any
+            n = self._comb_driver.get(signal)
+            if n is not None and n not in queued:
+                queued.add(n)
+                heapq.heappush(pending, n)
+        modified = all_modified
+        executions = 0
+        while True:
+            for signal in modified:
+                for n in self._comb_readers.get(signal, ()):
+                    if n not in queued:
+                        queued.add(n)
+                        heapq.heappush(pending, n)
+            if not pending:
+                break
+            n = heapq.heappop(pending)
+            queued.discard(n)
+            executions += 1
+            if executions > self._comb_max_executions:
+                loop = self._comb_loop_of.get(n)
+                if loop is None:
+                    loop = set().union(*self._comb_loop_of.values())
+                raise CombinationalLoopError(self._loop_names(loop))
+            self._comb_groups[n]()
             modified = self.evaluator.commit()
             all_modified |= modified
-        for signal in all_modified:
-            self.vcd.set(signal, self.evaluator.signal_values[signal])
+        return all_modified
+
+    def _comb_propagate_levelized(self, initial):
+        # All comb groups are executed once, in topological order.
+        # Loops are iterated until they settle.
+        all_modified = self.evaluator.commit()
+        for component, loop in self._comb_components:
+            if not loop:
+                self._comb_groups[component[0]]()
+                all_modified |= self.evaluator.commit()
+                continue
+            for i in range(_MAX_COMB_ITERATIONS):
+                modified = set()
+                for n in component:
+                    self._comb_groups[n]()
+                    modified |= self.evaluator.commit()
+                if not modified:
+                    break
+                all_modified |= modified
+            else:
+                raise CombinationalLoopError(self._loop_names(loop))
+        return all_modified
 
     def _evalexec_nested_lists(self, x):
         if isinstance(x, list):
@@ -348,20 +1347,92 @@ class Simulator:
         else:
             raise ValueError("Invalid simulator exec/eval request", x)
 
+    def _condition_value(self, expr):
+        return self.evaluator.eval(expr) & _mask(expr)
+
+    def _suspend(self, cd, generator, command):
+        # Returns False if the generator should continue immediately.
+        if isinstance(command, Sleep):
+            if command.cycles < 1:
+                return False
+            heapq.heappush(self._sleeping[cd],
+                           (self._cycles[cd] + command.cycles,
+                            self._generator_order[generator], generator))
+        elif isinstance(command, (WaitUntil, WaitChange)):
+            if self.lanes is not None:
+                # the condition has one value per lane
+                raise TypeError("{} cannot be used by batch generators, "
+                                "use per_lane"
+                                .format(command.__class__.__name__))
+            value = self._condition_value(command.expr)
+            if isinstance(command, WaitUntil) and value:
+                return False
+            inputs = self._list_sensitivity(command.expr)
+            self._waiting[generator] = cd, command, value, inputs
+            for signal in inputs:
+                self._waiting_on[signal].add(generator)
+        return True
+
+    def _wake(self, cd):
+        woken = []
+        sleeping = self._sleeping.get(cd)
+        while sleeping and sleeping[0][0] <= self._cycles[cd]:
+            woken.append(heapq.heappop(sleeping)[2])
+        dirty = self._waiting_dirty.get(cd)
+        if dirty:
+            for generator in dirty:
+                domain, command, value, inputs = self._waiting[generator]
+                new_value = self._condition_value(command.expr)
+                if isinstance(command, WaitUntil):
+                    done = new_value
+                else:
+                    done = new_value != value
+                if done:
+                    woken.append(generator)
+                    del self._waiting[generator]
+                    for signal in inputs:
+                        self._waiting_on[signal].discard(generator)
+                        if not self._waiting_on[signal]:
+                            del self._waiting_on[signal]
+            dirty.clear()
+        return woken
+
     def _process_generators(self, cd):
+        self._cycles[cd] += 1
+        runnable = self._runnable[cd]
+        woken = self._wake(cd)
+        if woken:
+            runnable = sorted(runnable + woken,
+                              key=self._generator_order.__getitem__)
+        still_runnable = []
         exhausted = []
-        for generator in self.generators[cd]:
+        profile = self.profile
+        for generator in runnable:
+            if profile is not None:
+                start = time.perf_counter()
             reply = None
             while True:
                 try:
                     request = generator.send(reply)
                     if request is None:
+                        still_runnable.append(generator)
                         break  # next cycle
+                    elif isinstance(request, (Sleep, WaitUntil, WaitChange)):
+                        reply = None
+                        if self._suspend(cd, generator, request):
+                            break
+                    elif isinstance(request, _ClockCommand):
+                        reply = None
+                        request.apply(self.time)
                     elif isinstance(request, str):
                         if request == "passive":
                             self.passive_generators.add(generator)
                         elif request == "active":
                             self.passive_generators.discard(generator)
+                        elif request == "trace_on":
+                            self.vcd.dump_on()
+                        elif request == "trace_off":
+                            self.vcd.dump_off()
                         else:
                             raise ValueError("Unknown simulator command: '{}'"
                                              .format(request))
@@ -379,8 +1450,30 @@ class Simulator:
                 except StopIteration:
                     exhausted.append(generator)
                     break
+            if profile is not None:
+                profile.add_generator(generator, time.perf_counter() - start)
+        self._runnable[cd] = still_runnable
         for generator in exhausted:
             self.generators[cd].remove(generator)
+        return bool(runnable)
+
+    def _skip_to_wakeup(self):
+        # Called when the design has settled and all generators are
+        # sleeping or waiting: nothing changes until the first sleeping
+        # generator wakes up, so the clock edges before it are skipped.
+        wakeups = [self.time.time_to_rising(cd, sleeping[0][0] - self._cycles[cd])
+                   for cd, sleeping in self._sleeping.items() if sleeping]
+        wakeups = [t for t in wakeups if t is not None]
+        if not wakeups:
+            return
+        # stop just before the first wakeup edge
+        rising = self.time.advance(min(wakeups) - 1)
+        for cd, n in rising.items():
+            self._cycles[cd] += n
+            self.skipped_cycles[cd] += n
+            clk = self.fragment.clock_domains[cd].clk
+            self.evaluator.assign(clk, int(self.time.clocks[cd].high))
+        self._commit_and_comb_propagate()
 
     def _continue_simulation(self):
         for cd_generators in self.generators.values():
@@ -389,21 +1482,54 @@ class Simulator:
         return False
 
     def run(self):
-        self.evaluator.execute(self.fragment.comb)
-        self._commit_and_comb_propagate()
+        self._commit_and_comb_propagate(initial=True)
+        if self.trace_window is not None:
+            trace_start, trace_stop = self.trace_window
+            if trace_start > 0:
+                self.vcd.dump_off()
+            sys_cycles = 0
+        clocks = {cd.clk for cd in self.fragment.clock_domains}
+        # domains having had a rising edge since the last change
+        idle = set()
 
         while True:
             dt, rising, falling = self.time.tick()
             self.vcd.delay(dt)
+            if self.trace_window is not None and "sys" in rising:
+                sys_cycles += 1
+                if sys_cycles == trace_start:
+                    self.vcd.dump_on()
+                elif sys_cycles == trace_stop:
+                    self.vcd.dump_off()
+            active = False
+            if self.cosim is not None and (rising or falling):
+                self.cosim.clock_edge(self.evaluator, rising, falling)
             for cd in rising:
                 self.evaluator.assign(self.fragment.clock_domains[cd].clk, 1)
-                if cd in self.fragment.sync:
-                    self.evaluator.execute(self.fragment.sync[cd])
+                if cd in self._reset_exec:
+                    rst, reset_exec, reset_only = self._reset_exec[cd]
+                    if self.evaluator.eval(rst):
+                        if not reset_only:
+                            self._sync_exec[cd]()
+                        reset_exec()
+                    else:
+                        self._sync_exec[cd]()
+                elif cd in self._sync_exec:
+                    self._sync_exec[cd]()
                 if cd in self.generators:
-                    self._process_generators(cd)
+                    active |= self._process_generators(cd)
             for cd in falling:
                 self.evaluator.assign(self.fragment.clock_domains[cd].clk, 0)
-            self._commit_and_comb_propagate()
+            modified = self._commit_and_comb_propagate()
+
+            if self.skip_idle:
+                if active or not modified <= clocks:
+                    idle.clear()
+                else:
+                    idle |= rising
+                    if len(idle) == len(self.time.clocks):
+                        self._skip_to_wakeup()
+                        idle.clear()
 
             if not self._continue_simulation():
                 break
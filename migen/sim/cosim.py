@@ -0,0 +1,211 @@
+"""Co-simulation of Verilog modules
+
+The :class:`Instance` specials of a design cannot be simulated in Python.
+With ``Simulator(..., verilog_sources=[...])``, they are exported with
+:func:`migen.fhdl.verilog.convert` into a wrapper module and simulated by
+Icarus Verilog in a subprocess, which exchanges the values of the
+instance ports with the simulator through a pipe.
+
+The instances are treated as a single combinatorial group, executed when
+one of their inputs changes: all input values are sent on one line and
+all output values are read back on the next one, after the Verilog
+simulator advanced by one time unit. At the edges of the clocks
+connected to the instances, the new clock levels are sent together with
+the values of the other inputs before the edge, so that the registers of
+the instances sample the same values as the registers of the design.
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+
+from migen.fhdl.structure import Signal, ClockSignal, _Fragment
+from migen.fhdl.specials import Instance
+from migen.fhdl.verilog import convert
+
+
+__all__ = ["Cosimulation"]
+
+
+_xz = str.maketrans("xXzZ", "0000")
+
+
+class Cosimulation:
+    """Simulator process for a set of instances
+
+    Parameters
+    ----------
+    instances : iterable of Instance
+        Instances to simulate. Inout ports are not supported.
+    clock_domains : list of ClockDomain
+        Clock domains of the design, to find the clock inputs of the
+        instances.
+    sources : list of str
+        Verilog files defining the instantiated modules.
+    iverilog : str
+        Name or path of the ``iverilog`` compiler.
+    vvp : str
+        Name or path of the ``vvp`` runtime.
+
+    Attributes
+    ----------
+    inputs : list of _Value
+        Expressions driving the inputs of the instances.
+    outputs : list of _Value
+        Expressions driven by the outputs of the instances.
+    exchanges : int
+        Number of round trips to the Verilog simulator so far.
+    """
+    def __init__(self, instances, clock_domains, sources=(),
+                 iverilog="iverilog", vvp="vvp"):
+        self.instances = sorted(instances, key=lambda x: x.duid)
+        self.sources = [os.path.abspath(source) for source in sources]
+        self.iverilog = iverilog
+        self.vvp = vvp
+
+        self.inputs = []
+        self.outputs = []
+        input_ports = []
+        output_ports = []
+        wrapper = _Fragment()
+        for instance in self.instances:
+            items = []
+            for item in instance.items:
+                if isinstance(item, Instance.InOut):
+                    raise ValueError("Inout ports cannot be co-simulated",
+                                     instance.of, item.name)
+                if isinstance(item, Instance._IO):
+                    port = Signal(len(item.expr), name_override="{}_{}".format(
+                        instance.name_override, item.name))
+                    if isinstance(item, Instance.Input):
+                        self.inputs.append(item.expr)
+                        input_ports.append(port)
+                    else:
+                        self.outputs.append(item.expr)
+                        output_ports.append(port)
+                    item = type(item)(item.name, port)
+                items.append(item)
+            wrapper.specials.add(Instance(instance.of, *items,
+                                          name=instance.name_override,
+                                          synthesis_directive=instance.synthesis_directive,
+                                          attr=instance.attr))
+        self.verilog = convert(wrapper, set(input_ports + output_ports),
+                               name="migen_cosim_top",
+                               create_clock_domains=False)
+        self.testbench = self._testbench(input_ports, output_ports)
+
+        clocks = {cd.clk: cd.name for cd in clock_domains}
+        # input index -> clock domain
+        self._clock_inputs = dict()
+        for n, expr in enumerate(self.inputs):
+            if isinstance(expr, ClockSignal):
+                self._clock_inputs[n] = expr.cd
+            elif isinstance(expr, Signal) and expr in clocks:
+                self._clock_inputs[n] = clocks[expr]
+        self._masks = [(1 << len(expr)) - 1 for expr in self.inputs]
+
+        self.exchanges = 0
+        self.process = None
+        self._directory = None
+        self._last_inputs = None
+        self._last_outputs = None
+
+    def _testbench(self, input_ports, output_ports):
+        ns = self.verilog.ns
+        inputs = [ns.get_name(port) for port in input_ports]
+        outputs = [ns.get_name(port) for port in output_ports]
+        lines = ["module migen_cosim;", "integer migen_cosim_cmd, migen_cosim_r;"]
+        for name, port in zip(inputs, input_ports):
+            lines.append("reg [{}:0] {};".format(len(port) - 1, name))
+        for name, port in zip(outputs, output_ports):
+            lines.append("wire [{}:0] {};".format(len(port) - 1, name))
+        lines.append("migen_cosim_top migen_cosim_dut(")
+        lines.append(",\n".join("\t.{0}({0})".format(name)
+                                for name in inputs + outputs))
+        lines.append(");")
+        lines.append("initial forever begin")
+        # each request is a command followed by the input values
+        lines.append("\tmigen_cosim_r = $fscanf(32'h8000_0000, \"%d\", migen_cosim_cmd);")
+        lines.append("\tif (migen_cosim_r != 1) $finish;")
+        for name in inputs:
+            lines.append("\tmigen_cosim_r = $fscanf(32'h8000_0000, \"%h\", {});"
+                         .format(name))
+        lines.append("\t#1;")
+        lines.append("\t$display(\"@cosim{}\"{});".format(
+            " %h"*len(outputs), "".join(", " + name for name in outputs)))
+        lines.append("\t$fflush;")
+        lines.append("end")
+        lines.append("endmodule")
+        return "\n".join(lines) + "\n"
+
+    def start(self):
+        """Compile the design and start the Verilog simulator."""
+        self._directory = tempfile.TemporaryDirectory()
+        directory = self._directory.name
+        with open(os.path.join(directory, "migen_cosim.v"), "w") as f:
+            f.write(self.testbench)
+        with open(os.path.join(directory, "migen_cosim_top.v"), "w") as f:
+            f.write(self.verilog.main_source)
+        for filename, content in self.verilog.data_files.items():
+            with open(os.path.join(directory, filename), "w") as f:
+                f.write(content)
+        subprocess.check_call([self.iverilog, "-o", "migen_cosim.vvp",
+                               "-s", "migen_cosim",
+                               "migen_cosim.v", "migen_cosim_top.v"]
+                              + self.sources, cwd=directory)
+        self.process = subprocess.Popen([self.vvp, "-n", "migen_cosim.vvp"],
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        cwd=directory,
+                                        universal_newlines=True)
+
+    def close(self):
+        if self.process is not None:
+            self.process.stdin.close()
+            self.process.stdout.close()
+            returncode = self.process.wait()
+            self.process = None
+            self._directory.cleanup()
+            if returncode != 0:
+                raise OSError("Subprocess failed")
+
+    def exchange(self, values):
+        """Send the values of the inputs, and return the values of the
+        outputs one time unit later."""
+        self.exchanges += 1
+        self.process.stdin.write("1" + "".join(" {:x}".format(value)
+                                               for value in values) + "\n")
+        self.process.stdin.flush()
+        while True:
+            line = self.process.stdout.readline()
+            if not line:
+                raise OSError("Subprocess failed")
+            if line.startswith("@cosim"):
+                break
+            # messages displayed by the instantiated modules
+            sys.stdout.write(line)
+        return [int(value.translate(_xz), 16) for value in line.split()[1:]]
+
+    def execute(self, evaluator, levels={}):
+        """Update the outputs of the instances after a change of their
+        inputs. ``levels`` overrides the values of some inputs."""
+        values = tuple(levels.get(n, evaluator.eval(expr)) & mask
+                       for n, (expr, mask) in enumerate(zip(self.inputs, self._masks)))
+        if values != self._last_inputs:
+            self._last_inputs = values
+            self._last_outputs = self.exchange(values)
+        for expr, value in zip(self.outputs, self._last_outputs):
+            evaluator.assign(expr, value)
+
+    def clock_edge(self, evaluator, rising, falling):
+        """Present clock edges to the instances, with the values of the
+        other inputs from before the edges."""
+        levels = dict()
+        for n, cd in self._clock_inputs.items():
+            if cd in rising:
+                levels[n] = 1
+            elif cd in falling:
+                levels[n] = 0
+        if levels:
+            self.execute(evaluator, levels)
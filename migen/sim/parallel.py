@@ -0,0 +1,143 @@
+import random
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from migen.fhdl import tracer
+from migen.sim.core import run_simulation
+
+
+__all__ = ["SimulationResult", "run_parallel"]
+
+
+class SimulationResult:
+    """Outcome of one simulation run by :func:`run_parallel`
+
+    Attributes
+    ----------
+    index : int
+        Position of the configuration in the list given to
+        :func:`run_parallel`.
+    config
+        The configuration.
+    result
+        Value returned by the ``collect`` function, or None.
+    error : str or None
+        Representation of the exception raised by the run, if it failed.
+    traceback : str or None
+        Formatted traceback of that exception.
+    vcd_name : str or None
+        VCD file written by the run.
+    elapsed : float
+        Wall-clock duration of the run, in seconds.
+    """
+    def __init__(self, index, config, result=None, error=None, traceback=None,
+                 vcd_name=None, elapsed=0.0):
+        self.index = index
+        self.config = config
+        self.result = result
+        self.error = error
+        self.traceback = traceback
+        self.vcd_name = vcd_name
+        self.elapsed = elapsed
+
+    @property
+    def passed(self):
+        return self.error is None
+
+    def __repr__(self):
+        status = "passed" if self.passed else "failed: " + self.error
+        return "<SimulationResult {} {}>".format(self.index, status)
+
+
+def _run_one(index, config, module_factory, testbench, collect, vcd_name,
+             simulator_kwargs):
+    # Worker processes run many simulations, possibly forked from a parent
+    # that already elaborated designs. Start every run from the same naming
+    # state so that signal names (and VCD files) do not depend on scheduling.
+    tracer.reset()
+    if isinstance(config, dict) and "seed" in config:
+        random.seed(config["seed"])
+    if vcd_name is not None:
+        vcd_name = vcd_name.format(index=index, config=config)
+
+    start = time.perf_counter()
+    try:
+        dut = module_factory(config)
+        run_simulation(dut, testbench(dut, config), vcd_name=vcd_name,
+                       **simulator_kwargs)
+        if collect is None:
+            result = None
+        else:
+            result = collect(dut, config)
+    except Exception as e:
+        return SimulationResult(index, config,
+                                error=repr(e), traceback=traceback.format_exc(),
+                                vcd_name=vcd_name,
+                                elapsed=time.perf_counter() - start)
+    return SimulationResult(index, config, result=result, vcd_name=vcd_name,
+                            elapsed=time.perf_counter() - start)
+
+
+def run_parallel(module_factory, testbench, configs, collect=None,
+                 vcd_name=None, max_workers=None, stop_on_failure=False,
+                 **simulator_kwargs):
+    """Run many simulations in a pool of processes
+
+    Each configuration is simulated in a worker process, which builds its
+    own design and ``Simulator``. Since designs and generators are created
+    in the workers, the factories (and configurations) must be picklable,
+    i.e. defined at module level.
+
+    Parameters
+    ----------
+    module_factory : callable
+        ``module_factory(config)`` returns the module to simulate.
+    testbench : callable
+        ``testbench(dut, config)`` returns the generators, as accepted by
+        :func:`run_simulation`.
+    configs : list
+        One configuration per run. When a configuration is a dictionary
+        with a ``"seed"`` key, the ``random`` module of the worker is seeded
+        with it before the design is built.
+    collect : callable or None
+        ``collect(dut, config)`` is called after a successful run; its
+        (picklable) return value is stored in the result.
+    vcd_name : str or None
+        If not None, a format string for the VCD file of each run, with
+        ``index`` and ``config`` fields, e.g. ``"run_{index}.vcd"``.
+    max_workers : int or None
+        Number of worker processes, defaults to the number of processors.
+    stop_on_failure : bool
+        Cancel the runs that have not started yet after the first failure.
+    simulator_kwargs
+        Passed to :func:`run_simulation`, e.g. ``clocks``.
+
+    Returns
+    -------
+    list of SimulationResult
+        Results of the completed runs, in the order of ``configs``.
+    """
+    results = []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(_run_one, index, config,
+                                   module_factory, testbench, collect,
+                                   vcd_name, simulator_kwargs): (index, config)
+                   for index, config in enumerate(configs)}
+        for future in as_completed(futures):
+            if future.cancelled():
+                continue
+            try:
+                result = future.result()
+            except Exception as e:
+                # the worker died, or the run or its result could not be
+                # pickled
+                index, config = futures[future]
+                result = SimulationResult(index, config, error=repr(e),
+                                          traceback=traceback.format_exc())
+            results.append(result)
+            if stop_on_failure and not result.passed:
+                for f in futures:
+                    f.cancel()
+    results.sort(key=lambda r: r.index)
+    return results
@@ -0,0 +1,155 @@
+"""Profiling of simulations
+
+With ``Simulator(..., profile=True)``, the simulator counts the executions
+of the statements of the design and measures the time spent in them and
+in the generators. The statistics are held in a :class:`Profile`.
+"""
+
+import collections
+import json
+import time
+
+
+__all__ = ["Profile"]
+
+
+class _Entry:
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.statements = 0
+        self.time = 0.0
+
+    def to_dict(self):
+        return {"name": self.name, "calls": self.calls,
+                "statements": self.statements, "time": self.time}
+
+
+def module_path(signal):
+    """Hierarchical name of the module where a signal was created."""
+    names = []
+    for name, number in signal.backtrace[1:-1]:
+        # skip comprehensions and repeated names
+        if not name.startswith("<") and (not names or names[-1] != name):
+            names.append(name)
+    return "/".join(names) or "top"
+
+
+class Profile:
+    """Statistics of a simulation
+
+    Attributes
+    ----------
+    comb : dict
+        Combinatorial statement groups, named after their targets.
+    sync : dict
+        Synchronous statements, by clock domain.
+    modules : dict
+        Statements by module, according to the place where their first
+        target was created. Only the time of combinatorial statements is
+        attributed to modules, since the synchronous statements of a
+        domain are executed together.
+    generators : dict
+        Generators, by function name.
+    deltas : Counter
+        Histogram of the number of combinatorial group executions
+        (delta cycles) needed to settle the design after a clock edge.
+
+    The values of the dictionaries have ``calls``, ``statements`` and
+    ``time`` (in seconds) attributes.
+    """
+    def __init__(self):
+        self.comb = collections.OrderedDict()
+        self.sync = collections.OrderedDict()
+        self.modules = collections.OrderedDict()
+        self.generators = collections.OrderedDict()
+        self.deltas = collections.Counter()
+        self.edges = 0
+        self._comb_calls = 0
+        self._comb_calls_edge = 0
+
+    @staticmethod
+    def _entry(entries, name):
+        try:
+            return entries[name]
+        except KeyError:
+            entry = entries[name] = _Entry(name)
+            return entry
+
+    def wrap_comb(self, executor, name, module, statements):
+        entry = self._entry(self.comb, name)
+        module_entry = self._entry(self.modules, module)
+        def profiled():
+            start = time.perf_counter()
+            executor()
+            elapsed = time.perf_counter() - start
+            entry.calls += 1
+            entry.statements += statements
+            entry.time += elapsed
+            module_entry.calls += 1
+            module_entry.statements += statements
+            module_entry.time += elapsed
+            self._comb_calls += 1
+        return profiled
+
+    def wrap_sync(self, executor, domain, modules):
+        # modules: number of statements of each module in the domain
+        entry = self._entry(self.sync, domain)
+        statements = sum(modules.values())
+        module_entries = [(self._entry(self.modules, module), n)
+                          for module, n in modules.items()]
+        def profiled():
+            start = time.perf_counter()
+            executor()
+            entry.time += time.perf_counter() - start
+            entry.calls += 1
+            entry.statements += statements
+            for module_entry, n in module_entries:
+                module_entry.statements += n
+        return profiled
+
+    def add_generator(self, generator, elapsed):
+        entry = self._entry(self.generators, generator.__qualname__)
+        entry.calls += 1
+        entry.time += elapsed
+
+    def end_edge(self):
+        """Record the delta cycles of a clock edge."""
+        self.deltas[self._comb_calls - self._comb_calls_edge] += 1
+        self._comb_calls_edge = self._comb_calls
+        self.edges += 1
+
+    def to_dict(self):
+        def entries(d):
+            return [e.to_dict() for e in sorted(d.values(),
+                                                key=lambda e: -e.time)]
+        return {
+            "edges": self.edges,
+            "deltas": {str(k): v for k, v in sorted(self.deltas.items())},
+            "comb": entries(self.comb),
+            "sync": entries(self.sync),
+            "modules": entries(self.modules),
+            "generators": entries(self.generators)
+        }
+
+    def write_json(self, filename):
+        with open(filename, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def report(self, limit=20):
+        """Text report, with the ``limit`` most expensive entries of each
+        category."""
+        d = self.to_dict()
+        lines = ["{} clock edges".format(self.edges)]
+        if self.edges:
+            total = sum(k*v for k, v in self.deltas.items())
+            lines.append("{:.2f} delta cycles per edge on average, {} at most"
+                         .format(total/self.edges, max(self.deltas)))
+        for title in "comb", "sync", "modules", "generators":
+            lines.append("")
+            lines.append("{:>10} {:>12} {:>10}  {}".format(
+                "time (s)", "statements", "calls", title))
+            for e in d[title][:limit]:
+                lines.append("{:10.4f} {:12} {:10}  {}".format(
+                    e["time"], e["statements"], e["calls"], e["name"]))
+        return "\n".join(lines) + "\n"
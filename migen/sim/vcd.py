@@ -1,8 +1,7 @@
 from itertools import count
-import tempfile
-import os
 from collections import OrderedDict
-import shutil
+import subprocess
+import warnings
 
 from migen.fhdl.namer import build_namespace
 
@@ -18,85 +17,274 @@ def vcd_codes():
         yield code
 
 
+def _open_output(filename):
+    # compress according to the file extension
+    if filename.endswith(".gz"):
+        import gzip
+        # the default level 9 is very slow on such repetitive data
+        return gzip.open(filename, "wt", compresslevel=6)
+    elif filename.endswith(".zst"):
+        try:
+            from compression import zstd
+        except ImportError:
+            try:
+                import zstandard as zstd
+            except ImportError:
+                raise ImportError("Writing zstd-compressed VCD files requires "
+                                  "Python 3.14 or the zstandard package")
+        return zstd.open(filename, "wt")
+    else:
+        return open(filename, "w")
+
+
 class VCDWriter:
-    def __init__(self, filename, module_name=None):
+    """Write signal changes to a VCD file
+
+    Unless given with ``signals``, the signals traced are the ones set
+    before the first delay: the header of the file is written at the first
+    delay, and a signal first set afterwards is not traced (with a
+    warning). Value changes are then accumulated in memory and streamed to
+    the file in blocks of about ``buffer_size`` characters.
+
+    Files whose name ends in ``.gz`` or ``.zst`` are compressed with gzip
+    or zstd, respectively.
+
+    Parameters
+    ----------
+    signals : iterable of Signal or None
+        If not None, the signals to trace, with their reset value as
+        initial value. Other signals are ignored.
+    namespace : Namespace or None
+        Names of the signals. By default, a namespace is built from the
+        traced signals.
+    """
+    def __init__(self, filename, module_name=None, buffer_size=1 << 20,
+                 signals=None, namespace=None):
         self.filename = filename
         self.module_name = module_name
-        self.buffer_file = tempfile.TemporaryFile(
-            dir=os.path.dirname(filename), mode="w+")
+        self.buffer_size = buffer_size
+        self.namespace = namespace
+        self.out = self._open(filename)
         self.codegen = vcd_codes()
         self.codes = OrderedDict()
+        self.formats = dict()
         self.signal_values = dict()
         self.t = 0
+        self.header_written = False
+        self.dumping = True
+        self.buffer = []
+        self.buffered = 0
+        self.fixed_signals = signals is not None
+        self.late_signals = set()
+        if signals is not None:
+            for signal in signals:
+                self._get_format(signal)
+                self.signal_values[signal] = signal.reset.value
 
-    def _get_code(self, signal):
+    def _open(self, filename):
+        return _open_output(filename)
+
+    def _get_format(self, signal):
         try:
-            code = self.codes[signal]
+            return self.formats[signal]
         except KeyError:
-            code = next(self.codegen)
-            self.codes[signal] = code
-        return code
-
-    def _write_primitive_value(self, f, signal, value):
-        l = len(signal)
-        if value < 0:
-            value += 2**l
-        if l > 1:
-            fmtstr = "b{:0" + str(l) + "b} {}\n"
-        else:
-            fmtstr = "{}{}\n"
-        code = self._get_code(signal)
-        f.write(fmtstr.format(value, code))
-
-    def _write_enum_value(self, f, signal, value):
-        val = "b"
-        for c in signal._enumeration[value].encode():
-            val += "{:08b}".format(c)
-        code = self._get_code(signal)
-        f.write("{} {}\n".format(val, code))
-
-    def _write_value(self, f, signal, value):
+            pass
+        code = next(self.codegen)
+        self.codes[signal] = code
         if hasattr(signal, "_enumeration"):
-            self._write_enum_value(self.buffer_file, signal, value)
+            fmt = None
         else:
-            self._write_primitive_value(self.buffer_file, signal, value)
+            l = len(signal)
+            if l > 1:
+                fmt = ("b", "0" + str(l) + "b", " " + code + "\n", (1 << l) - 1)
+            else:
+                fmt = ("", "d", code + "\n", 1)
+        self.formats[signal] = fmt
+        return fmt
+
+    def _format_unknown(self, signal, fmt):
+        if fmt is not None and fmt[0] == "":
+            return "x" + self.codes[signal] + "\n"
+        else:
+            return "bx " + self.codes[signal] + "\n"
+
+    def _format_value(self, signal, fmt, value):
+        if fmt is None:
+            val = "b"
+            for c in signal._enumeration[value].encode():
+                val += "{:08b}".format(c)
+            return "{} {}\n".format(val, self.codes[signal])
+        else:
+            prefix, spec, suffix, mask = fmt
+            return prefix + format(value & mask, spec) + suffix
+
+    def _write(self, s):
+        self.buffer.append(s)
+        self.buffered += len(s)
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered value changes to the file."""
+        self.out.write("".join(self.buffer))
+        self.buffer = []
+        self.buffered = 0
+
+    def _write_header(self):
+        if self.module_name:
+            self._write("$scope module {name} $end\n".format(name=self.module_name))
+        ns = self.namespace
+        if ns is None:
+            ns = build_namespace(self.codes.keys())
+        for signal, code in self.codes.items():
+            name = ns.get_name(signal)
+            if hasattr(signal, "_enumeration"):
+                size = max([len(v) for v in signal._enumeration.values()])*8
+            else:
+                size = len(signal)
+            self._write("$var wire {size} {code} {name} $end\n"
+                        .format(name=name, code=code, size=size))
+        if self.module_name:
+            self._write("$enddefinitions $end\n")
+        self._write("$dumpvars\n")
+        for signal in self.codes.keys():
+            self._write(self._format_value(signal, self.formats[signal],
+                                           self.signal_values[signal]))
+        self._write("$end\n")
+        self._write("#{}\n".format(self.t))
+        self.header_written = True
 
     def set(self, signal, value):
-        if signal not in self.signal_values or self.signal_values[signal] != value:
-            self._write_value(self.buffer_file, signal, value)
+        if self.header_written:
+            try:
+                fmt = self.formats[signal]
+            except KeyError:
+                if not self.fixed_signals and signal not in self.late_signals:
+                    self.late_signals.add(signal)
+                    warnings.warn("{} was first set after the VCD header "
+                                  "was written and is not traced"
+                                  .format(signal), stacklevel=2)
+                return
+            if self.signal_values[signal] != value:
+                self.signal_values[signal] = value
+                if self.dumping:
+                    self._write(self._format_value(signal, fmt, value))
+        elif self.fixed_signals:
+            # initial values, written with the header
+            if signal in self.formats:
+                self.signal_values[signal] = value
+        else:
+            self._get_format(signal)
             self.signal_values[signal] = value
 
     def delay(self, delay):
+        if not self.header_written:
+            self._write_header()
         self.t += delay
-        self.buffer_file.write("#{}\n".format(self.t))
+        self._write("#{}\n".format(self.t))
+
+    def set_time(self, t):
+        """Set the current time, before the first delay.
+
+        Used to continue a simulation that was restored from a saved
+        state.
+        """
+        self.t = t
+
+    def dump_off(self):
+        """Stop recording value changes ($dumpoff)."""
+        if not self.dumping:
+            return
+        if not self.header_written:
+            self._write_header()
+        self._write("$dumpoff\n")
+        for signal in self.codes.keys():
+            self._write(self._format_unknown(signal, self.formats[signal]))
+        self._write("$end\n")
+        self.dumping = False
+
+    def dump_on(self):
+        """Resume recording value changes ($dumpon)."""
+        if self.dumping:
+            return
+        self._write("$dumpon\n")
+        for signal in self.codes.keys():
+            self._write(self._format_value(signal, self.formats[signal],
+                                           self.signal_values[signal]))
+        self._write("$end\n")
+        self.dumping = True
 
     def close(self):
-        out = open(self.filename, "w")
         try:
-            if self.module_name:
-                out.write("$scope module {name} $end\n".format(name=self.module_name))
-            ns = build_namespace(self.codes.keys())
-            for signal, code in self.codes.items():
-                name = ns.get_name(signal)
-                if hasattr(signal, "_enumeration"):
-                    size = max([len(v) for v in signal._enumeration.values()])*8
-                else:
-                    size = len(signal)
-                out.write("$var wire {size} {code} {name} $end\n"
-                          .format(name=name, code=code, size=size))
-            if self.module_name:
-                out.write("$enddefinitions $end\n")
-            out.write("$dumpvars\n")
-            for signal in self.codes.keys():
-                self._write_value(out, signal, signal.reset.value)
-            out.write("$end\n")
-            out.write("#0\n")
-
-            self.buffer_file.seek(0)
-            shutil.copyfileobj(self.buffer_file, out)
-            self.buffer_file.close()
+            if not self.header_written:
+                self._write_header()
+            self.flush()
+        finally:
+            self.out.close()
+
+
+class FSTWriter(VCDWriter):
+    """Write signal changes to an FST file
+
+    FST is the compressed and indexed waveform format of GTKWave, which
+    lets viewers load the signals and time ranges they display without
+    reading the whole file. The VCD stream is converted on the fly by
+    the ``vcd2fst`` program of GTKWave, which must be installed.
+
+    Parameters
+    ----------
+    vcd2fst : str
+        Name or path of the ``vcd2fst`` program.
+    """
+    def __init__(self, filename, module_name=None, buffer_size=1 << 20,
+                 signals=None, namespace=None, vcd2fst="vcd2fst"):
+        self.vcd2fst = vcd2fst
+        # vcd2fst needs the $enddefinitions statement
+        if not module_name:
+            module_name = "top"
+        VCDWriter.__init__(self, filename, module_name, buffer_size,
+                           signals, namespace)
+
+    def _open(self, filename):
+        self.process = subprocess.Popen([self.vcd2fst, "-", filename],
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.DEVNULL,
+                                        universal_newlines=True)
+        return self.process.stdin
+
+    def close(self):
+        try:
+            VCDWriter.close(self)
         finally:
-            out.close()
+            if self.process.wait() != 0:
+                raise OSError("Subprocess failed")
+
+
+def open_trace(filename, module_name=None, trace_format=None,
+               signals=None, namespace=None):
+    """Create the writer of a waveform file
+
+    Parameters
+    ----------
+    trace_format : str or None
+        ``"vcd"`` or ``"fst"``. If None, FST is used for file names
+        ending in ``.fst`` and VCD otherwise.
+    signals, namespace
+        See :class:`VCDWriter`.
+    """
+    if trace_format is None:
+        if filename.endswith(".fst"):
+            trace_format = "fst"
+        else:
+            trace_format = "vcd"
+    if trace_format == "vcd":
+        return VCDWriter(filename, module_name=module_name,
+                         signals=signals, namespace=namespace)
+    elif trace_format == "fst":
+        return FSTWriter(filename, module_name=module_name,
+                         signals=signals, namespace=namespace)
+    else:
+        raise ValueError("Unknown trace format: '{}'".format(trace_format))
 
 
 class DummyVCDWriter:
@@ -106,5 +294,14 @@ class DummyVCDWriter:
     def delay(self, delay):
         pass
 
+    def set_time(self, t):
+        pass
+
+    def dump_off(self):
+        pass
+
+    def dump_on(self):
+        pass
+
     def close(self):
         pass
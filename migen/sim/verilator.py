@@ -0,0 +1,295 @@
+"""Simulation with Verilator
+
+With ``Simulator(..., backend="verilator")``, the design is converted to
+Verilog and compiled by Verilator into a shared library, which is loaded
+with :mod:`ctypes`. The generators are run by the Python simulator as
+usual, but they read and write the signals of the compiled model through
+the VPI interface of Verilator, and the logic of the design is evaluated
+by the model.
+
+Compiled models are cached, by a hash of the Verilog sources and of the
+Verilator version, in ``$XDG_CACHE_HOME/migen/verilator``. Verilator 5 is
+required, for the names of the signals in its VPI interface.
+"""
+
+import ctypes
+import hashlib
+import os
+import subprocess
+import tempfile
+
+from migen.fhdl.structure import Signal, _MemoryLocation
+from migen.sim.core import Evaluator, _truncate
+
+
+__all__ = ["build", "VerilatorModel", "VerilatorEvaluator"]
+
+
+_shim = """
+#include <cstdint>
+#include <vector>
+#include "verilated.h"
+#include "verilated_vpi.h"
+#include "Vtop.h"
+
+static VerilatedContext *context;
+static Vtop *model;
+
+extern "C" {
+
+void migen_open() {
+    context = new VerilatedContext;
+    model = new Vtop{context};
+}
+
+void migen_close() {
+    model->final();
+    delete model;
+    delete context;
+}
+
+void migen_eval() {
+    model->eval();
+}
+
+void *migen_handle(const char *name) {
+    return vpi_handle_by_name((PLI_BYTE8 *)name, NULL);
+}
+
+void migen_get(void *handle, uint32_t *words, int n) {
+    s_vpi_value value;
+    value.format = vpiVectorVal;
+    vpi_get_value((vpiHandle)handle, &value);
+    for(int i = 0; i < n; i++)
+        words[i] = value.value.vector[i].aval;
+}
+
+void migen_put(void *handle, const uint32_t *words, int n) {
+    std::vector<s_vpi_vecval> vector(n);
+    for(int i = 0; i < n; i++) {
+        vector[i].aval = words[i];
+        vector[i].bval = 0;
+    }
+    s_vpi_value value;
+    value.format = vpiVectorVal;
+    value.value.vector = vector.data();
+    vpi_put_value((vpiHandle)handle, &value, NULL, vpiNoDelay);
+}
+
+}
+"""
+
+
+def _cache_dir():
+    base = os.environ.get("XDG_CACHE_HOME",
+                          os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(base, "migen", "verilator")
+
+
+def build(conv_output, sources=(), verilator="verilator", cache_dir=None):
+    """Compile a design converted with :func:`migen.fhdl.verilog.convert`
+    (with ``name="top"``), unless it is in the cache.
+
+    Parameters
+    ----------
+    sources : list of str
+        Additional Verilog files, e.g. defining the modules of instances.
+
+    Returns
+    -------
+    str
+        The directory containing the model library and the data files
+        of the design.
+    """
+    version = subprocess.check_output([verilator, "--version"],
+                                      universal_newlines=True)
+    key = hashlib.sha256()
+    for text in [version, _shim, conv_output.main_source]:
+        key.update(text.encode())
+    for filename, content in sorted(conv_output.data_files.items()):
+        key.update(filename.encode())
+        key.update(content.encode())
+    sources = [os.path.abspath(source) for source in sources]
+    for source in sources:
+        with open(source, "rb") as f:
+            key.update(f.read())
+    if cache_dir is None:
+        cache_dir = _cache_dir()
+    directory = os.path.join(cache_dir, key.hexdigest())
+    if os.path.exists(os.path.join(directory, "libmigen_sim.so")):
+        return directory
+
+    os.makedirs(cache_dir, exist_ok=True)
+    build_dir = tempfile.mkdtemp(dir=cache_dir)
+    with open(os.path.join(build_dir, "top.v"), "w") as f:
+        f.write(conv_output.main_source)
+    with open(os.path.join(build_dir, "migen_shim.cpp"), "w") as f:
+        f.write(_shim)
+    for filename, content in conv_output.data_files.items():
+        with open(os.path.join(build_dir, filename), "w") as f:
+            f.write(content)
+    subprocess.check_call([verilator, "--cc", "--exe", "--build", "--vpi",
+                           "--public-flat-rw", "-Wno-fatal", "-O3",
+                           "--top-module", "top", "-Mdir", "obj",
+                           "-CFLAGS", "-fPIC", "-LDFLAGS", "-shared",
+                           "-o", "libmigen_sim.so",
+                           "top.v", "migen_shim.cpp"] + sources,
+                          cwd=build_dir)
+    os.replace(os.path.join(build_dir, "obj", "libmigen_sim.so"),
+               os.path.join(build_dir, "libmigen_sim.so"))
+    try:
+        os.rename(build_dir, directory)
+    except OSError:
+        # built concurrently by another process
+        pass
+    return directory
+
+
+class VerilatorModel:
+    """Compiled model of a design
+
+    The model is global to the process: only one simulator can use a
+    given compiled design at a time.
+
+    Parameters
+    ----------
+    directory : str
+        Directory returned by :func:`build`.
+    """
+    def __init__(self, directory):
+        self.lib = ctypes.CDLL(os.path.join(directory, "libmigen_sim.so"))
+        self.lib.migen_handle.restype = ctypes.c_void_p
+        self.lib.migen_handle.argtypes = [ctypes.c_char_p]
+        for name in "migen_get", "migen_put":
+            getattr(self.lib, name).argtypes = [
+                ctypes.c_void_p, ctypes.POINTER(ctypes.c_uint32), ctypes.c_int]
+        # initial blocks, executed by the first evaluation, load the
+        # data files of memories from the current directory
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            self.lib.migen_open()
+            self.lib.migen_eval()
+        finally:
+            os.chdir(cwd)
+
+    def close(self):
+        self.lib.migen_close()
+
+    def handle(self, name):
+        return self.lib.migen_handle(name.encode())
+
+    def get(self, handle, nbits):
+        n = (nbits + 31)//32
+        words = (ctypes.c_uint32*n)()
+        self.lib.migen_get(handle, words, n)
+        return sum(word << 32*i for i, word in enumerate(words))
+
+    def put(self, handle, value, nbits):
+        n = (nbits + 31)//32
+        words = (ctypes.c_uint32*n)(*[(value >> 32*i) & 0xffffffff
+                                      for i in range(n)])
+        self.lib.migen_put(handle, words, n)
+
+    def eval(self):
+        self.lib.migen_eval()
+
+
+class VerilatorEvaluator(Evaluator):
+    """Evaluator reading and writing the signals of a compiled model
+
+    Expressions are evaluated in Python, from the values of their signals
+    in the model. Writes are kept until :meth:`commit`, which applies the
+    new levels of the clocks first, so that the registers of the model
+    sample the values from before the writes of the generators.
+
+    Parameters
+    ----------
+    clock_domains : list of ClockDomain
+        Clock domains of the design.
+    model : VerilatorModel
+        The compiled design.
+    namespace : Namespace
+        Names of the signals in the Verilog source.
+    """
+    def __init__(self, clock_domains, model, namespace):
+        Evaluator.__init__(self, clock_domains, [])
+        self.model = model
+        self.namespace = namespace
+        self._clocks = {cd.clk for cd in clock_domains}
+        self._handles = dict()
+        # signal -> value at the last commit, for the signals read or
+        # written so far
+        self._watched = dict()
+        self._pending = dict()
+
+    def _handle(self, signal):
+        try:
+            return self._handles[signal]
+        except KeyError:
+            pass
+        try:
+            name = self.namespace.get_name(signal)
+        except KeyError:
+            raise ValueError("Signal is not part of the design", signal)
+        # ports of the top-level module, which must be written there (the
+        # signals of the module are copied from them), then signals of
+        # the module, as named by Verilator 5
+        for prefix in "TOP.TOP.", "TOP.top.":
+            handle = self.model.handle(prefix + name)
+            if handle:
+                self._handles[signal] = handle
+                return handle
+        raise ValueError("Signal not found in the Verilator model: " + name)
+
+    def _read(self, signal):
+        value = _truncate(self.model.get(self._handle(signal), signal.nbits),
+                          signal.nbits, signal.signed)
+        self._watched.setdefault(signal, value)
+        return value
+
+    def _check_memory(self, node):
+        if isinstance(node, _MemoryLocation):
+            raise ValueError("Memories cannot be accessed from generators "
+                             "with the Verilator backend")
+
+    def eval(self, node, postcommit=False):
+        self._check_memory(node)
+        if isinstance(node, Signal):
+            if postcommit and node in self._pending:
+                return self._pending[node]
+            return self._read(node)
+        return Evaluator.eval(self, node, postcommit)
+
+    def assign(self, node, value):
+        self._check_memory(node)
+        if isinstance(node, Signal):
+            assert not node.variable
+            self._pending[node] = _truncate(value, node.nbits, node.signed)
+        else:
+            Evaluator.assign(self, node, value)
+
+    def commit(self):
+        if not self._pending:
+            return set()
+        for signal in self._pending:
+            self._read(signal)
+        clocks = [signal for signal in self._pending if signal in self._clocks]
+        if clocks:
+            for signal in clocks:
+                self.model.put(self._handle(signal), self._pending.pop(signal),
+                               signal.nbits)
+            self.model.eval()
+        if self._pending:
+            for signal, value in self._pending.items():
+                self.model.put(self._handle(signal), value, signal.nbits)
+            self.model.eval()
+            self._pending.clear()
+        r = set()
+        for signal, value in self._watched.items():
+            new_value = _truncate(self.model.get(self._handles[signal], signal.nbits),
+                                  signal.nbits, signal.signed)
+            if new_value != value:
+                self._watched[signal] = new_value
+                r.add(signal)
+        return r
@@ -0,0 +1,1011 @@
+import unittest
+import unittest.mock
+from functools import reduce
+import operator
+import os
+import json
+import tempfile
+import shutil
+import stat
+import sys
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from migen import *
+from migen.sim.core import Simulator, TimeManager, CombinationalLoopError
+from migen.sim.cosim import Cosimulation
+from migen.sim.verilator import VerilatorEvaluator
+from migen.fhdl import verilog
+from migen.fhdl.namer import build_namespace
+from migen.fhdl.tools import list_targets
+
+
+class _Datapath(Module):
+    def __init__(self):
+        self.a = Signal(8)
+        self.b = Signal((6, True))
+        self.sel = Signal(4)
+
+        self.sum = Signal(10)
+        self.chain = Signal(16)
+        self.cat_l = Signal(3)
+        self.cat_h = Signal((5, True))
+        self.sliced = Signal(12, reset=0xabc)
+        self.parted = Signal(16)
+        self.rep = Signal(12)
+        self.muxed = Signal((8, True))
+        self.cased = Signal(8)
+        self.arr_out = Signal(8)
+        self.regs = [Signal(8, name="reg" + str(i)) for i in range(4)]
+        self.counter = Signal(32)
+        self.rd = Signal(8)
+
+        ###
+
+        self.comb += [
+            self.sum.eq(self.a + self.b),
+            self.chain.eq(reduce(operator.add,
+                                 [self.a + i for i in range(100)])),
+            Cat(self.cat_l, self.cat_h).eq(self.a - self.b),
+            self.sliced[4:8].eq(self.a[2:6]),
+            self.parted.part(self.sel, 3).eq(self.a),
+            self.rep.eq(Replicate(self.a[0:3], 4)),
+            self.muxed.eq(Mux(self.a[0], self.b, -self.b)),
+            Case(self.sel, dict([(i, self.cased.eq(i*3 + self.a))
+                                 for i in range(12)] +
+                                [("default", self.cased.eq(0xff))])),
+            self.arr_out.eq(Array(self.regs)[self.sel]),
+        ]
+        self.sync += [
+            self.counter.eq(self.counter + 1),
+            Array(self.regs)[self.a[0:2]].eq(self.a ^ self.counter),
+            If(self.sel == 3,
+                self.regs[3][0:4].eq(0xf)
+            ).Elif(self.sel == 5,
+                self.regs[3].eq(self.b)
+            ),
+        ]
+
+        mem = Memory(8, 16, init=[3*i for i in range(16)])
+        port = mem.get_port(write_capable=True)
+        self.specials += mem, port
+        self.comb += [
+            port.adr.eq(self.sel),
+            port.dat_w.eq(self.a),
+            port.we.eq(self.a[7]),
+            self.rd.eq(port.dat_r)
+        ]
+
+
+def _datapath_bench(dut, trace, seed=0):
+    observed = [dut.sum, dut.chain, dut.cat_l, dut.cat_h, dut.sliced,
+                dut.parted, dut.rep, dut.muxed, dut.cased, dut.arr_out,
+                dut.counter, dut.rd] + dut.regs
+    for i in range(64):
+        yield dut.a.eq((i*37 + seed*91) & 0xff)
+        yield dut.b.eq(((i*13 + seed) & 0x3f) - 32)
+        yield dut.sel.eq((i + seed) % 15)
+        yield
+        trace.append((yield observed))
+
+
+class EngineCase(unittest.TestCase):
+    def trace(self, engine, comb_schedule="event", opt_level=0):
+        dut = _Datapath()
+        trace = []
+        run_simulation(dut, _datapath_bench(dut, trace),
+                       engine=engine, comb_schedule=comb_schedule,
+                       opt_level=opt_level)
+        return trace
+
+    def test_engines_agree(self):
+        self.assertEqual(self.trace("compiled"), self.trace("interpreted"))
+
+    def test_schedules_agree(self):
+        self.assertEqual(self.trace("compiled", "levelized"),
+                         self.trace("compiled", "event"))
+
+    def test_opt_level(self):
+        for engine in "compiled", "interpreted":
+            self.assertEqual(self.trace(engine, opt_level=1),
+                             self.trace(engine))
+
+    def test_opt_level_reset(self):
+        def simulate(reset_less, opt_level):
+            m = Module()
+            m.clock_domains.cd_sys = ClockDomain()
+            count = Signal(8, reset=5)
+            other = Signal(8, reset_less=reset_less)
+            m.sync += count.eq(count + 1), other.eq(other + 2)
+            trace = []
+            def bench():
+                for i in range(20):
+                    yield m.cd_sys.rst.eq(5 <= i < 10)
+                    yield
+                    trace.append(((yield count), (yield other)))
+            with Simulator(m, bench(), opt_level=opt_level) as s:
+                s.run()
+            return trace, s
+        for reset_less in False, True:
+            expected, s = simulate(reset_less, 0)
+            trace, s = simulate(reset_less, 1)
+            self.assertEqual(trace, expected)
+            self.assertEqual(s._reset_exec["sys"][2], not reset_less)
+
+    def test_wide(self):
+        def trace(engine):
+            m = Module()
+            a = Signal(512)
+            offset = Signal(8)
+            s = Signal((512, True))
+            parts = Signal(512)
+            m.comb += [
+                s.eq(Cat(Replicate(a[500:504], 3), a[3:300], a.part(offset, 100))),
+                parts.part(offset, 64).eq(a[64:128])
+            ]
+            result = []
+            def gen():
+                for i in range(10):
+                    yield a.eq((0xdeadbeef << (i*47)) | i)
+                    yield offset.eq(i*31)
+                    yield
+                    result.append((yield [s, parts]))
+            run_simulation(m, gen(), engine=engine)
+            return result
+        self.assertEqual(trace("interpreted"), trace("compiled"))
+
+    def test_unknown_engine(self):
+        with self.assertRaises(ValueError):
+            run_simulation(Module(), [], engine="foo")
+
+
+class CombPropagationCase(unittest.TestCase):
+    def test_chain(self):
+        # declared in reverse order of evaluation
+        m = Module()
+        a, b, c, d = Signal(8), Signal(8), Signal(8), Signal(8)
+        m.comb += [d.eq(c + 1), c.eq(b + 1), b.eq(a + 1)]
+        def gen():
+            for i in range(5):
+                yield a.eq(i)
+                yield
+                self.assertEqual((yield d), i + 3)
+        run_simulation(m, gen())
+
+    def test_generator_write_overridden(self):
+        m = Module()
+        a, b = Signal(8), Signal(8)
+        m.comb += b.eq(a)
+        def gen():
+            yield a.eq(3)
+            yield b.eq(7)
+            yield
+            self.assertEqual((yield b), 3)
+        run_simulation(m, gen())
+
+    def test_clock_signal(self):
+        m = Module()
+        clk = Signal()
+        m.comb += clk.eq(ClockSignal())
+        values = []
+        def gen():
+            for i in range(3):
+                values.append((yield clk))
+                yield
+        # sample in the middle of the high phase of sys_clk
+        run_simulation(m, {"other": gen()},
+                       clocks={"sys": 10, "other": (10, 7)})
+        self.assertEqual(values, [1, 1, 1])
+
+
+    def test_part_target(self):
+        x, y = Signal(8, name="x"), Signal(8, name="y")
+        sel, a = Signal(2, name="sel"), Signal(2, reset=3, name="a")
+        comb = x.part(sel, 2).eq(a)
+        sync = y.part(sel, 2).eq(a)
+        # the offset is an input
+        self.assertEqual(list_targets(comb), {x})
+        self.assertEqual(list_targets(sync), {y})
+        def design():
+            m = Module()
+            m.comb += comb
+            m.sync += sync
+            return m
+        def gen():
+            for i in range(3):
+                yield sel.eq(i)
+                yield
+                self.assertEqual((yield sel), i)
+                self.assertEqual((yield x), 3 << i)
+        run_simulation(design(), gen())
+        source = verilog.convert(design(), {x, y, sel, a}).main_source
+        self.assertIn("input [1:0] sel", source)
+        self.assertNotIn("sel <=", source)
+        self.assertIn("y <= 8'd0", source)
+
+
+class MemoryCase(unittest.TestCase):
+    def write_read(self, engine, mode, **kwargs):
+        m = Module()
+        mem = Memory(16, 6, init=[0x0101*i for i in range(6)])
+        port = mem.get_port(write_capable=True, mode=mode, **kwargs)
+        m.specials += mem, port
+        result = []
+        def gen():
+            yield port.adr.eq(1)
+            yield port.dat_w.eq(0x5555)
+            yield port.we.eq(0b10 if kwargs.get("we_granularity") else 1)
+            yield
+            yield port.we.eq(0)
+            yield
+            result.append((yield port.dat_r))
+            result.append((yield mem[1]))
+        run_simulation(m, gen(), engine=engine)
+        return result
+
+    def test_modes(self):
+        for engine in "compiled", "interpreted":
+            self.assertEqual(self.write_read(engine, WRITE_FIRST),
+                             [0x5555, 0x5555])
+            self.assertEqual(self.write_read(engine, READ_FIRST),
+                             [0x0101, 0x5555])
+            self.assertEqual(self.write_read(engine, NO_CHANGE),
+                             [0, 0x5555])
+            self.assertEqual(self.write_read(engine, READ_FIRST,
+                                             we_granularity=8),
+                             [0x0101, 0x5501])
+
+    def test_read_enable(self):
+        for engine in "compiled", "interpreted":
+            m = Module()
+            mem = Memory(8, 4, init=[10, 11, 12, 13])
+            port = mem.get_port(has_re=True)
+            m.specials += mem, port
+            result = []
+            def gen():
+                for adr, re in (1, 1), (2, 0), (3, 1), (0, 0):
+                    yield port.adr.eq(adr)
+                    yield port.re.eq(re)
+                    yield
+                    result.append((yield port.dat_r))
+            run_simulation(m, gen(), engine=engine)
+            self.assertEqual(result, [10, 11, 11, 13])
+
+    def test_async_read(self):
+        for engine in "compiled", "interpreted":
+            m = Module()
+            mem = Memory(8, 1024)
+            port = mem.get_port(async_read=True)
+            m.specials += mem, port
+            result = []
+            def gen():
+                yield port.adr.eq(700)
+                yield mem[700].eq(42)
+                yield
+                result.append((yield port.dat_r))
+                yield mem[700].eq(43)
+                yield
+                result.append((yield port.dat_r))
+            run_simulation(m, gen(), engine=engine)
+            self.assertEqual(result, [42, 43])
+
+
+class WaitCase(unittest.TestCase):
+    class Counter(Module):
+        def __init__(self):
+            self.count = Signal(8)
+            self.slow = Signal()
+            self.sync += self.count.eq(self.count + 1)
+            self.comb += self.slow.eq(self.count[2])
+
+    def observe(self, bench):
+        dut = self.Counter()
+        observed = []
+        run_simulation(dut, bench(dut, observed))
+        return observed
+
+    def test_sleep(self):
+        def commands(dut, observed):
+            observed.append((yield dut.count))
+            yield Sleep(5)
+            observed.append((yield dut.count))
+            yield Sleep(1)
+            observed.append((yield dut.count))
+        def loop(dut, observed):
+            observed.append((yield dut.count))
+            for i in range(5):
+                yield
+            observed.append((yield dut.count))
+            yield
+            observed.append((yield dut.count))
+        self.assertEqual(self.observe(commands), self.observe(loop))
+
+    def test_wait(self):
+        def commands(dut, observed):
+            yield WaitUntil(dut.count == 12)
+            observed.append((yield dut.count))
+            yield WaitUntil(dut.count == 12)
+            observed.append((yield dut.count))
+            yield WaitChange(dut.slow)
+            observed.append((yield dut.count))
+        def loop(dut, observed):
+            while not (yield dut.count == 12):
+                yield
+            observed.append((yield dut.count))
+            while not (yield dut.count == 12):
+                yield
+            observed.append((yield dut.count))
+            slow = yield dut.slow
+            yield
+            while (yield dut.slow) == slow:
+                yield
+            observed.append((yield dut.count))
+        self.assertEqual(self.observe(commands), self.observe(loop))
+
+    def test_order(self):
+        # generators keep their order of execution after sleeping
+        dut = self.Counter()
+        x = Signal(8)
+        def writer(value, cycles):
+            yield Sleep(cycles)
+            yield x.eq(value)
+        def check():
+            yield Sleep(4)
+            self.assertEqual((yield x), 2)
+        run_simulation(dut, [writer(1, 2), writer(2, 1), writer(2, 2), check()])
+
+    @unittest.skipIf(numpy is None, "NumPy is not available")
+    def test_per_lane(self):
+        from migen.sim.batch import per_lane
+
+        dut = self.Counter()
+        observed = [[] for lane in range(3)]
+        def bench(lane):
+            yield Sleep(lane + 2)
+            observed[lane].append((yield dut.count))
+            yield WaitChange(dut.slow)
+            observed[lane].append((yield dut.count))
+        run_simulation(dut, per_lane(bench(lane) for lane in range(3)), lanes=3)
+        self.assertEqual(observed, [[2, 4], [3, 4], [4, 8]])
+
+
+def _reference_edges(clocks, n):
+    # straightforward scan of all clocks at every step
+    state = []
+    for period, phase in clocks:
+        half_period = period//2
+        high = phase >= half_period
+        if high:
+            phase -= half_period
+        state.append([high, half_period, half_period - phase])
+    edges = []
+    for i in range(n):
+        dt = min(cs[2] for cs in state)
+        rising, falling = set(), set()
+        for k, cs in enumerate(state):
+            if cs[2] == dt:
+                cs[0] = not cs[0]
+                (rising if cs[0] else falling).add(k)
+            cs[2] -= dt
+            if not cs[2]:
+                cs[2] = cs[1]
+        edges.append((dt, rising, falling))
+    return edges
+
+
+class TimeManagerCase(unittest.TestCase):
+    clocks = [(10, 0), (4, 1), (6, 5), (20, 3), (14, 0)]
+
+    def edges(self, time, n):
+        return [(dt, set(rising), set(falling))
+                for dt, rising, falling in (time.tick() for i in range(n))]
+
+    def test_pattern(self):
+        time = TimeManager(dict(enumerate(self.clocks)))
+        self.assertIsNotNone(time._pattern)
+        self.assertEqual(self.edges(time, 1000),
+                         _reference_edges(self.clocks, 1000))
+
+    def test_heap(self):
+        time = TimeManager(dict(enumerate(self.clocks)))
+        # a period change to the same period only disables the pattern
+        time.set_period(0, 10)
+        self.assertIsNone(time._pattern)
+        self.assertEqual(self.edges(time, 1000),
+                         _reference_edges(self.clocks, 1000))
+        # the pattern is built again once the clocks are stable
+        self.assertIsNotNone(time._pattern)
+
+    def test_advance(self):
+        reference = _reference_edges(self.clocks, 1000)
+        for pattern in True, False:
+            time = TimeManager(dict(enumerate(self.clocks)))
+            if not pattern:
+                time.set_period(0, 10)
+            self.edges(time, 10)
+            rising = time.advance(sum(dt for dt, r, f in reference[10:500]))
+            self.assertEqual(rising,
+                             {k: sum(k in r for dt, r, f in reference[10:500])
+                              for k in range(len(self.clocks))})
+            self.assertEqual(self.edges(time, 500)[1:], reference[501:])
+
+    def test_restart_high(self):
+        # "slow" is restarted in its high phase, then the pattern is
+        # built again while it is still low
+        def restarted():
+            time = TimeManager({"slow": 2000, "fast": 2})
+            time.gate("slow")
+            while time.now < 1000:
+                time.tick()
+            time.gate("slow", False)
+            return time
+        def edges(time):
+            result = []
+            while time.now < 6000:
+                dt, rising, falling = time.tick()
+                if "slow" in rising or "slow" in falling:
+                    result.append((time.now, "slow" in rising))
+            return result
+        expected = [(3000, True), (4000, False), (5000, True), (6000, False)]
+        time = restarted()
+        self.assertEqual(edges(time), expected)
+        self.assertIsNotNone(time._pattern)
+        state = restarted().get_state()
+        time = TimeManager({"slow": 2000, "fast": 2})
+        time.set_state(state)
+        self.assertEqual(edges(time), expected)
+
+    def test_commands(self):
+        m = Module()
+        count = Signal(8)
+        m.sync.gated += count.eq(count + 1)
+        observed = []
+        def bench():
+            yield GateClock("gated")
+            yield Sleep(5)
+            observed.append((yield count))
+            yield Sleep(5)
+            observed.append((yield count))
+            yield GateClock("gated", False)
+            yield Sleep(5)
+            observed.append((yield count))
+            yield SetClockPeriod("gated", 2)
+            yield Sleep(5)
+            observed.append((yield count))
+            yield ShiftClock("gated", 100)
+            yield Sleep(5)
+            observed.append((yield count))
+        run_simulation(m, bench(), clocks={"sys": 10, "gated": 10})
+        self.assertEqual(observed[0], observed[1])
+        self.assertEqual(observed[2], observed[1] + 4)
+        self.assertGreaterEqual(observed[3], observed[2] + 20)
+        self.assertLessEqual(observed[4], observed[3] + 1)
+
+
+class SkipIdleCase(unittest.TestCase):
+    class Timeout(Module):
+        def __init__(self):
+            self.start = Signal()
+            self.count = Signal(8)
+            self.fast_count = Signal(8)
+            self.sync += If(self.start, self.count.eq(0)
+                ).Elif(self.count != 100, self.count.eq(self.count + 1))
+            self.sync.fast += If(self.fast_count != 30,
+                                 self.fast_count.eq(self.fast_count + 1))
+
+    def simulate(self, **kwargs):
+        dut = self.Timeout()
+        observed = []
+        def sys_bench():
+            yield Sleep(5000)
+            observed.append(((yield dut.count), (yield dut.fast_count)))
+            yield dut.start.eq(1)
+            yield
+            yield dut.start.eq(0)
+            yield Sleep(1000)
+            observed.append(((yield dut.count), (yield dut.fast_count)))
+        def fast_bench():
+            yield Sleep(3333)
+            yield dut.fast_count.eq(0)
+            yield Sleep(7)
+            observed.append(((yield dut.count), (yield dut.fast_count)))
+        with Simulator(dut, {"sys": sys_bench(), "fast": fast_bench()},
+                       clocks={"sys": 10, "fast": (4, 1)}, **kwargs) as s:
+            s.run()
+        return observed, s.skipped_cycles
+
+    def test_skip(self):
+        expected, skipped = self.simulate()
+        self.assertEqual(sum(skipped.values()), 0)
+        observed, skipped = self.simulate(skip_idle=True)
+        self.assertEqual(observed, expected)
+        self.assertGreater(skipped["sys"], 5000)
+        self.assertGreater(skipped["fast"], 10000)
+
+    def test_tracing(self):
+        with tempfile.TemporaryDirectory() as dir:
+            observed, skipped = self.simulate(
+                skip_idle=True, vcd_name=os.path.join(dir, "trace.vcd"))
+        self.assertEqual(sum(skipped.values()), 0)
+
+
+class StateCase(unittest.TestCase):
+    class SoC(Module):
+        def __init__(self):
+            self.count = Signal(16)
+            self.count_next = Signal(16)
+            self.mem = Memory(16, 8)
+            port = self.mem.get_port(write_capable=True)
+            self.specials += self.mem, port
+            self.comb += [
+                self.count_next.eq(self.count + 1),
+                port.adr.eq(self.count[:3]),
+                port.dat_w.eq(self.count),
+                port.we.eq(1)
+            ]
+            self.sync += self.count.eq(self.count_next)
+
+    def bench(self, dut, observed):
+        for i in range(4):
+            observed.append(((yield dut.count), (yield dut.mem[i])))
+            yield
+
+    def boot(self):
+        for i in range(100):
+            yield
+
+    def test_restore(self):
+        def full(dut, observed):
+            yield from self.boot()
+            # the restored simulation starts at the next clock cycle
+            yield
+            yield from self.bench(dut, observed)
+        dut = self.SoC()
+        expected = []
+        run_simulation(dut, full(dut, expected))
+
+        with tempfile.TemporaryDirectory() as dir:
+            filename = os.path.join(dir, "boot.state")
+            dut = self.SoC()
+            with Simulator(dut, self.boot()) as s:
+                s.run()
+                s.save_state(filename)
+
+            for i in range(2):
+                dut = self.SoC()
+                observed = []
+                vcd_name = os.path.join(dir, "test.vcd")
+                with Simulator(dut, [], vcd_name=vcd_name) as s:
+                    s.restore_state(filename)
+                    s.add_generators(self.bench(dut, observed))
+                    s.run()
+                self.assertEqual(observed, expected)
+                with open(vcd_name) as f:
+                    self.assertIn("#1005\n", f.read())
+
+            with Simulator(Module(), []) as s:
+                with self.assertRaises(ValueError):
+                    s.restore_state(filename)
+
+
+class ProfileCase(unittest.TestCase):
+    def test_profile(self):
+        dut = _Datapath()
+        trace = []
+        with tempfile.TemporaryDirectory() as dir:
+            filename = os.path.join(dir, "profile.json")
+            with Simulator(dut, _datapath_bench(dut, trace, 0),
+                           profile=filename) as s:
+                s.run()
+            with open(filename) as f:
+                report = json.load(f)
+        profile = s.profile
+        self.assertEqual(sum(profile.deltas.values()), profile.edges)
+        self.assertEqual(report["edges"], profile.edges)
+        self.assertEqual(profile.sync["sys"].calls, len(trace) + 1)
+        self.assertEqual(list(profile.generators), ["_datapath_bench"])
+        self.assertEqual(sum(e.calls for e in profile.comb.values()),
+                         sum(k*v for k, v in profile.deltas.items()))
+        self.assertIn("_datapath_bench", profile.report())
+
+# Model of the "cosim_dut" module: s = a + b, q <= d at the rising edges of clk
+_cosim_verilog = """
+module cosim_dut(input [7:0] a, input [7:0] b, input clk, input [7:0] d,
+                 output [7:0] s, output reg [7:0] q);
+assign s = a + b;
+initial q = 0;
+always @(posedge clk) q <= d;
+endmodule
+"""
+
+_fake_iverilog = """
+import sys
+open(sys.argv[sys.argv.index("-o") + 1], "w").close()
+"""
+
+_fake_vvp = """
+import sys
+clk = q = 0
+for line in sys.stdin:
+    cmd, a, b, new_clk, d = [int(value, 16) for value in line.split()]
+    if new_clk and not clk:
+        q = d
+    clk = new_clk
+    # outputs in the order of the instance items, sorted by name
+    print("@cosim {:02x} {:02x}".format(q, (a + b) & 0xff), flush=True)
+"""
+
+
+class CosimCase(unittest.TestCase):
+    class Top(Module):
+        def __init__(self):
+            self.a = Signal(8)
+            self.b = Signal(8)
+            self.s = Signal(8)
+            self.c = Signal(8)
+            self.q = Signal(8)
+            self.sync += self.c.eq(self.c + 1)
+            self.specials += Instance("cosim_dut",
+                i_a=self.a, i_b=self.b, i_clk=ClockSignal(), i_d=self.c,
+                o_s=self.s, o_q=self.q)
+
+    def run_cosim(self, directory, tools):
+        source = os.path.join(directory, "cosim_dut.v")
+        with open(source, "w") as f:
+            f.write(_cosim_verilog)
+        dut = self.Top()
+        def generator():
+            yield dut.a.eq(3)
+            yield dut.b.eq(4)
+            yield
+            yield
+            self.assertEqual((yield dut.s), 7)
+            for i in range(5):
+                # the instance register samples c like a design register
+                self.assertEqual((yield dut.q), ((yield dut.c) - 1) & 0xff)
+                yield
+        with Simulator(dut, generator(), verilog_sources=[source],
+                       cosim_tools=tools, skip_idle=True) as s:
+            # the instance must see every clock edge
+            self.assertFalse(s.skip_idle)
+            s.run()
+        # a few exchanges per cycle, not one per signal
+        self.assertLessEqual(s.cosim.exchanges, 3*8)
+
+    def test_protocol(self):
+        with tempfile.TemporaryDirectory() as dir:
+            tools = []
+            for name, script in ("iverilog", _fake_iverilog), ("vvp", _fake_vvp):
+                filename = os.path.join(dir, name)
+                with open(filename, "w") as f:
+                    f.write("#!" + sys.executable + "\n" + script)
+                os.chmod(filename, os.stat(filename).st_mode | stat.S_IXUSR)
+                tools.append(filename)
+            self.run_cosim(dir, tools)
+
+    @unittest.skipIf(shutil.which("iverilog") is None, "iverilog is not available")
+    def test_iverilog(self):
+        with tempfile.TemporaryDirectory() as dir:
+            self.run_cosim(dir, ("iverilog", "vvp"))
+
+    def test_testbench(self):
+        dut = self.Top()
+        cosim = Cosimulation(dut.get_fragment().specials, [])
+        self.assertEqual(len(cosim.inputs), 4)
+        self.assertIn("cosim_dut", cosim.verilog.main_source)
+        self.assertEqual(cosim.testbench.count("$fscanf"), 5)
+        self.assertIn("$display(\"@cosim %h %h\"", cosim.testbench)
+        with self.assertRaises(ValueError):
+            Simulator(self.Top(), [])
+
+
+class _FakeModel:
+    # register q <= d at the rising edges of the sys_clk port
+    def __init__(self):
+        self.values = {"sys_clk": 0, "d": 0, "q": 0}
+        self.clk = 0
+
+    def handle(self, name):
+        if name == "TOP.TOP.sys_clk":
+            return "sys_clk"
+        if name.startswith("TOP.top.") and name[8:] in ("d", "q"):
+            return name[8:]
+
+    def get(self, handle, nbits):
+        return self.values[handle]
+
+    def put(self, handle, value, nbits):
+        self.values[handle] = value
+
+    def eval(self):
+        if self.values["sys_clk"] and not self.clk:
+            self.values["q"] = self.values["d"]
+        self.clk = self.values["sys_clk"]
+
+
+class VerilatorCase(unittest.TestCase):
+    def test_evaluator(self):
+        cd = ClockDomain("sys", reset_less=True)
+        d = Signal(8, name_override="d")
+        q = Signal(8, name_override="q")
+        ns = build_namespace([cd.clk, d, q])
+        evaluator = VerilatorEvaluator([cd], _FakeModel(), ns)
+        self.assertEqual(evaluator.eval(q), 0)
+        evaluator.assign(d, 5)
+        self.assertEqual(evaluator.eval(d), 0)
+        self.assertEqual(evaluator.eval(d, postcommit=True), 5)
+        self.assertEqual(evaluator.commit(), {d})
+        # the clock edge is applied before the writes of the same commit
+        evaluator.assign(d, 6)
+        evaluator.assign(cd.clk, 1)
+        self.assertEqual(evaluator.commit(), {cd.clk, d, q})
+        self.assertEqual(evaluator.eval(q), 5)
+        self.assertEqual(evaluator.eval(d[1:3]), 3)
+        with self.assertRaises(ValueError):
+            evaluator.eval(Signal())
+
+    @unittest.skipIf(shutil.which("verilator") is None, "verilator is not available")
+    def test_verilator(self):
+        traces = dict()
+        with tempfile.TemporaryDirectory() as dir, \
+                unittest.mock.patch.dict(os.environ, XDG_CACHE_HOME=dir):
+            for backend in "python", "verilator":
+                dut = _Datapath()
+                trace = []
+                run_simulation(dut, _datapath_bench(dut, trace, 0),
+                               backend=backend)
+                # the bits of sliced and parted that are not assigned by
+                # comb statements keep their reset value in Migen, but are
+                # undriven in the Verilog output
+                traces[backend] = [t[:4] + t[6:] for t in trace]
+
+            fragment = _Datapath().get_fragment()
+            mem = [s for s in fragment.specials if isinstance(s, Memory)][0]
+            def reader():
+                yield
+                yield mem[0]
+            with Simulator(fragment, reader(), backend="verilator") as s:
+                with self.assertRaises(ValueError):
+                    s.run()
+                with self.assertRaises(ValueError):
+                    s.save_state(os.path.join(dir, "state"))
+        self.assertEqual(traces["verilator"], traces["python"])
+
+
+class TraceCase(unittest.TestCase):
+    class Top(Module):
+        def __init__(self):
+            self.submodules.counter = Module()
+            self.count = Signal(4)
+            self.counter.sync += self.count.eq(self.count + 1)
+            self.count_next = Signal(4)
+            self.debug_flag = Signal()
+            self.comb += [
+                self.count_next.eq(self.count + 1),
+                self.debug_flag.eq(self.count == 3)
+            ]
+
+    def trace(self, generator=None, only_counter=False, **kwargs):
+        dut = self.Top()
+        if generator is None:
+            generator = (None for i in range(6))
+        with tempfile.TemporaryDirectory() as dir:
+            filename = os.path.join(dir, "trace.vcd")
+            if only_counter:
+                kwargs["trace_modules"] = [dut.counter]
+            run_simulation(dut, generator, vcd_name=filename, **kwargs)
+            with open(filename) as f:
+                lines = f.read().splitlines()
+        # value changes only come after the header
+        header = lines[:lines.index("$dumpvars")]
+        for line in header:
+            self.assertTrue(line.startswith("$"), line)
+        names = [line.split()[4] for line in lines if line.startswith("$var")]
+        return names, lines
+
+    def test_header(self):
+        names, lines = self.trace()
+        self.assertTrue(lines[0].startswith("$scope module"))
+        self.assertIn("b0001 " + lines[names.index("count_next") + 1].split()[3],
+                      lines[lines.index("$dumpvars"):lines.index("$end")])
+
+    def test_filters(self):
+        names, lines = self.trace(trace_include=["count*", "debug_*"],
+                                  trace_exclude=["*_next"])
+        self.assertEqual(names, ["count", "debug_flag"])
+        names, lines = self.trace(only_counter=True)
+        self.assertEqual(names, ["count"])
+
+    def test_window(self):
+        names, lines = self.trace(trace_window=(2, 4))
+        self.assertEqual([line for line in lines if line.startswith("$dump")],
+                         ["$dumpvars", "$dumpoff", "$dumpon", "$dumpoff"])
+        self.assertEqual(lines[lines.index("$dumpon") - 1], "#15")
+
+    def test_commands(self):
+        def gen():
+            yield "trace_off"
+            yield
+            yield
+            yield "trace_on"
+            yield
+        names, lines = self.trace(gen())
+        start = lines.index("$dumpoff")
+        stop = lines.index("$dumpon")
+        self.assertEqual(lines[start - 1], "#5")
+        self.assertEqual(lines[stop - 1], "#25")
+        for line in lines[start + len(names) + 2:stop]:
+            self.assertTrue(line.startswith("#"))
+
+
+class CombLoopCase(unittest.TestCase):
+    class Oscillator(Module):
+        def __init__(self):
+            self.en = Signal()
+            self.a = Signal()
+            self.b = Signal()
+            self.c = Signal()
+            self.comb += [
+                self.a.eq(~self.b & self.en),
+                self.b.eq(self.a),
+                self.c.eq(self.b)
+            ]
+
+    def gen(self, dut):
+        yield
+        yield dut.en.eq(1)
+        yield
+
+    def test_report(self):
+        dut = self.Oscillator()
+        with Simulator(dut, []) as sim:
+            self.assertEqual(sim.comb_loops(), [["a", "b"]])
+
+    def test_event(self):
+        dut = self.Oscillator()
+        with self.assertRaises(CombinationalLoopError) as cm:
+            run_simulation(dut, self.gen(dut))
+        self.assertEqual(cm.exception.signals, ["a", "b"])
+
+    def test_levelized(self):
+        dut = self.Oscillator()
+        with self.assertRaises(CombinationalLoopError) as cm:
+            run_simulation(dut, self.gen(dut), comb_schedule="levelized")
+        self.assertEqual(cm.exception.signals, ["a", "b"])
+
+    def test_settling_loop(self):
+        for comb_schedule in "event", "levelized":
+            m = Module()
+            x = Signal(4)
+            m.comb += x.eq(x | 1)
+            def gen():
+                yield
+                self.assertEqual((yield x), 1)
+            run_simulation(m, gen(), comb_schedule=comb_schedule)
+
+
+@unittest.skipIf(numpy is None, "NumPy is not available")
+class BatchCase(unittest.TestCase):
+    def test_lanes_agree(self):
+        from migen.sim.batch import per_lane
+
+        lanes = 5
+        expected = []
+        for seed in range(lanes):
+            dut = _Datapath()
+            expected.append([])
+            run_simulation(dut, _datapath_bench(dut, expected[-1], seed))
+
+        dut = _Datapath()
+        traces = [[] for seed in range(lanes)]
+        run_simulation(dut, per_lane(_datapath_bench(dut, traces[seed], seed)
+                                     for seed in range(lanes)),
+                       lanes=lanes)
+        self.assertEqual(traces, expected)
+
+    def test_stimulus_arrays(self):
+        from migen.sim.batch import Lanes
+
+        m = Module()
+        a = Signal(8)
+        acc = Signal(16)
+        m.sync += acc.eq(acc + a)
+        stimulus = numpy.arange(4*10).reshape(10, 4)
+        result = []
+        def gen():
+            for row in stimulus:
+                yield a.eq(Lanes(row))
+                yield
+            yield
+            result.append((yield acc))
+        run_simulation(m, gen(), lanes=4)
+        self.assertEqual(list(result[0]), list(stimulus.sum(axis=0)))
+
+    def test_wide(self):
+        # constants are not narrowed to native integers in wide designs
+        def build():
+            m = Module()
+            m.sel = Signal(reset=1)
+            m.o = Signal(80)
+            m.comb += m.o.eq(Cat(C(0, 70), -C(3, 4)) |
+                             Replicate(-C(1, 2), 20) |
+                             Mux(m.sel, C(1 << 75, 80), 0))
+            return m
+        def gen(m, result):
+            result.append((yield m.o))
+        expected = []
+        m = build()
+        run_simulation(m, gen(m, expected))
+        result = []
+        m = build()
+        run_simulation(m, gen(m, result), lanes=2)
+        self.assertEqual(list(result[0]), expected*2)
+
+    def test_wait_commands(self):
+        from migen.sim.batch import per_lane
+
+        def build():
+            m = Module()
+            m.count = Signal(4)
+            m.sync += m.count.eq(m.count + 1)
+            return m
+        for command in WaitUntil, WaitChange:
+            m = build()
+            def gen():
+                yield command(m.count == 3)
+            with self.assertRaises(TypeError):
+                run_simulation(m, gen(), lanes=2)
+
+        m = build()
+        result = []
+        def lane_gen(i):
+            yield WaitUntil(m.count == 3 + i)
+            result.append((i, (yield m.count)))
+        run_simulation(m, per_lane(lane_gen(i) for i in range(2)), lanes=2)
+        self.assertEqual(sorted(result), [(0, 3), (1, 4)])
+
+
+def _parallel_dut(config):
+    return _Datapath()
+
+
+def _parallel_bench(dut, config):
+    dut.trace = []
+    if config["seed"] < 0:
+        raise ValueError("negative seed")
+    return _datapath_bench(dut, dut.trace, config["seed"])
+
+
+def _parallel_collect(dut, config):
+    if config.get("unpicklable"):
+        return lambda: dut.trace
+    return dut.trace
+
+
+class ParallelCase(unittest.TestCase):
+    def test_seed_sweep(self):
+        from migen.sim.parallel import run_parallel
+
+        configs = [{"seed": seed} for seed in range(4)] + [{"seed": -1}]
+        results = run_parallel(_parallel_dut, _parallel_bench, configs,
+                               collect=_parallel_collect, max_workers=2)
+        self.assertEqual([r.index for r in results], list(range(5)))
+        for seed, r in enumerate(results[:4]):
+            self.assertTrue(r.passed)
+            dut = _Datapath()
+            expected = []
+            run_simulation(dut, _datapath_bench(dut, expected, seed))
+            self.assertEqual(r.result, expected)
+        self.assertFalse(results[4].passed)
+        self.assertIn("negative seed", results[4].error)
+
+    def test_unpicklable_result(self):
+        from migen.sim.parallel import run_parallel
+
+        configs = [{"seed": 0, "unpicklable": True}, {"seed": 1}]
+        results = run_parallel(_parallel_dut, _parallel_bench, configs,
+                               collect=_parallel_collect, max_workers=2)
+        self.assertEqual([r.passed for r in results], [False, True])
+        self.assertIsNotNone(results[0].traceback)
@@ -1,6 +1,7 @@
 import unittest
 
 from migen import *
+from migen.fhdl.bitcontainer import value_bits_sign
 
 
 def _same_slices(a, b):
@@ -17,3 +18,13 @@ class SignalSizeCase(unittest.TestCase):
         self.assertEqual(len(self.s), 13)
         self.assertEqual(len(self.i), 8)
         self.assertEqual(len(self.j), 8)
+
+    def test_cached_shape(self):
+        a = Signal(8)
+        e = Cat(a, self.s + 1)
+        self.assertEqual(len(e), 22)
+        self.assertEqual(value_bits_sign(e + 1), (23, False))
+        a.nbits = 10
+        self.assertEqual(len(e), 24)
+        self.s.signed = False
+        self.assertEqual(value_bits_sign(self.s + 1), (14, False))
@@ -1,8 +1,12 @@
 import unittest
 import os
 import tempfile
+import gzip
+import shutil
+import warnings
 
-from migen.sim.vcd import VCDWriter
+from migen.fhdl.structure import Signal
+from migen.sim.vcd import VCDWriter, FSTWriter, open_trace
 
 
 class VcdWriter(unittest.TestCase):
@@ -42,3 +46,104 @@ class VcdWriter(unittest.TestCase):
             filename = self.get_file_path(dir)
             self.vcd = VCDWriter(filename, module_name="name1")
             self.check_expectation(filename, expected_content)
+
+    def write_changes(self, filename):
+        a = Signal(4, name="a")
+        b = Signal((3, True), name="b")
+        self.vcd = VCDWriter(filename, buffer_size=16)
+        self.vcd.set(a, 0)
+        self.vcd.set(b, 0)
+        self.vcd.set(a, 5)
+        self.vcd.delay(10)
+        self.vcd.set(b, -1)
+        self.vcd.set(a, 5)
+        late = Signal(name="late")
+        with self.assertWarns(UserWarning) as w:
+            self.vcd.set(late, 1)
+        self.assertIn("late", str(w.warning))
+        # only the first value change is reported
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            self.vcd.set(late, 0)
+        self.vcd.delay(10)
+
+    changes = (
+        "$var wire 4 ! a $end\n"
+        "$var wire 3 \" b $end\n"
+        "$dumpvars\n"
+        "b0101 !\n"
+        "b000 \"\n"
+        "$end\n"
+        "#0\n"
+        "#10\n"
+        "b111 \"\n"
+        "#20\n"
+    )
+
+    def test_changes(self):
+        with tempfile.TemporaryDirectory() as dir:
+            filename = self.get_file_path(dir)
+            self.write_changes(filename)
+            self.check_expectation(filename, self.changes)
+
+    def test_fixed_signals(self):
+        a = Signal(name="a")
+        with tempfile.TemporaryDirectory() as dir:
+            filename = self.get_file_path(dir)
+            self.vcd = VCDWriter(filename, signals=[a])
+            self.vcd.delay(10)
+            # signals left out on purpose are ignored silently
+            with warnings.catch_warnings():
+                warnings.simplefilter("error")
+                self.vcd.set(Signal(name="other"), 1)
+            self.vcd.set(a, 1)
+            self.check_expectation(filename, (
+                "$var wire 1 ! a $end\n"
+                "$dumpvars\n"
+                "0!\n"
+                "$end\n"
+                "#0\n"
+                "#10\n"
+                "1!\n"
+            ))
+
+    def test_gzip(self):
+        with tempfile.TemporaryDirectory() as dir:
+            filename = self.get_file_path(dir) + ".gz"
+            self.write_changes(filename)
+            self.vcd.close()
+            with gzip.open(filename, "rt") as f:
+                self.assertMultiLineEqual(self.changes, f.read())
+
+
+class FstWriter(unittest.TestCase):
+    @unittest.skipIf(os.name != "posix", "requires a POSIX shell")
+    def test_pipe(self):
+        with tempfile.TemporaryDirectory() as dir:
+            # stand-in for vcd2fst that stores the VCD stream
+            converter = os.path.join(dir, "vcd2fst")
+            with open(converter, "w") as f:
+                f.write("#!/bin/sh\ncat \"$1\" > \"$2\"\n")
+            os.chmod(converter, 0o755)
+            filename = os.path.join(dir, "test.fst")
+            vcd = FSTWriter(filename, vcd2fst=converter)
+            vcd.set(Signal(name="a"), 1)
+            vcd.delay(5)
+            vcd.close()
+            with open(filename) as f:
+                self.assertTrue(f.read().startswith("$scope module top $end\n"))
+
+    @unittest.skipIf(shutil.which("vcd2fst") is None, "vcd2fst is not available")
+    def test_vcd2fst(self):
+        with tempfile.TemporaryDirectory() as dir:
+            filename = os.path.join(dir, "test.fst")
+            vcd = open_trace(filename)
+            self.assertIsInstance(vcd, FSTWriter)
+            vcd.set(Signal(4, name="a"), 3)
+            vcd.delay(5)
+            vcd.close()
+            self.assertTrue(os.path.getsize(filename))
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            open_trace("test.vcd", trace_format="foo")
@@ -0,0 +1,197 @@
+import unittest
+import os
+import tempfile
+
+from migen import *
+from migen.fhdl import verilog
+from migen.fhdl.structure import _Fragment, _ArrayProxy, _Slice
+from migen.fhdl.tools import (group_by_targets, lower_basics, list_signals,
+                              insert_resets)
+from migen.fhdl.visit import NodeVisitor, NodeTransformer, fuse
+
+
+class ConvOutputCase(unittest.TestCase):
+    class Top(Module):
+        def __init__(self):
+            self.sel = Signal(4)
+            self.o = Signal(8)
+            statement = If(self.sel == 0, self.o.eq(0))
+            for i in range(1, 16):
+                statement = statement.Elif(self.sel == i, self.o.eq(i))
+            self.sync += statement
+            mem = Memory(8, 4, init=[1, 2, 3, 4])
+            self.specials += mem, mem.get_port()
+
+    def test_fragments(self):
+        top = self.Top()
+        output = verilog.convert(top, {top.sel, top.o})
+        source = output.main_source
+        self.assertTrue(source.startswith("/* Machine-generated using Migen */\n"))
+        self.assertTrue(source.endswith("endmodule\n"))
+        self.assertEqual(source.count("end else begin\n"), 15)
+        self.assertEqual(source.count("\n" + "\t"*16 + "if ("), 1)
+        self.assertIn("$readmemh", source)
+        self.assertIs(output.main_source, source)
+
+    def test_write(self):
+        top = self.Top()
+        output = verilog.convert(top, {top.sel, top.o})
+        with tempfile.TemporaryDirectory() as dir:
+            filename = os.path.join(dir, "top.v")
+            cwd = os.getcwd()
+            os.chdir(dir)
+            try:
+                output.write(filename)
+            finally:
+                os.chdir(cwd)
+            with open(filename) as f:
+                self.assertEqual(f.read(), output.main_source)
+            self.assertEqual(sorted(os.listdir(dir)), ["mem.init", "top.v"])
+
+
+class GroupByTargetsCase(unittest.TestCase):
+    def test_order(self):
+        a, b, c, d = [Signal(name=name) for name in "abcd"]
+        s0 = a.eq(1)
+        s1 = b.eq(a)
+        s2 = c.eq(1)
+        s3 = If(d, a.eq(0), c.eq(0))
+        s4 = Display("x")
+        s5 = b.eq(0)
+        groups = group_by_targets([s0, [s1, s2], s3, s4, s5])
+        # groups are ordered by their last statement
+        self.assertEqual([targets for targets, statements in groups],
+                         [{a, c}, set(), {b}])
+        self.assertEqual([[id(s) for s in statements]
+                          for targets, statements in groups],
+                         [[id(s0), id(s2), id(s3)], [id(s4)], [id(s1), id(s5)]])
+
+
+class NodeTransformerCase(unittest.TestCase):
+    class Sharing(NodeTransformer):
+        share_unchanged = True
+
+    class Renamer(Sharing):
+        def __init__(self, old, new):
+            self.old = old
+            self.new = new
+
+        def visit_Signal(self, node):
+            return self.new if node is self.old else node
+
+    def setUp(self):
+        self.a, self.b, self.c, self.d = [Signal(8) for i in range(4)]
+        self.sel = Signal(2)
+        self.shared = self.b.eq(self.c + 1)
+        self.changed = self.c.eq(Cat(self.a[:4], self.d[4:]))
+        self.statements = [
+            If(self.sel == 0, self.shared).Else(
+                Case(self.sel, {1: self.changed, "default": self.d.eq(0)}))
+        ]
+
+    def test_copy(self):
+        r = NodeTransformer().visit(self.statements)
+        self.assertIsNot(r[0], self.statements[0])
+        self.assertIsNot(r[0].t[0], self.shared)
+        self.assertIs(r[0].t[0].l, self.b)
+
+    def test_unchanged(self):
+        r = self.Sharing().visit(self.statements)
+        self.assertIsNot(r, self.statements)
+        self.assertIs(r[0], self.statements[0])
+
+    def test_changed(self):
+        e = Signal(8)
+        r = self.Renamer(self.a, e).visit(self.statements)
+        # nodes are copied on the path to the change only
+        self.assertIsNot(r[0], self.statements[0])
+        self.assertIs(r[0].cond, self.statements[0].cond)
+        self.assertIs(r[0].t[0], self.shared)
+        case = r[0].f[0]
+        self.assertIs(case.cases["default"][0],
+                      self.statements[0].f[0].cases["default"][0])
+        changed = case.cases[Constant(1)][0]
+        self.assertIs(changed.l, self.c)
+        self.assertIs(changed.r.l[0].value, e)
+        self.assertIs(changed.r.l[1], self.changed.r.l[1])
+        self.assertIs(self.changed.r.l[0].value, self.a)
+
+
+class FuseCase(unittest.TestCase):
+    class SignalCounter(NodeVisitor):
+        def __init__(self):
+            self.signals = 0
+
+        def visit_Signal(self, node):
+            self.signals += 1
+
+    class ConstantCounter(NodeVisitor):
+        def visit_Constant(self, node):
+            self.constants += 1
+
+    def test_visitors(self):
+        a, b = Signal(), Signal()
+        visitor = fuse(self.SignalCounter, self.ConstantCounter)()
+        visitor.constants = 0
+        visitor.visit([a.eq(b + 1), If(a, b.eq(0))])
+        self.assertEqual((visitor.signals, visitor.constants), (4, 2))
+
+    def test_conflict(self):
+        class SignalLister(NodeVisitor):
+            def visit_Signal(self, node):
+                pass
+
+        with self.assertRaises(ValueError):
+            fuse(self.SignalCounter, SignalLister)
+
+    def test_lowering(self):
+        a = Array(Signal(8) for i in range(4))
+        b = Signal(8)
+        k = Signal(2)
+        o = Signal(4)
+        f = _Fragment(comb=[o.eq((a[k] + b)[2:6])],
+                      sync={"sys": [a[k][:4].eq(o)]})
+        f.clock_domains.append(ClockDomain("sys"))
+        f = lower_basics(f, complex_slices=True)
+
+        class Checker(NodeVisitor):
+            def visit_ArrayProxy(self, node):
+                raise AssertionError("ArrayProxy was not lowered")
+
+            def visit_Slice(self, node):
+                if not isinstance(node.value, Signal):
+                    raise AssertionError("complex slice was not lowered")
+
+        Checker().visit(f)
+        self.assertLessEqual(set(a), list_signals(f))
+
+    def test_reset_signal(self):
+        def build():
+            a = Signal(8, reset=1)
+            f = _Fragment(sync={"sys": [a.eq(a + 1)]})
+            f.clock_domains.append(ClockDomain("sys"))
+            return f
+        f = build()
+        insert_resets(f)
+        # resolved when the basics are lowered
+        self.assertIsInstance(f.sync["sys"][-1].cond, ResetSignal)
+        f = lower_basics(f)
+        self.assertIs(f.sync["sys"][-1].cond, f.clock_domains["sys"].rst)
+        f = lower_basics(build())
+        insert_resets(f, lowered=True)
+        self.assertIs(f.sync["sys"][-1].cond, f.clock_domains["sys"].rst)
+
+    def test_resets(self):
+        class Top(Module):
+            def __init__(self):
+                self.k = Signal(2)
+                self.i = Signal(8)
+                self.a = Array(Signal(8, reset=i) for i in range(4))
+                self.sync += self.a[self.k].eq(self.i)
+
+        top = Top()
+        source = verilog.convert(top, {top.k, top.i}).main_source
+        resets = source[source.index("if (sys_rst)"):]
+        self.assertEqual(resets.count("<= 8'd"), 4)
+        # the variable of the lowered array is not reset
+        self.assertNotIn(" = ", resets)